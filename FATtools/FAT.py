@@ -2,11 +2,12 @@
 # Utilities to manage a FAT12/16/32 file system
 #
 
-import sys, copy, os, struct, time, io, atexit, functools
+import sys, copy, os, re, struct, time, io, array, functools, bisect, itertools
 from datetime import datetime
 from collections import OrderedDict
 from zlib import crc32
 from FATtools import disk, utils
+from FATtools.freemap import FreeSpaceMap, POLICIES
 from FATtools.debug import log
 
 DEBUG=int(os.getenv('FATTOOLS_DEBUG', '0'))
@@ -18,6 +19,52 @@ VFS_ENCODING = 'cp1252' # set here encoding to use in virtual FAT FS
 class FATException(Exception):
 	pass
 
+_NONZERO = re.compile(b'[^\0]') # end of a run of zero bytes (free FAT slots)
+_ZERO_BLOCK = bytes(4096)
+
+def _zero_runs(s, size):
+    """Yields (first slot, slots) for each run of zero 'size' bytes slots in 's'.
+    Runs of zero bytes are found with bytes.find, measured with startswith and a
+    regex, then trimmed to whole slots, so used slots cost nothing in Python."""
+    s = bytes(s) # find needs bytes (a page copy if memoryview)
+    zero = bytes(size)
+    start = s.find(zero)
+    while start > -1:
+        end = start+size
+        while s.startswith(_ZERO_BLOCK, end): # memcmp, fast on a blank FAT
+            end += len(_ZERO_BLOCK)
+        m = _NONZERO.search(s, end)
+        end = m.start() if m else len(s)
+        first, last = (start+size-1)//size, end//size # whole slots only
+        if last > first:
+            yield first, last-first
+        start = s.find(zero, end)
+
+def _unpack12(s):
+    "Returns the list of the 12-bit slots packed in FAT12 bytes 's'"
+    slots = []
+    for k in range(len(s)*8//12):
+        j = k*3//2
+        if k%2: # odd cluster: top 12 bits of the 16 in j, j+1
+            slots.append(s[j]>>4 | s[j+1]<<4)
+        else: # even cluster: bottom 12 bits
+            slots.append(s[j] | (s[j+1]&0x0F)<<8)
+    return slots
+
+def _pack12(slots):
+    "Returns the FAT12 bytes packing the 12-bit 'slots'"
+    s = bytearray((len(slots)*12+7)//8)
+    for k, slot in enumerate(slots):
+        j = k*3//2
+        if k%2:
+            s[j] |= (slot&0x0F)<<4
+            s[j+1] = slot>>4
+        else:
+            s[j] = slot&0xFF
+            s[j+1] |= slot>>8
+    return s
+
+@utils.layout_class
 class boot_fat32(object):
     "FAT32 Boot Sector"
     layout = { # { offset: (name, unpack string) }
@@ -58,10 +105,6 @@ class boot_fat32(object):
         self._pos = offset # base offset
         self._buf = s or bytearray(512) # normal boot sector size
         self.stream = stream
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
         self.__init2__()
 
     def __init2__(self):
@@ -74,8 +117,10 @@ class boot_fat32(object):
         self.dataoffs = self.fatoffs + self.uchFATCopies * self.dwSectorsPerFAT * self.wBytesPerSector + self._pos
         # Number of clusters represented in this FAT (if valid buffer)
         self.fatsize = self.dwTotalLogicalSectors//self.uchSectorsPerCluster
-        if self.stream:
-            self.fsinfo = fat32_fsinfo(stream=self.stream, offset=self.wFSISector*self.cluster)
+        if self.stream and self.wFSISector not in (0, 0xFFFF):
+            offset = self.wFSISector*self.wBytesPerSector + self._pos
+            self.stream.seek(offset)
+            self.fsinfo = fat32_fsinfo(bytearray(self.stream.read(512)), offset, self.stream)
         else:
             self.fsinfo = None
 
@@ -110,6 +155,7 @@ class boot_fat32(object):
 
 
 
+@utils.layout_class
 class fat32_fsinfo(object):
     "FAT32 FSInfo Sector (usually sector 1)"
     layout = { # { offset: (name, unpack string) }
@@ -125,10 +171,6 @@ class fat32_fsinfo(object):
         self._pos = offset # base offset
         self._buf = s or bytearray(512) # normal FSInfo sector size
         self.stream = stream
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
 
     __getattr__ = utils.common_getattr
 
@@ -143,6 +185,7 @@ class fat32_fsinfo(object):
 
 
 
+@utils.layout_class
 class boot_fat16(object):
     "FAT12/16 Boot Sector"
     layout = { # { offset: (name, unpack string) }
@@ -174,10 +217,6 @@ class boot_fat16(object):
         self._pos = offset # base offset
         self._buf = s or bytearray(512) # normal boot sector size
         self.stream = stream
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
         self.__init2__()
 
     def __init2__(self):
@@ -229,8 +268,13 @@ class boot_fat16(object):
 
 # NOTE: limit decoded dictionary size! Zero or {}.popitem()?
 class FAT(object):
-    "Decodes a FAT (12, 16, 32 o EX) table on disk"
-    def __init__ (self, stream, offset, clusters, bitsize=32, exfat=0):
+    """Decodes a FAT (12, 16, 32 o EX) table on disk. Changes are written to
+    the first FAT at once; the other copies ('mirrors') are updated from it at
+    flush time, unless 'mirror_now' is set (crash consistency: both copies
+    always written together)"""
+    block = 4096 # mirrors dirty tracking granularity, in FAT bytes
+
+    def __init__ (self, stream, offset, clusters, bitsize=32, exfat=0, fsinfo=None, mirrors=None):
         self.stream = stream
         self.size = clusters # total clusters in the data area (max = 2^x - 11)
         self.bits = bitsize # cluster slot bits (12, 16 or 32)
@@ -238,6 +282,10 @@ class FAT(object):
         # CAVE! This accounts the 0-1 unused cluster index?
         self.offset2 = offset + (((clusters*bitsize+7)//8)+511)//512*512 # relative FAT offset (2nd copy)
         self.exfat = exfat # true if exFAT (aka FAT64)
+        # offsets of the FAT copies mirroring the first (exFAT has one FAT only, by default)
+        self.mirrors = [] if exfat else ([self.offset2] if mirrors is None else mirrors)
+        self.mirror_now = False # if set, mirrors are written with the first FAT
+        self.mirror_dirty = set() # first FAT blocks to copy into the mirrors
         self.reserved = 0x0FF7
         self.bad = 0x0FF7
         self.last = 0x0FFF
@@ -264,11 +312,32 @@ class FAT(object):
         self.real_last = min(self.reserved-1, self.size+2-1)
         self.decoded = {} # {cluster index: cluster content}
         self.last_free_alloc = 2 # last free cluster allocated (also set in FAT32 FSInfo)
-        self.free_clusters = None # tracks free clusters
-        # ordered (by disk offset) dictionary {first_cluster: run_length} mapping free space
-        self.free_clusters_map = None
-        self.map_free_space()
+        self.policy = 'first' # default allocation policy (see FreeSpaceMap)
+        # FreeSpaceMap of free runs {first_cluster: run_length}, sorted by disk offset.
+        # It is built lazily, scanning the FAT a page at a time only as far as
+        # allocations need (see _scan)
+        self.free_clusters_map = (FreeSpaceMap(), None)[bool(exfat)]
+        self.scanned = 2 # first cluster not mapped yet
+        self.page = (1<<20)*8//bitsize if bitsize == 32 else clusters+2 # clusters scanned at once (FAT32: 1 MB pages)
+        self.unscanned_free = None # free clusters not mapped yet, if known
+        self.fsinfo = fsinfo # FAT32 FSInfo sector
+        if fsinfo and fsinfo.sSignature1 == b'RRaA' and fsinfo.sSignature2 == b'rrAa' and fsinfo.dwFreeClusters <= clusters:
+            # trusts the free clusters count, so that mounting scans nothing
+            self.unscanned_free = fsinfo.dwFreeClusters
+            if 2 < fsinfo.dwNextFreeCluster <= self.real_last:
+                self.last_free_alloc = fsinfo.dwNextFreeCluster-1
+            if DEBUG&4: log("FSInfo: %d free clusters, next free #%d", fsinfo.dwFreeClusters, fsinfo.dwNextFreeCluster)
+        self._fsinfo_state = (self.unscanned_free, self.last_free_alloc) # free clusters and last allocated, as in FSInfo
         self.free_clusters_flag = 1
+
+    @property
+    def free_clusters(self):
+        """Free clusters count (None with exFAT, whose free space lives in the bitmap).
+        If FSInfo did not give it, the whole FAT is scanned to count them."""
+        if self.free_clusters_map is None: return None
+        if self.unscanned_free is None:
+            self._scan()
+        return self.free_clusters_map.clusters + max(0, self.unscanned_free)
         
     def __str__ (self):
         return "%d-bit %sFAT table of %d clusters starting @%Xh\n" % (self.bits, ('','ex')[self.exfat], self.size, self.offset)
@@ -297,7 +366,6 @@ class FAT(object):
         if DEBUG&4: log("Got FAT1[0x%X]=0x%X @0x%X", index, slot, pos)
         return slot
 
-    # Defer write on FAT#2 allowing undelete?
     def __setitem__ (self, index, value):
         "Set the value stored in a given cluster index"
         try:
@@ -333,11 +401,7 @@ class FAT(object):
         self.stream.seek(pos)
         value = struct.pack(self.fat_slot_fmt, value)
         self.stream.write(value)
-        if self.exfat: return # exFAT has one FAT only (default)
-        pos = self.offset2+dsp
-        if DEBUG&4: log("setting FAT2[0x%X] @0x%X", index, pos)
-        self.stream.seek(pos)
-        self.stream.write(value)
+        self._mirror(dsp, value)
 
     def isvalid(self, index):
         "Tests if index is a valid cluster number in this FAT"
@@ -394,137 +458,147 @@ class FAT(object):
 
     def findmaxrun(self):
         "Finds the greatest cluster run available. Returns a tuple (total_free_clusters, (run_start, clusters))"
-        t = 1,0
-        maxrun=(0,0)
-        n=0
-        while 1:
-            t = self.findfree(t[0]+1)
-            if t[0] < 0: break
-            if DEBUG&4: log("Found %d free clusters from #%d", t[1], t[0])
-            maxrun = max(t, maxrun, key=lambda x:x[1])
-            n += t[1]
-            t = (t[0]+t[1], t[1])
-        if DEBUG&4: log("Found the biggest run of %d clusters from #%d on %d total free clusters", maxrun[1], maxrun[0], n)
-        return n, maxrun
+        self._scan()
+        maxrun = self.free_clusters_map.largest()
+        if DEBUG&4: log("Found the biggest run of %d clusters from #%d on %d total free clusters", maxrun[1], maxrun[0], self.free_clusters)
+        return self.free_clusters, maxrun
 
     def map_free_space(self):
-        "Maps the free clusters in an ordered dictionary {start_cluster: run_length}"
+        """Maps all the free clusters in a FreeSpaceMap {start_cluster: run_length},
+        scanning the whole FAT again (as fsck would): the count found replaces
+        the FSInfo one"""
         if self.exfat: return
+        self.free_clusters_map = FreeSpaceMap()
+        self.scanned = 2
+        self.unscanned_free = None
+        self._scan()
+        if DEBUG&4: log("map_free_space: %s", self.free_clusters_map)
+        return self.free_clusters, len(self.free_clusters_map)
+
+    def _scan(self, upto=None):
+        """Maps the free clusters from the first not scanned yet to 'upto' (or to
+        the last one), a FAT page at a time. Runs crossing pages are joined."""
+        end = self.size+2
+        if upto is not None: end = min(upto, end)
+        m = self.free_clusters_map
+        while self.scanned < end:
+            count = min(self.page, self.size+2-self.scanned)
+            n = m.clusters
+            m.update(self._page_runs(self.scanned, count))
+            if self.unscanned_free is not None:
+                self.unscanned_free -= m.clusters-n # clusters freed after mount were in the map already
+            self.scanned += count
+        if self.scanned >= self.size+2:
+            self.unscanned_free = 0 # exact count, now
+
+    def _page_runs(self, first, count):
+        "Returns the free runs (start_cluster, run_length) among 'count' FAT slots from cluster 'first'"
         startpos = self.stream.tell()
-        self.free_clusters_map = {}
-        FREE_CLUSTERS=0
-        if self.bits < 32:
-            # FAT16 is max 130K...
-            PAGE = self.offset2 - self.offset - (2*self.bits)//8
-        else:
-            # FAT32 could reach ~1GB!
-            PAGE = 1<<20
-        END_OF_CLUSTERS = self.offset + (self.size*self.bits+7)//8 + (2*self.bits)//8
-        i = self.offset+(2*self.bits)//8 # address of cluster #2
-        self.stream.seek(i)
-        while i < END_OF_CLUSTERS:
-            s = self.stream.read(min(PAGE, END_OF_CLUSTERS-i)) # slurp full FAT, or 1M page if FAT32
-            if DEBUG&4: log("map_free_space: loaded FAT page of %d bytes @0x%X", len(s), i)
-            j=0
-            while j < len(s):
-                first_free = -1
-                run_length = -1
-                while j < len(s):
-                    if self.bits == 32:
-                        if s[j] != 0 or s[j+1] != 0 or s[j+2] != 0 or s[j+3] != 0:
-                            j += 4
-                            if run_length > 0: break
-                            continue
-                    elif self.bits == 16:
-                        if s[j] != 0 or s[j+1] != 0:
-                            j += 2
-                            if run_length > 0: break
-                            continue
-                    elif self.bits == 12:
-                        # Pick the 12 bits wanted
-                        #     0        1        2
-                        # AAAAAAAA AAAABBBB BBBBBBBB
-                        if not j%3:
-                            if s[j] != 0 or s[j+1]>>4 != 0:
-                                j += 1
-                                if run_length > 0: break
-                                continue
-                        elif j%3 == 1:
-                            j+=1
-                            continue # simply skips median byte
-                        else: # j%3==2
-                            if s[j] != 0 or s[j-1] & 0x0FFF != 0:
-                                j += 1
-                                if run_length > 0: break
-                                continue
-                    if first_free < 0:
-                        first_free = (i-self.offset+j)*8//self.bits
-                        if DEBUG&4: log("map_free_space: found run from %d", first_free)
-                        run_length = 0
-                    run_length += 1
-                    j+=self.bits//8
-                if first_free < 0: continue
-                FREE_CLUSTERS+=run_length
-                self.free_clusters_map[first_free] =  run_length
-                if DEBUG&4: log("map_free_space: appended run (%d, %d)", first_free, run_length)
-            i += len(s) # advance to next FAT page to examine
+        pos = self.offset + (first*self.bits)//8
+        self.stream.seek(pos)
+        read = getattr(self.stream, 'readview', self.stream.read) # zero-copy if possible
+        s = read((count*self.bits+7)//8)
+        if DEBUG&4: log("_page_runs: loaded FAT page of %d bytes @0x%X", len(s), pos)
         self.stream.seek(startpos)
-        self.free_clusters = FREE_CLUSTERS
-        if DEBUG&4: log("map_free_space: %d clusters free in %d runs", FREE_CLUSTERS, len(self.free_clusters_map))
-        return FREE_CLUSTERS, len(self.free_clusters_map)
-
-    def findfree(self, count=0):
-        """Returns index and length of the first free clusters run beginning from
-        'start' or (-1,0) in case of failure. If 'count' is given, limit the search
-        to that amount."""
-        if self.free_clusters_map == None:
-            self.map_free_space()
-        chosen = None
-        for i in sorted(self.free_clusters_map.keys()):
-            n = self.free_clusters_map[i]
-            if n>=count:
-                chosen=i
-                break
-        if chosen == None:
+        return [(first+start, n) for start, n in self._free_slots(s)]
+
+    def _map_for(self, count, policy):
+        """Scans the FAT further, as needed, until the free space mapped holds the
+        run that 'policy' picks for 'count' clusters"""
+        if self.scanned >= self.size+2: return
+        if policy in ('best', 'contig'): # the smallest run could be anywhere
+            return self._scan()
+        m = self.free_clusters_map
+        while self.scanned < self.size+2:
+            i, n = m.find(count, policy, self.last_free_alloc)
+            if i > -1 and (policy != 'next' or i >= self.last_free_alloc): break # 'next' wrapped: looks past the hint first
+            self._scan(self.scanned+self.page)
+
+    def _free_slots(self, s):
+        """Yields (first slot, slots) for each run of free (zero) slots in the FAT
+        bytes 's', which must begin at a slot boundary. FAT16/32: see _zero_runs;
+        FAT12 (4084 slots at most) is unpacked slot by slot."""
+        if self.bits == 12:
+            first = -1
+            slots = _unpack12(s)
+            for k, slot in enumerate(slots):
+                if not slot:
+                    if first < 0: first = k
+                elif first > -1:
+                    yield first, k-first
+                    first = -1
+            if first > -1:
+                yield first, len(slots)-first
+            return
+        yield from _zero_runs(s, self.bits//8)
+
+    def _mirror(self, dsp, s):
+        "Writes the first FAT bytes 's' changed at 'dsp' into the mirrors, or marks them for flush"
+        if not self.mirrors: return
+        if self.mirror_now:
+            for offset in self.mirrors:
+                if DEBUG&4: log("setting FAT mirror @0x%X", offset+dsp)
+                self.stream.seek(offset+dsp)
+                self.stream.write(s)
+            return
+        self.mirror_dirty.update(range(dsp//self.block, (dsp+len(s)-1)//self.block+1))
+
+    def flush(self):
+        """Commits pending FAT changes: the first FAT is written through, so its
+        changed blocks are copied into the mirrors, in sorted runs"""
+        if self.mirror_dirty:
+            blocks = sorted(self.mirror_dirty)
+            self.mirror_dirty = set()
+            size = ((self.size+2)*self.bits+7)//8 # FAT bytes in use
+            startpos = self.stream.tell()
+            i = 0
+            while i < len(blocks):
+                j = i
+                while j+1 < len(blocks) and blocks[j+1] == blocks[j]+1: j += 1
+                start, end = blocks[i]*self.block, min((blocks[j]+1)*self.block, size)
+                self.stream.seek(self.offset+start)
+                s = self.stream.read(end-start)
+                for offset in self.mirrors:
+                    if DEBUG&4: log("FAT: copying %d bytes @%Xh into the mirror @%Xh", end-start, start, offset)
+                    self.stream.seek(offset+start)
+                    self.stream.write(s)
+                i = j+1
+            self.stream.seek(startpos)
+        self._flush_fsinfo()
+
+    def _flush_fsinfo(self):
+        """Writes the free clusters count and the next free cluster to FAT32
+        FSInfo, if they changed (or got known) since mount"""
+        fsi = self.fsinfo
+        if not fsi or self.unscanned_free is None or self.stream.mode != 'r+b': return
+        state = (self.free_clusters, self.last_free_alloc)
+        if state == self._fsinfo_state: return
+        fsi.sSignature1, fsi.sSignature2, fsi.wBootSignature = b'RRaA', b'rrAa', 0xAA55
+        fsi.dwFreeClusters = state[0]
+        fsi.dwNextFreeCluster = (0xFFFFFFFF, state[1]+1)[state[1] < self.real_last]
+        if DEBUG&4: log("FSInfo: updating to %d free clusters, next free #%d", state[0], state[1]+1)
+        self.stream.seek(fsi._pos)
+        self.stream.write(fsi.pack())
+        self._fsinfo_state = state
+
+    def findfree(self, count=0, policy=None):
+        """Takes from the free space map the first run of at least 'count' clusters
+        (or the one chosen by 'policy'), returning its index and 'count', or
+        (-1,-1) in case of failure."""
+        policy = policy or self.policy
+        self._map_for(count, policy)
+        i, n = self.free_clusters_map.find(count, policy, self.last_free_alloc)
+        if i < 0:
             return -1,-1
-        n=self.free_clusters_map[chosen]
-        i=chosen
-        del self.free_clusters_map[i]
         if DEBUG&4: log("got run of %d free clusters from #%x", n, i)
-        if n-count > 0:
-            self.free_clusters_map[i+count] = n-count # updates map
-        self.free_clusters-=min(n,count)
-        return i, min(n, count)
-    
+        n = min(n, count)
+        self.free_clusters_map.take(i, n)
+        return i, n
+
     def map_compact(self, strategy=0):
-        "Compacts, eventually reordering, the free space runs map"
-        if not self.free_clusters_flag: return
-        #~ print "Map before:", sorted(self.free_clusters_map.iteritems())
-        map_changed = 0
-        while 1:
-            d=copy.copy(self.free_clusters_map)
-            for k,v in sorted(self.free_clusters_map.items()):
-                while d.get(k+v): # while contig runs exist, merge
-                    v1 = d.get(k+v)
-                    if DEBUG&4: log("Compacting free_clusters_map: {%d:%d} -> {%d:%d}", k,v,k,v+v1)
-                    d[k] = v+v1
-                    del d[k+v]
-                    #~ print "Compacted {%d:%d} -> {%d:%d}" %(k,v,k,v+v1)
-                    #~ print sorted(d.iteritems())
-                    v+=v1
-            if self.free_clusters_map != d:
-                self.free_clusters_map = d
-                map_changed = 1
-                continue
-            break
+        "Kept for compatibility: FreeSpaceMap merges adjacent runs as they are freed"
         self.free_clusters_flag = 0
-        #~ if strategy == 1:
-            #~ self.free_clusters_map = OrderedDict(sorted(self.free_clusters_map.items(), key=lambda t: t[0])) # sort by disk offset
-        #~ elif strategy == 2:
-            #~ self.free_clusters_map = OrderedDict(sorted(self.free_clusters_map.items(), key=lambda t: t[1])) # sort by run size
-        if DEBUG&4: log("Free space map - %d run(s): %s", len(self.free_clusters_map), self.free_clusters_map)
-        #~ print "Map AFTER:", sorted(self.free_clusters_map.iteritems())
-        
+
     # TODO: split very large runs
     # About 12% faster injecting a Python2 tree
     def mark_run(self, start, count, clear=False):
@@ -536,8 +610,7 @@ class FAT(object):
             return
         if self.bits == 12:
             if clear == True:
-                self.free_clusters_flag = 1
-                self.free_clusters_map[start] = count
+                self.free_clusters_map.free(start, count)
             while count:
                 self[start] = (start+1, 0)[clear==True]
                 start+=1
@@ -551,12 +624,9 @@ class FAT(object):
                 self.decoded[i] = 0
             run = bytearray(count*(self.bits//8))
             self.stream.write(run)
-            self.free_clusters_flag = 1
-            self.free_clusters_map[start] = count
-            if self.exfat: return # exFAT has one FAT only (default)
-            # updating FAT2, too!
-            self.stream.seek(self.offset2+dsp)
-            self.stream.write(run)
+            self._mirror(dsp, run)
+            if self.exfat: return # exFAT free space lives in the Bitmap
+            self.free_clusters_map.free(start, count)
             return
         # consecutive values to set
         L = range(start+1, start+1+count)
@@ -568,20 +638,52 @@ class FAT(object):
         L[-1] = struct.pack(self.fat_slot_fmt, self.last)
         run = bytearray().join(L)
         self.stream.write(run)
-        if self.exfat: return # exFAT has one FAT only (default)
-        # updating FAT2, too!
-        pos = self.offset2+dsp
-        self.stream.seek(pos)
+        self._mirror(dsp, run)
+
+    def mark_chains(self, start, lengths):
+        """Marks a sequence of adjacent chains from 'start', each one of the given
+        length and terminated by END CLUSTER mark, with one write (optimized for
+        FAT16/32)"""
+        if not lengths: return
+        if DEBUG&4: log("mark_chains(%Xh, %d chains of %d clusters)", start, len(lengths), sum(lengths))
+        if start<2 or start+sum(lengths)-1>self.real_last:
+            if DEBUG&4: log("attempt to mark invalid chains, aborted!")
+            return
+        if self.bits == 12:
+            for count in lengths:
+                self.mark_run(start, count)
+                self[start+count-1] = self.last
+                start += count
+            return
+        L = []
+        i = start
+        for count in lengths:
+            L.extend(range(i+1, i+count))
+            L.append(self.last)
+            i += count
+        for i, v in enumerate(L, start):
+            self.decoded[i] = v
+        run = struct.pack('<%d%s' % (len(L), self.fat_slot_fmt[1]), *L)
+        dsp = (start*self.bits)//8
+        self.stream.seek(self.offset+dsp)
         self.stream.write(run)
+        self._mirror(dsp, run)
 
     def alloc(self, runs_map, count, params={}):
         """Allocates a set of free clusters, marking the FAT.
         runs_map is the dictionary of previously allocated runs
         count is the number of clusters to allocate
-        params is an optional dictionary of directives to tune the allocation (to be done). 
+        params is an optional dictionary of directives to tune the allocation:
+          'policy' - 'first' (default: self.policy), 'best', 'next' (from
+          last_free_alloc) or 'contig' (a single run, or failure); the others
+          split the request over the largest runs if no run fits it whole
         Returns the last cluster or raise an exception in case of failure"""
-        self.map_compact()
+        policy = params.get('policy', self.policy)
+        if policy not in POLICIES:
+            raise FATException("Unknown allocation policy '%s'" % policy)
 
+        if self.free_clusters < count:
+            self._scan() # FSInfo count could be wrong
         if self.free_clusters < count:
             if DEBUG&4: log("Couldn't allocate %d cluster(s), only %d free", count, self.free_clusters)
             raise FATException("FATAL! Free clusters exhausted, couldn't allocate %d, only %d left!" % (count, self.free_clusters))
@@ -592,8 +694,12 @@ class FAT(object):
         
         while count:
             if runs_map:
-                last_run = list(runs_map.items())[-1]
-            i, n = self.findfree(count)
+                last_run = next(reversed(runs_map.items()))
+            self._map_for(count, policy)
+            i, n = self.free_clusters_map.alloc(count, policy, self.last_free_alloc)
+            if i < 0:
+                if DEBUG&4: log("Couldn't allocate %d contiguous cluster(s)", count)
+                raise FATException("FATAL! No free run of %d contiguous clusters!" % count)
             self.mark_run(i, n) # marks the FAT
             if last_run:
                 self[last_run[0]+last_run[1]-1] = i # link prev chain with last
@@ -615,14 +721,10 @@ class FAT(object):
         if start < 2 or start > self.real_last:
             if DEBUG&4: log("free: attempt to free from invalid cluster %Xh", start)
             return
-        self.free_clusters_flag = 1
         if runs:
             for run in runs:
                 if DEBUG&4: log("free: directly zeroing run of %d clusters from %Xh", runs[run], run)
-                self.mark_run(run, runs[run], True)
-                if not self.exfat:
-                    self.free_clusters += runs[run]
-                    self.free_clusters_map[run] = runs[run]
+                self.mark_run(run, runs[run], True) # updates the free space map, too
             return
 
         while True:
@@ -631,15 +733,156 @@ class FAT(object):
                 log("free: count_run returned %d, %Xh", length, next)
                 log("free: zeroing run of %d clusters from %Xh (next=%Xh)", length, start, next)
             self.mark_run(start, length, True)
-            if not self.exfat:
-                self.free_clusters += length
-                self.free_clusters_map[start] = length
             start = next
             if self.last <= next <= self.last+7: break
 
 
 
-class Chain(object):
+class MemoryFAT(FAT):
+    """A FAT kept in memory: the table is loaded once in an array of 16/32-bit
+    slots (FAT12 is unpacked to 16-bit), read and changed there, and written
+    back to every FAT copy by flush, one write per run of changed 'block' bytes
+    blocks. Until then the FAT on disk is stale: the volume must be flushed or
+    closed. 'mirror_now' has no effect, since the first FAT is not written
+    through either: all copies are written together by flush. Chain walks and
+    run counting work on the array."""
+    block = 4096 # dirty tracking granularity, in FAT bytes
+
+    def __init__ (self, stream, offset, clusters, bitsize=32, exfat=0, fsinfo=None, mirrors=None):
+        self.stream, self.offset, self.size, self.bits = stream, offset, clusters, bitsize
+        self._load()
+        self.dirty = set() # changed blocks
+        FAT.__init__(self, stream, offset, clusters, bitsize, exfat, fsinfo, mirrors)
+
+    def __str__ (self):
+        return "%d-bit %sFAT table of %d clusters in memory, from @%Xh\n" % (self.bits, ('','ex')[self.exfat], self.size, self.offset)
+
+    def _load(self):
+        "Loads slots from #0 to the last cluster in self.table"
+        self.stream.seek(self.offset)
+        raw = self.stream.read(((self.size+2)*self.bits+7)//8)
+        if self.bits == 12:
+            self.table = array.array('H', _unpack12(raw))
+            return
+        self.table = array.array({16:'H', 32:'I'}[self.bits])
+        assert self.table.itemsize == self.bits//8
+        self.table.frombytes(raw[:len(raw)//self.table.itemsize*self.table.itemsize])
+        if sys.byteorder == 'big': self.table.byteswap()
+        if DEBUG&4: log("MemoryFAT: loaded %d slots from @%Xh", len(self.table), self.offset)
+
+    def _touch(self, start, end):
+        "Marks slots [start, end) as changed"
+        self.dirty.update(range((start*self.bits)//8//self.block, ((end*self.bits+7)//8-1)//self.block+1))
+
+    def __getitem__ (self, index):
+        "Retrieves the value stored in a given cluster index"
+        if 2 <= index <= self.real_last:
+            return self.table[index]
+        if DEBUG&4: log("Attempt to read unexistant FAT index #%d", index)
+        return self.last
+
+    def __setitem__ (self, index, value):
+        "Set the value stored in a given cluster index"
+        if not 2 <= index <= self.real_last:
+            if DEBUG&4: log("Attempt to set invalid cluster index 0x%X with value 0x%X", index, value)
+            return
+        if not (value <= self.real_last or value >= self.reserved):
+            if DEBUG&4: log("Attempt to set invalid value 0x%X in cluster 0x%X", value, index)
+            return
+        if DEBUG&4: log("setting FAT[0x%X]=0x%X in memory", index, value)
+        self.table[index] = value
+        self._touch(index, index+1)
+
+    def count(self, startcluster):
+        "Counts the clusters in a chain. Returns a tuple (<total clusters>, <last cluster>)"
+        table, last, real_last = self.table, self.last, self.real_last
+        n = 1
+        while 1:
+            next = table[startcluster] if 2 <= startcluster <= real_last else last
+            if last <= next <= last+7: break
+            startcluster = next
+            n += 1
+        return (n, startcluster)
+
+    def count_run(self, start, count=0):
+        """Returns the count of the clusters in a contiguous run from 'start'
+        and the next cluster (or END CLUSTER mark), eventually limiting to the first 'count' clusters"""
+        table, last, real_last = self.table, self.last, self.real_last
+        n = 1
+        while not last <= start <= last+7:
+            next = table[start] if 2 <= start <= real_last else last
+            if next != start+1:
+                return n, next
+            start = next
+            if count > 0:
+                if count == 1: break
+                count -= 1
+            n += 1
+        return n, start
+
+    def mark_run(self, start, count, clear=False):
+        "Marks a range of consecutive FAT clusters"
+        if not count: return
+        if DEBUG&4: log("mark_run(%Xh, %d, clear=%d)", start, count, clear)
+        if start<2 or start>self.real_last:
+            if DEBUG&4: log("attempt to mark invalid run, aborted!")
+            return
+        if clear:
+            self.table[start:start+count] = array.array(self.table.typecode, bytes(count*self.table.itemsize))
+            if not self.exfat: self.free_clusters_map.free(start, count)
+        else:
+            self.table[start:start+count] = array.array(self.table.typecode, range(start+1, start+count+1))
+            self.table[start+count-1] = self.last
+        self._touch(start, start+count)
+
+    def mark_chains(self, start, lengths):
+        """Marks a sequence of adjacent chains from 'start', each one of the given
+        length and terminated by END CLUSTER mark"""
+        if not lengths: return
+        if DEBUG&4: log("mark_chains(%Xh, %d chains of %d clusters)", start, len(lengths), sum(lengths))
+        if start<2 or start+sum(lengths)-1>self.real_last:
+            if DEBUG&4: log("attempt to mark invalid chains, aborted!")
+            return
+        i = start
+        for count in lengths:
+            self.mark_run(i, count)
+            i += count
+
+    def _page_runs(self, first, count):
+        "Returns the free runs (start_cluster, run_length) among 'count' slots from cluster 'first'"
+        size = self.table.itemsize
+        slots = memoryview(self.table).cast('B')[first*size:(first+count)*size]
+        return [(first+start, n) for start, n in _zero_runs(slots, size)]
+
+    def flush(self):
+        "Writes the changed blocks back to every FAT copy (exFAT has one), in sorted runs"
+        self._flush_fsinfo()
+        if not self.dirty: return
+        if self.bits == 12:
+            raw = _pack12(self.table)
+        else:
+            table = self.table
+            if sys.byteorder == 'big':
+                table = array.array(table.typecode, table)
+                table.byteswap()
+            raw = memoryview(table).cast('B')
+        blocks = sorted(self.dirty)
+        runs = [[blocks[0], blocks[0]]]
+        for blk in blocks[1:]:
+            if blk == runs[-1][1]+1:
+                runs[-1][1] = blk
+            else:
+                runs.append([blk, blk])
+        for first, last in runs:
+            start, end = first*self.block, min((last+1)*self.block, len(raw))
+            if DEBUG&4: log("MemoryFAT: writing back %d bytes @%Xh", end-start, start)
+            for offset in [self.offset] + self.mirrors:
+                self.stream.seek(offset+start)
+                self.stream.write(raw[start:end])
+        self.dirty = set()
+
+
+class Chain(utils.PositionalIO):
     "Opens a cluster chain or run like a plain file"
     def __init__ (self, boot, fat, cluster, size=0, nofat=0, end=0):
         self.isdirectory=False
@@ -666,6 +909,9 @@ class Chain(object):
         self.vco = 0
         self.lastvlcn = (0, cluster) # last cluster VCN & LCN
         self.runs = OrderedDict() # RLE map of fragments
+        self._lcns = [] # first LCN of each run, in chain order
+        self._vcns = [] # first VCN of each run (cumulative run lengths)
+        self._run = 0 # index of the run last mapped
         if self.start:
             self._get_frags()
         if DEBUG&4: log("Cluster chain of %d%sbytes (%d bytes) @LCN %Xh:LBA %Xh", self.filesize, (' ', ' contiguous ')[nofat], self.size, cluster, self.boot.cl2offset(cluster))
@@ -684,14 +930,43 @@ class Chain(object):
                 self.runs[start] = length
                 if next >= self.fat.last or next==start+length-1: break
                 start = next
+        self._index()
         if DEBUG&4: log("Runs map for %s: %s", self, self.runs)
 
+    def _index(self, first=0):
+        "Rebuilds the VCN index of the runs from the 'first' one (those before are unchanged)"
+        del self._lcns[first:], self._vcns[first:]
+        vcn = 0
+        if first:
+            vcn = self._vcns[-1] + self.runs[self._lcns[-1]]
+        tail = list(itertools.islice(reversed(self.runs.items()), max(0, len(self.runs)-first)))
+        for start, count in reversed(tail):
+            self._lcns.append(start)
+            self._vcns.append(vcn)
+            vcn += count
+        self._run = min(self._run, max(0, len(self._lcns)-1))
+
+    def _map(self, vcn):
+        """Returns the index of the run containing 'vcn' or -1: the run last mapped
+        and the next one are tried first, to walk sequential I/O in O(1)"""
+        vcns = self._vcns
+        for i in (self._run, self._run+1):
+            if i < len(vcns) and vcns[i] <= vcn < vcns[i] + self.runs[self._lcns[i]]:
+                self._run = i
+                return i
+        i = bisect.bisect_right(vcns, vcn) - 1
+        if i < 0 or vcn >= vcns[i] + self.runs[self._lcns[i]]:
+            return -1
+        self._run = i
+        return i
+
     def _alloc(self, count):
         "Allocates some clusters and updates the runs map. Returns last allocated LCN"
         if self.fat.exfat:
             self.end = self.boot.bitmap.alloc(self.runs, count)
         else:
             self.end = self.fat.alloc(self.runs, count)
+        self._index(max(0, len(self._lcns)-1)) # last run could have grown
         if not self.start:
             self.start = list(self.runs.keys())[0]
         self.nofat = (len(self.runs)==1)
@@ -703,26 +978,20 @@ class Chain(object):
         if not self.runs:
             self._get_frags()
         n = (length+self.boot.cluster-1)//self.boot.cluster # contig clusters searched for
-        found = 0
-        items = list(self.runs.items())
-        for start, count in items:
-            # if current LCN is in run
-            if start <= self.lastvlcn[1] < start+count:
-                found=1
-                break
-        if not found:
+        i = self._map(self.lastvlcn[0])
+        if i < 0 or self._lcns[i]+self.lastvlcn[0]-self._vcns[i] != self.lastvlcn[1]:
             raise FATException("FATAL! maxrun4len did NOT find current LCN!\n%s\n%s" % (self.runs, self.lastvlcn))
-        left = start+count-self.lastvlcn[1] # clusters to end of run
+        start = self._lcns[i]
+        left = start+self.runs[start]-self.lastvlcn[1] # clusters to end of run
         run = min(n, left)
         maxchunk = run*self.boot.cluster
         if n < left:
             next = self.lastvlcn[1]+n
         else:
-            i = items.index((start, count))
-            if i == len(items)-1:
+            if i == len(self._lcns)-1:
                 next = self.fat.last
             else:
-                next = items[i+1][0] # first of next run
+                next = self._lcns[i+1] # first of next run
         # Updates VCN & next LCN
         self.lastvlcn = (self.lastvlcn[0]+n, next)
         if DEBUG&4:
@@ -754,20 +1023,15 @@ class Chain(object):
         self.vcn = self.pos // self.boot.cluster # n-th cluster chain
         self.vco = self.pos % self.boot.cluster # offset in it
 
-        vcn = 0
-        for start, count in list(self.runs.items()):
-            # if current VCN is in run
-            if vcn <= self.vcn < vcn+count:
-                lcn = start + self.vcn - vcn
-                #~ print "Chain%08X: mapped VCN %d to LCN %Xh (LBA %Xh)"%(self.start, self.vcn, lcn, self.boot.cl2offset(lcn))
-                if DEBUG&4:
-                    log("Chain%08X: mapped VCN %d to LCN %Xh (%d), LBA %Xh", self.start, self.vcn, lcn, lcn, self.boot.cl2offset(lcn))
-                    log("Chain%08X: seeking cluster offset %Xh (%d)", self.start, self.vco, self.vco)
-                self.stream.seek(self.boot.cl2offset(lcn)+self.vco)
-                self.lastvlcn = (self.vcn, lcn)
-                #~ print "Set lastvlcn", self.lastvlcn
-                return
-            vcn += count
+        i = self._map(self.vcn)
+        if i > -1:
+            lcn = self._lcns[i] + self.vcn - self._vcns[i]
+            if DEBUG&4:
+                log("Chain%08X: mapped VCN %d to LCN %Xh (%d), LBA %Xh", self.start, self.vcn, lcn, lcn, self.boot.cl2offset(lcn))
+                log("Chain%08X: seeking cluster offset %Xh (%d)", self.start, self.vco, self.vco)
+            self.stream.seek(self.boot.cl2offset(lcn)+self.vco)
+            self.lastvlcn = (self.vcn, lcn)
+            return
         if DEBUG&4: log("Chain%08X: reached chain's end seeking VCN %Xh", self.start, self.vcn)
 
     def read(self, size=-1):
@@ -780,26 +1044,84 @@ class Chain(object):
             size = self.filesize - self.pos
             if size < 0: size = 0
         if DEBUG&4: log("Chain%08X: adjusted size is %d", self.start, size)
-        buf = bytearray()
-        if not size:
-            if DEBUG&4: log("Chain%08X: returning empty buffer", self.start)
-            return buf
-        self.seek(self.pos) # coerce real stream to the right position!
-        if self.nofat: # contiguous clusters
-            buf += self.stream.read(size)
-            self.pos += size
-            if DEBUG&4: log("Chain%08X: read %d contiguous bytes @VCN %Xh [%X:%X]", self.start, len(buf), self.vcn, self.vco, self.vco+size)
-            return buf
-        while 1:
-            if not size: break
-            n = min(size, self.maxrun4len(size)-self.vco)
-            buf += self.stream.read(n)
-            size -= n
-            self.pos += n
-            if DEBUG&4: log("Chain%08X: read %d (%d) bytes @VCN %Xh [%X:%X]", self.start, n, len(buf), self.vcn, self.vco, self.vco+n)
-            self.seek(self.pos)
+        buf = bytearray(size)
+        if size:
+            self._readinto(buf)
+        return buf
+
+    def readinto(self, buf):
+        "Reads into 'buf' (bytearray or memoryview) from current position, returning the bytes read"
+        return self._readinto(buf)
+
+    def _readinto(self, buf):
+        n = self._fill(self.pos, buf)
+        self.pos += n
+        if n and not self.nofat:
+            self._prefetch_next(n)
+        return n
+
+    def _prefetch_next(self, size):
+        """If the next 'size' bytes cross into another run, hints the stream to
+        read ahead the start of that run: the disk can't guess the jump"""
+        prefetch = getattr(self.stream, 'prefetch', None)
+        if not prefetch or self.pos >= self.filesize: return
+        cluster = self.boot.cluster
+        i = self._map(self.pos//cluster)
+        if i < 0 or i+1 >= len(self._lcns): return
+        left = (self._vcns[i] + self.runs[self._lcns[i]])*cluster - self.pos # bytes left in run
+        if left >= size: return
+        start = self._lcns[i+1] # next run
+        n = min(size-left, self.runs[start]*cluster, self.filesize-self.pos-left)
+        if n > 0:
+            if DEBUG&4: log("Chain%08X: prefetching %d bytes @LCN %Xh", self.start, n, start)
+            prefetch(self.boot.cl2offset(start), n)
+
+    def extents(self, offset, size):
+        "Yields (stream offset, chain offset, length) of the runs covering 'size' bytes from chain 'offset'"
+        cluster = self.boot.cluster
+        end = min(offset+size, self.size)
+        i = self._map(offset//cluster)
+        if i < 0: return
+        for start in self._lcns[i:]:
+            if offset >= end: break
+            vco = self._vcns[i]*cluster # chain offset of run
+            n = min(end, vco + self.runs[start]*cluster) - offset
+            yield self.boot.cl2offset(start) + offset - vco, offset, n
+            offset += n
+            i += 1
+
+    def _fill(self, offset, buf):
+        "Fills 'buf' straight from the stream runs at chain 'offset', up to file size"
+        buf = memoryview(buf).cast('B')
+        size = max(0, min(len(buf), self.filesize-offset))
+        done = 0
+        for where, pos, n in self.extents(offset, size):
+            self.stream.readinto_at(where, buf[pos-offset:pos-offset+n])
+            done += n
+        if DEBUG&4: log("Chain%08X: read %d bytes @%Xh in place", self.start, done, offset)
+        return done
+
+    def readinto_at(self, offset, buf):
+        """Reads into 'buf' from chain 'offset' without seeking, so that many
+        threads can read the same chain or volume. Returns the bytes read"""
+        return self._fill(offset, buf)
+
+    def read_at(self, offset, size=-1):
+        if size < 0 or offset + size > self.filesize:
+            size = max(0, self.filesize - offset)
+        buf = bytearray(size)
+        del buf[self.readinto_at(offset, buf):]
         return buf
 
+    def write_at(self, offset, s):
+        "Writes 's' at chain 'offset' without seeking, if already allocated"
+        if offset + len(s) > self.size:
+            return utils.PositionalIO.write_at(self, offset, s) # needs allocation
+        s = memoryview(s).cast('B')
+        for where, pos, n in self.extents(offset, len(s)):
+            self.stream.write_at(where, s[pos-offset:pos-offset+n])
+        self.filesize = max(self.filesize, offset+len(s))
+
     def write(self, s):
         if not s: return
         if DEBUG&4: log("Chain%08X: write(buf[:%d]) called from offset %Xh (%d), VCN %Xh(%d)[%Xh:]", self.start, len(s), self.pos, self.pos, self.vcn, self.vcn, self.vco)
@@ -865,7 +1187,7 @@ class Chain(object):
                 else:
                     self.fat.mark_run(start, length, True)
                 if n == length and (not self.fat.exfat or len(self.runs) > 1):
-                    k = list(self.runs.keys())[-1]
+                    k = next(reversed(self.runs))
                     self.fat[k+self.runs[k]-1] = self.fat.last
                 n -= length
             else:
@@ -879,6 +1201,7 @@ class Chain(object):
                     self.fat[start+length-n-1] = self.fat.last
                 self.runs[start] = length-n
                 n=0
+        self._index(max(0, len(self.runs)-1)) # last run could have shrunk
         #~ print "Final runs:\n", self.runs
         #~ for start, length in self.runs.items():
             #~ for i in range(length):
@@ -960,6 +1283,89 @@ class FixedRoot(object):
         pass
 
 
+class DirBuffer(object):
+    """Holds a whole directory table (a Chain or FixedRoot) in memory: it is
+    loaded with one read, slots are read and changed in the buffer and flush
+    writes back the changed clusters only. Growing the table writes through the
+    Chain, which allocates and blanks the new clusters. One DirBuffer serves
+    every Dirtable of a directory (dirtable[start]['Buffer']); attributes
+    it lacks are the Chain ones."""
+    def __init__ (self, stream, block):
+        self.chain = stream
+        self.block = block # dirty tracking granularity
+        self.pos = 0
+        self.dirty = set() # changed blocks
+        stream.seek(0)
+        self.buf = bytearray(stream.read(stream.size))
+        self.buf.extend(bytes(stream.size-len(self.buf))) # past valid data length
+        if DEBUG&4: log("DirBuffer: loaded %d bytes from %s", len(self.buf), stream)
+
+    def __getattr__(self, name):
+        return getattr(self.chain, name)
+
+    def __str__ (self):
+        return "Buffered %s" % self.chain
+
+    def tell(self): return self.pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += len(self.buf)
+        self.pos = offset
+
+    def read(self, size=-1):
+        if size < 0: size = len(self.buf)
+        s = self.buf[self.pos:self.pos+size]
+        self.pos += len(s)
+        return s
+
+    def write(self, s):
+        pos, end, old = self.pos, self.pos+len(s), len(self.buf)
+        if end > old: # the table grows: the new part is written through
+            if pos < old:
+                self.write(s[:old-pos])
+                s, pos = s[old-pos:], old
+            s = bytes(pos-old) + bytes(s) # zeroes any gap
+            self.chain.seek(old)
+            self.chain.write(s)
+            self.buf += s
+            self.buf.extend(bytes(self.chain.size-len(self.buf))) # blanked cluster tip
+            del self.buf[self.chain.size:] # FixedRoot can't grow
+            if DEBUG&4: log("DirBuffer: %s grown to %d bytes", self.chain, len(self.buf))
+        elif s:
+            self.buf[pos:end] = s
+            self.dirty.update(range(pos//self.block, (end-1)//self.block+1))
+        self.pos = end
+
+    def trunc(self):
+        "Truncates the table at current position (see Chain.trunc)"
+        self.chain.seek(self.pos)
+        r = self.chain.trunc()
+        self.sync()
+        return r
+
+    def sync(self):
+        "Drops what is buffered past the Chain end, after truncating it"
+        del self.buf[self.chain.size:]
+        self.dirty = set(i for i in self.dirty if i*self.block < len(self.buf))
+
+    def flush(self):
+        "Writes the changed blocks back, one write per run of them"
+        blocks = sorted(self.dirty)
+        self.dirty = set()
+        i = 0
+        while i < len(blocks):
+            j = i
+            while j+1 < len(blocks) and blocks[j+1] == blocks[j]+1: j += 1
+            start, end = blocks[i]*self.block, min((blocks[j]+1)*self.block, len(self.buf))
+            if DEBUG&4: log("DirBuffer: writing back %d bytes @%Xh of %s", end-start, start, self.chain)
+            self.chain.seek(start)
+            self.chain.write(self.buf[start:end])
+            i = j+1
+
+
 class Handle(object):
     "Manages an open table slot"
     def __init__ (self):
@@ -994,6 +1400,18 @@ class Handle(object):
         self.update_time()
         return self.File.read(size)
 
+    def read_at(self, offset, size=-1):
+        "Reads from 'offset' without moving the file position (thread safe against other positional readers)"
+        return self.File.read_at(offset, size)
+
+    def readinto(self, buf):
+        "Reads into 'buf' (bytearray or memoryview), returning the bytes read"
+        self.update_time()
+        return self.File.readinto(buf)
+
+    def readinto_at(self, offset, buf):
+        return self.File.readinto_at(offset, buf)
+
     def write(self, s):
         self.File.write(s)
         self.update_time(1)
@@ -1002,6 +1420,15 @@ class Handle(object):
         self.Entry.dwFileSize = self.File.filesize
         self.Dir._update_dirtable(self.Entry)
 
+    def write_at(self, offset, s):
+        "Writes at 'offset' without moving the file position"
+        self.File.write_at(offset, s)
+        self.update_time(1)
+        self.IsReadOnly = False
+
+        self.Entry.dwFileSize = self.File.filesize
+        self.Dir._update_dirtable(self.Entry)
+
     # NOTE: FAT permits chains with more allocated clusters than those required by file size!
     # Distinguish a ftruncate w/deallocation and update Chain.__init__ and Handle flushing accordingly!
     def ftruncate(self, length, free=0):
@@ -1055,6 +1482,7 @@ DirentryType = type(Direntry())
 HandleType = type(Handle())
 
 
+@utils.layout_class(base=-32) # offsets from the end: the short name slot follows LFN ones
 class FATDirentry(Direntry):
     "Represents a FAT direntry of one or more slots"
 
@@ -1089,12 +1517,6 @@ class FATDirentry(Direntry):
         self._i = 0
         self._buf = s
         self._pos = pos
-        self._kv = {}
-        for k in self.layout:
-            self._kv[k-32] = self.layout[k]
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
 
     __getattr__ = utils.common_getattr
 
@@ -1377,12 +1799,12 @@ class Dirtable(object):
         if path == '.':
             self.dirtable = {} # This *MUST* be propagated from root to descendants! 
             self.boot.dirtable = self.dirtable
-            atexit.register(self.flush)
         else:
             self.dirtable = self.boot.dirtable
         if startcluster not in self.dirtable:
-            self.dirtable[startcluster] = {'LFNs':{}, 'Names':{}, 'Handle':None, 'slots_map':{}, 'Open':[]} # LFNs key MUST be Unicode!
+            self.dirtable[startcluster] = {'LFNs':{}, 'Names':{}, 'Handle':None, 'slots_map':{}, 'Open':[], 'Dirs':{}, 'Aliases':{}} # LFNs key MUST be Unicode!
         #~ if DEBUG&4: log("Global directory table is '%s':", self.dirtable)
+        self._buffer()
         self.map_slots()
         self.filetable = self.dirtable[startcluster]['Open']
         self.closed = False
@@ -1390,7 +1812,23 @@ class Dirtable(object):
     def __str__ (self):
         s = "Directory table @LCN %X (LBA %Xh)" % (self.start, self.boot.cl2offset(self.start))
         return s
+
+    def _buffer(self):
+        "Makes self.stream the DirBuffer shared by all the tables of this directory"
+        d = self.dirtable[self.start]
+        if 'Buffer' not in d:
+            if d['Handle']: # the Chain of the unique directory Handle
+                self.stream = d['Handle'].File
+            d['Buffer'] = DirBuffer(self.stream, self.boot.cluster)
+        self.stream = d['Buffer']
         
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if not self.closed:
+            self.close()
+
     def _checkopen(self):
         if self.closed:
             raise FATException('Requested operation on a closed Dirtable!')
@@ -1431,44 +1869,74 @@ class Dirtable(object):
 
     def opendir(self, name):
         """Opens an existing relative directory path beginning in this table and
-        return a new Dirtable object or None if not found"""
+        return a Dirtable object or None if not found. Tables opened are cached
+        in the parent's dirtable[start]['Dirs'] by name, so a path is resolved once"""
         self._checkopen()
         name = name.replace('/','\\')
         path = name.split('\\')
         found = self
-        parent = self # records parent dir handle
         for com in path:
+            dirs = self.dirtable[found.start]['Dirs']
+            cached = dirs.get(com.lower())
+            if cached and not cached.closed:
+                found = cached
+                continue
             e = found.find(com)
             if e and e.IsDir():
                 parent = found
                 found = Dirtable(self.boot, self.fat, e.Start(), path=os.path.join(found.path, com))
+                found._sethandle(e, parent)
+                if com not in ('.', '..'):
+                    dirs[com.lower()] = found
                 continue
             found = None
             break
-        if found:
-            if DEBUG&4: log("Opened directory table '%s' @LCN %Xh (LBA %Xh)", found.path, found.start, self.boot.cl2offset(found.start))
-            if self.dirtable[found.start]['Handle']:
-                # Opened many, closed once!
-                found.handle = self.dirtable[found.start]['Handle']
-                if DEBUG&4: log("retrieved previous directory Handle %s", found.handle)
-                # We must update the Chain stream associated with the unique Handle,
-                # or size variations will be discarded!
-                found.stream = found.handle.File
-            else:
-                res = Handle()
-                res.IsValid = True
-                res.IsReadOnly = (self.boot.stream.mode != 'r+b')
-                res.IsDirectory = 1
-                res.File = found.stream
-                res.File.isdirectory = 1
-                res.Entry = e
-                res.Dir = parent
-                found.handle = res
-                self.dirtable[found.start]['Handle'] = res
         #~ if not found:
             #~ raise FATException('Could not open "%s", directory not found!'%name)
         return found
 
+    def _sethandle(self, e, parent):
+        "Gives this table the unique Handle to its directory, making it if needed"
+        if DEBUG&4: log("Opened directory table '%s' @LCN %Xh (LBA %Xh)", self.path, self.start, self.boot.cl2offset(self.start))
+        if self.dirtable[self.start]['Handle']:
+            # Opened many, closed once!
+            self.handle = self.dirtable[self.start]['Handle']
+            if DEBUG&4: log("retrieved previous directory Handle %s", self.handle)
+        else:
+            res = Handle()
+            res.IsValid = True
+            res.IsReadOnly = (self.boot.stream.mode != 'r+b')
+            res.IsDirectory = 1
+            res.File = self.stream.chain # shared with the DirBuffer, or size variations will be discarded!
+            res.File.isdirectory = 1
+            res.Entry = e
+            res.Dir = parent
+            self.handle = res
+            self.dirtable[self.start]['Handle'] = res
+
+    def _uncache(self, start):
+        "Forgets the opened tables of the subdirectory at cluster 'start' (erased or renamed)"
+        dirs = self.dirtable[self.start]['Dirs']
+        for k in [k for k, d in dirs.items() if d.start == start]:
+            del dirs[k]
+
+    def _genshort(self, name):
+        """Returns the first unused short alias for a long name. Aliases ~1...~4
+        share a basis (the ~1 alias) with any long name beginning alike, NT ones
+        a CRC basis: the next tail to probe for each basis is recorded in
+        dirtable[start]['Aliases'], so a basis is never scanned twice"""
+        aliases = self.dirtable[self.start]['Aliases']
+        for first, last in ((1, 4), (5, 0)):
+            basis = (first, FATDirentry.GenRawShortFromLongNameNT(name, first))
+            i = aliases.get(basis, first)
+            while not last or i <= last:
+                short = FATDirentry.GetShortName(basis[1] if i == first else FATDirentry.GenRawShortFromLongNameNT(name, i))
+                i += 1
+                if not self.find(short):
+                    aliases[basis] = i
+                    return short
+            aliases[basis] = i # exhausted
+
     def _alloc(self, name, clusters=0):
         "Allocates a new Direntry slot (both file/directory)"
         if len(os.path.join(self.path, name))+2 > 260:
@@ -1476,12 +1944,7 @@ class Dirtable(object):
         dentry = FATDirentry(bytearray(32))
         # If name is a LFN, generate a short one valid in this table
         if not FATDirentry.IsShortName(name):
-            i = 1
-            short = FATDirentry.GetShortName(FATDirentry.GenRawShortFromLongNameNT(name, i))
-            while self.find(short):
-                i += 1
-                short = FATDirentry.GetShortName(FATDirentry.GenRawShortFromLongNameNT(name, i))
-            dentry.GenRawSlotFromName(short, name)
+            dentry.GenRawSlotFromName(self._genshort(name), name)
         else:
             dentry.GenRawSlotFromName(name)
 
@@ -1553,7 +2016,7 @@ class Dirtable(object):
         self._update_dirtable(handle.Entry)
         handle.close()
         # Records the unique Handle to the directory
-        self.dirtable[handle.File.start] = {'LFNs':{}, 'Names':{}, 'Handle':handle, 'slots_map':{64:(2<<20)//32-2}, 'Open':[]}
+        self.dirtable[handle.File.start] = {'LFNs':{}, 'Names':{}, 'Handle':handle, 'slots_map':{64:(2<<20)//32-2}, 'Open':[], 'Dirs':{}, 'Aliases':{}}
         #~ return Dirtable(handle, None, path=os.path.join(self.path, name))
         return self.opendir(name)
 
@@ -1596,13 +2059,13 @@ class Dirtable(object):
         "Closes all open handles and commits changes to disk"
         if self.path != '.':
             if DEBUG&4: log("Flushing dirtable for '%s'", self.path)
-            dirs = {self.start: self.dirtable[self.start]}
+            dirs = {self.start: self.dirtable[self.start]} if self.start in self.dirtable else {} # {} if erased
         else:
             if DEBUG&4: log("Flushing root dirtable")
             dirs = self.dirtable
-            atexit.unregister(self.flush)
         if not dirs:
             if DEBUG&4: log("No directories to flush!")
+        buffers = []
         for i in dirs:
             if not self.dirtable[i]['Open']:
                 if DEBUG&4: log("No opened files!")
@@ -1613,6 +2076,11 @@ class Dirtable(object):
             if h:
                 h.close()
                 h.IsValid = False
+                buffers.append(h.Dir.stream) # parent table, updated by close
+            buffers.append(self.dirtable[i].get('Buffer')) # None if erased
+        for b in buffers:
+            if b: b.flush()
+        self.fat.flush() # in memory FAT
 
     def map_compact(self):
         "Compacts, eventually reordering, a slots map"
@@ -1642,7 +2110,7 @@ class Dirtable(object):
     def map_slots(self):
         "Fills the free slots map and file names table once at first access"
         if not self.dirtable[self.start]['slots_map']:
-            self.stream.seek(0)
+            table = memoryview(self.stream.buf)
             pos = 0
             s = ''
             while True:
@@ -1650,7 +2118,7 @@ class Dirtable(object):
                 run_length = -1
                 buf = bytearray()
                 while True:
-                    s = self.stream.read(32)
+                    s = table[pos:pos+32]
                     if not s or not s[0]: break
                     if s[0] == 0xE5: # if erased
                         if first_free < 0:
@@ -1679,6 +2147,7 @@ class Dirtable(object):
                     else:
                         self.dirtable[self.start]['slots_map'][pos] = ((2<<20) - pos)//32
                     break
+            table.release()
             self.map_compact()
             if DEBUG&4:
                 log("%s collected slots map: %s", self, self.dirtable[self.start]['slots_map'])
@@ -1705,13 +2174,11 @@ class Dirtable(object):
     def iterator(self):
         "Iterates through directory table slots, generating a FATDirentry for each one"
         self._checkopen()
-        told = self.stream.tell()
+        table = self.stream.buf # it could change while iterating
         buf = bytearray()
-        s = 1
         pos = 0
-        while s:
-            self.stream.seek(pos)
-            s = self.stream.read(32)
+        while True:
+            s = table[pos:pos+32]
             pos += 32
             if not s or s[0] == 0: break
             if s[0] == 0xE5: continue
@@ -1719,9 +2186,8 @@ class Dirtable(object):
                 buf += s
                 continue
             buf += s
-            yield FATDirentry(buf, self.stream.tell()-len(buf))
+            yield FATDirentry(buf, pos-len(buf))
             buf = bytearray()
-        self.stream.seek(told)
 
     def _update_dirtable(self, it, erase=False):
         "Updates internal cache of object names and their associated slots"
@@ -1730,6 +2196,8 @@ class Dirtable(object):
             log("_update_dirtable: short alias is %s", it.ShortName().lower())
         if erase:
             del self.dirtable[self.start]['Names'][it.ShortName().lower()]
+            if '~' in it.ShortName():
+                self.dirtable[self.start]['Aliases'].clear() # a tail is free again
             ln = it.LongName()
             if ln:
                 del self.dirtable[self.start]['LFNs'][ln.lower()]
@@ -1770,6 +2238,13 @@ class Dirtable(object):
         if start in self.dirtable and self.dirtable[start]['Handle']:
             if DEBUG&4: log("Marking open Handle for %Xh as invalid", start)
             self.dirtable[start]['Handle'].IsValid = False # 20190413: prevents post-mortem updating
+        if e.IsDir():
+            self._uncache(start)
+            if start in self.dirtable:
+                if 'Buffer' in self.dirtable[start]:
+                    self.dirtable[start].pop('Buffer').dirty.clear() # its clusters are going to be freed
+                # forgets names, slots and tables: a directory made later at 'start' starts afresh
+                del self.dirtable[start]
         e.Start(0)
         e.dwFileSize = 0
         self._update_dirtable(e, True)
@@ -1799,6 +2274,8 @@ class Dirtable(object):
         if self.find(newname):
             if DEBUG&4: log("Can't rename, file exists: '%s'", newname)
             return 0
+        if e.IsDir():
+            self._uncache(e.Start())
         # Alloc new slot
         ne = self._alloc(newname)
         if not ne:
@@ -1806,6 +2283,7 @@ class Dirtable(object):
             return 0
         # Copy attributes from old to new slot
         ne.Entry._buf[-21:] = e._buf[-21:]
+        ne.Entry = FATDirentry(ne.Entry._buf, ne.Entry._pos) # decodes them
         # Write new entry
         self.stream.seek(ne.Entry._pos)
         self.stream.write(ne.Entry._buf)
@@ -1813,6 +2291,8 @@ class Dirtable(object):
         if DEBUG&4: log("'%s' renamed to '%s'", name, newname)
         self._update_dirtable(ne.Entry)
         self._update_dirtable(e, True)
+        if e.IsDir() and e.Start() in self.dirtable and self.dirtable[e.Start()]['Handle']:
+            self.dirtable[e.Start()]['Handle'].Entry = ne.Entry # or closing it would rewrite the old slot
         # Mark the old one as erased
         for i in range(0, len(e._buf), 32):
             e._buf[i] = 0xE5
@@ -1890,7 +2370,7 @@ class Dirtable(object):
         # Rebuilds Dirtable caches
         #~ self.slots_map = {}
         # Rebuilds Dirtable caches
-        self.dirtable[self.start] = {'LFNs':{}, 'Names':{}, 'Handle':None, 'slots_map':{}, 'Open':[]}
+        self.dirtable[self.start] = {'LFNs':{}, 'Names':{}, 'Handle':None, 'slots_map':{}, 'Open':[], 'Dirs':self.dirtable[self.start]['Dirs'], 'Aliases':{}, 'Buffer':self.stream}
         self.map_slots()
         return last//32, unused//32
 
@@ -1988,3 +2468,78 @@ def fat_copy_clusters(boot, fat, start):
         s = src.read(boot.cluster)
         dst.write(s)
     return target
+
+
+if __name__ == '__main__':
+    # FAT.py [image]: times mounting a FAT32 volume (its free space is mapped
+    # lazily), finding a first free run of 16 clusters and scanning the
+    # whole FAT, with 'image' or a sparse 32 GB image with a 60% used and
+    # fragmented FAT built here.
+    # FAT.py aliases [files]: times creating 'files' similarly named files
+    # (file-00001.txt...) in a directory, i.e. generating their short aliases,
+    # then iterating it and decoding name, attributes, start and size of each.
+    import array, random, tempfile
+    from FATtools import partutils, mkfat, Volume
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'aliases':
+        files = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+        image = os.path.join(tempfile.gettempdir(), 'fat32aliases.img')
+        with open(image, 'wb') as f: f.truncate(512<<20)
+        with Volume.vopened(image, 'r+b') as d:
+            mkfat.fat32_mkfs(d, d.size, params={'wanted_cluster':4096})
+        root = Volume.vopen(image, 'r+b')
+        table = root.mkdir('aliases')
+        t0 = time.perf_counter()
+        for i in range(files):
+            table.create('file-%05d.txt' % i).close()
+        t1 = time.perf_counter()
+        shorts = set(e.ShortName() for e in table.iterator())
+        t2 = time.perf_counter()
+        for i in range(10):
+            for e in table.iterator():
+                e.Name(), e.IsDir(), e.Start(), e.dwFileSize
+        t3 = time.perf_counter()
+        Volume.vclose(root)
+        os.remove(image)
+        print("%d files created in %.3fs, %d distinct short names" % (files, t1-t0, len(shorts)-2))
+        print("directory iterated in %.3fs" % ((t3-t2)/10))
+        sys.exit(0)
+
+    if len(sys.argv) > 1:
+        image = sys.argv[1]
+    else:
+        image = os.path.join(tempfile.gettempdir(), 'fat32bench.img')
+        if not os.path.exists(image):
+            print("Building a 32 GB FAT32 image in", image)
+            with open(image, 'wb') as f: f.truncate(32<<30)
+            with disk.disk(image, 'r+b') as d:
+                partutils.partition(d, 'mbr', mbr_type=0xC)
+            with Volume.vopened(image, 'r+b', 'partition0') as part:
+                mkfat.fat32_mkfs(part, part.size, params={'wanted_cluster':4096})
+            with Volume.vopened(image, 'r+b', 'partition0') as part:
+                boot = boot_fat32(part.read(512), stream=part)
+                clusters = boot.clusters()
+                # chains of 1-256 clusters alternating (60/40) with free runs of 1-64
+                slots = array.array('I', [0x0FFFFFFF]*2)
+                rnd = random.Random(1)
+                while len(slots) < clusters+2:
+                    if rnd.random() < 0.6:
+                        first, n = len(slots), rnd.randint(1, 256)
+                        slots.extend(range(first+1, first+n))
+                        slots.append(0x0FFFFFFF)
+                    else:
+                        slots.extend(bytes(rnd.randint(1, 64)))
+                del slots[clusters+2:]
+                part.seek(boot.fatoffs)
+                part.write(slots.tobytes())
+
+    with Volume.vopened(image, 'rb', 'partition0') as part:
+        t0 = time.perf_counter()
+        root = Volume.openvolume(part)
+        t1 = time.perf_counter()
+        root.fat.findfree(16)
+        t2 = time.perf_counter()
+        free, runs = root.fat.map_free_space()
+        t3 = time.perf_counter()
+        print("%d-bit FAT of %d clusters: %d free in %d runs" % (root.fat.bits, root.fat.size, free, runs))
+        print("Mount: %.3fs, first run found: %.3fs, free space scan: %.3fs" % (t1-t0, t2-t1, t3-t2))
@@ -5,10 +5,11 @@
 #
 #
 
-import os, time, sys, re, glob, fnmatch
+import os, time, sys, re, glob, fnmatch, contextlib
 DEBUG=int(os.getenv('FATTOOLS_DEBUG', '0'))
+MEMFAT=int(os.getenv('FATTOOLS_MEMFAT', '0'))
 from io import BytesIO
-from FATtools import disk, utils, FAT, exFAT, partutils
+from FATtools import disk, utils, FAT, exFAT, partutils, iotrace
 from FATtools import vhdutils, vhdxutils, vdiutils, vmdkutils
 from FATtools.debug import log
 
@@ -21,7 +22,7 @@ def vopen(path, mode='rb', what='auto'):
     system. 'path' can be: 1) a file or device path; 2) a FATtools disk or virtual
     disk object; 3) a BytesIO object if mode is 'ramdisk'."""
     if DEBUG&2: log("vopen in '%s' mode", what)
-    if type(path) in (disk.disk, vhdutils.Image, vhdxutils.Image, vdiutils.Image, vmdkutils.Image, BytesIO):
+    if type(path) in (disk.disk, disk.mmap_disk, vhdutils.Image, vhdxutils.Image, vdiutils.Image, vmdkutils.Image, BytesIO):
         if isinstance(path, BytesIO):
             # Opens a Ram Disk with a BytesIO object
             d = disk.disk(path, 'ramdisk')
@@ -42,6 +43,8 @@ def vopen(path, mode='rb', what='auto'):
             d = vdiutils.Image(path, mode)
         elif path.lower().endswith('.vmdk'): # VMDK image
             d = vmdkutils.Image(path, mode)
+        elif os.path.isfile(path) and os.path.getsize(path):
+            d = disk.mmap_disk(path, mode) # plain disk image
         else:
             d = disk.disk(path, mode) # disk or disk image
         if DEBUG&2: log("Opened disk: %s", d)
@@ -132,8 +135,6 @@ def vopen(path, mode='rb', what='auto'):
                     break
                 wanted+=1
         part.mbr = mbr
-    def open(x): return openvolume(x)
-    disk.partition.open = open # adds an open member to partition object
     if what in ('volume', 'auto'):
         v = part.open()
         part.volume = v # remember volume opened
@@ -147,14 +148,14 @@ def vopen(path, mode='rb', what='auto'):
 # BUG: it assumes one partition per disk, real life might vary!
 def vclose(obj):
     "Closes intelligently an object returned by vopen (=closes all child partitions/volumes, too)"
-    if type(obj) in (disk.disk, vhdutils.Image, vhdxutils.Image, vdiutils.Image, vmdkutils.Image):
-        if hasattr(obj, 'volume') and obj.volume:
+    if type(obj) in (disk.disk, disk.mmap_disk, vhdutils.Image, vhdxutils.Image, vdiutils.Image, vmdkutils.Image):
+        if hasattr(obj, 'volume') and obj.volume and not obj.volume.closed:
             if DEBUG&2: log("Closing child volume %s", obj.volume)
             obj.volume.close()
         if DEBUG&2: log("Closing %s", obj)
         obj.close()
     elif type(obj) == disk.partition:
-        if hasattr(obj, 'volume') and obj.volume:
+        if hasattr(obj, 'volume') and obj.volume and not obj.volume.closed:
             if DEBUG&2: log("Closing child volume %s", obj.volume)
             obj.volume.close()
         if DEBUG&2: log("Closing %s", obj)
@@ -163,18 +164,64 @@ def vclose(obj):
         obj.disk.close()
     elif type(obj) in (FAT.Dirtable, exFAT.Dirtable):
         if DEBUG&2: log("Closing volume %s", obj)
-        obj.close()
+        if not obj.closed:
+            obj.close()
         if obj.parent:
-            if DEBUG&2: log("Closing %s", obj.parent)
-            obj.parent.close()
+            vclose(obj.parent)
     else:
         raise BaseException('vclose cannot close such an object: %s' % obj)
 
 
-
-def openvolume(part):
+@contextlib.contextmanager
+def vopened(path, mode='rb', what='auto'):
+    "Like vopen, but as a context manager closing the returned object (and its parents) with vclose"
+    obj = vopen(path, mode, what)
+    try:
+        yield obj
+    finally:
+        if type(obj) != str:
+            vclose(obj)
+
+
+@contextlib.contextmanager
+def vopened_in_ram(path, what='partition0'):
+    """Opens the file system in a disk ('disk') or partition ('partitionN') like
+    vopened, but works on a ramdisk copy of it loaded with one sequential read.
+    On a clean exit only the changed sectors are written back, sorted and in
+    large runs; if an exception is raised the disk is left untouched. Yields the
+    root Dirtable. Meant for small volumes, like a Raspberry Pi boot partition."""
+    part = vopen(path, 'r+b', what)
+    if type(part) == str:
+        raise BaseException('Could not open %s in %s: %s' % (what, path, part))
+    try:
+        part.seek(0)
+        ram = disk.ramdisk_image.load(part, part.size)
+        d = disk.disk(ram, 'ramdisk')
+        d.mbr = getattr(part, 'mbr', None)
+        root = openvolume(d)
+        if root == 'EINV':
+            raise BaseException('No known file system found in %s of %s' % (what, path))
+        d.volume = root
+        root.parent = d
+        yield root
+        vclose(root) # flushes everything into the ramdisk
+        n = ram.write_back(part)
+        if DEBUG&2: log("vopened_in_ram: %d bytes written back to %s", n, part)
+    finally:
+        vclose(part)
+
+
+
+def openvolume(part, memfat=None, fullscan=False):
     """Opens a filesystem given a Python disk or partition object, guesses
-    the file system and returns the root directory Dirtable"""
+    the file system and returns the root directory Dirtable. If 'memfat'
+    (default: FATTOOLS_MEMFAT environment variable) the FAT is loaded in
+    memory and written back at flush/close time (see FAT.MemoryFAT).
+    The FAT free space is mapped lazily, trusting the FAT32 FSInfo count:
+    'fullscan' maps it at once, as fsck would, and fixes FSInfo at flush.
+    FAT copies are updated from the first one at flush time, too: set
+    root.fat.mirror_now to write them together at every change instead (it
+    has no effect with 'memfat', which writes all copies together at flush)."""
     part.seek(0)
     bs = part.read(512)
     
@@ -192,7 +239,10 @@ def openvolume(part):
     else:
         return 'EINV'
 
-    fat = FAT.FAT(part, boot.fatoffs, boot.clusters(), bitsize={'FAT12':12,'FAT16':16,'FAT32':32,'EXFAT':32}[fstyp], exfat=(fstyp=='EXFAT'))
+    if memfat is None: memfat = MEMFAT
+    fat = (FAT.FAT, FAT.MemoryFAT)[bool(memfat)](part, boot.fatoffs, boot.clusters(), bitsize={'FAT12':12,'FAT16':16,'FAT32':32,'EXFAT':32}[fstyp], exfat=(fstyp=='EXFAT'), fsinfo=boot.fsinfo if fstyp=='FAT32' else None,
+        mirrors=None if fstyp=='EXFAT' else [boot.fat(i) for i in range(1, boot.uchFATCopies)])
+    if fullscan: fat.map_free_space()
 
     if DEBUG&2:
         log("Inited BOOT object: %s", boot)
@@ -213,7 +263,10 @@ def openvolume(part):
                 break
 
     root.parent = part # remember parent device/partition
-    
+
+    if iotrace.tracer: # FATTOOLS_IOTRACE set
+        iotrace.tracer.attach(root)
+
     return root
 
 
@@ -325,21 +378,14 @@ def copy_tree_in(base, dest, callback=None, attributes=None, chunk_size=1<<20):
     virtual 'dest' directory table, 'chunk_size' bytes at a time, calling callback function if provided
     and preserving date and times if desired."""
 
+    # os.walk is top-down: each directory is made (or opened) once, in its parent
+    base = os.path.normpath(base)
+    tables = {base: dest}
     for root, folders, files in os.walk(base):
-        relative_dir = root[len(base)+1:]
-        # Split subdirs in target path
-        subdirs = []
-        while 1:
-            pro, epi = os.path.split(relative_dir)
-            if pro == relative_dir: break
-            relative_dir = pro
-            subdirs += [epi]
-        subdirs.reverse()
-
-        # Recursively open path to dest, creating directories if necessary
-        target_dir = dest
-        for subdir in subdirs:
-            target_dir = target_dir.mkdir(subdir)
+        if root in tables:
+            target_dir = tables[root]
+        else:
+            target_dir = tables[root] = tables[os.path.dirname(root)].mkdir(os.path.basename(root))
 
         # Finally, copy files
         for file in files:
@@ -360,10 +406,19 @@ def copy_tree_in(base, dest, callback=None, attributes=None, chunk_size=1<<20):
 
 
 
+def _copy_stream_out(fpi, fpo, buf):
+    "Copies virtual file 'fpi' to real file 'fpo' through the preallocated memoryview 'buf'"
+    while True:
+        n = fpi.readinto(buf)
+        if not n: break
+        fpo.write(buf[:n])
+
 def copy_out(base, src_list, dest, callback=None, attributes=None, chunk_size=1<<20):
     """Copies files and directories in virtual 'src_list' to real 'dest' directory
     'chunk_size' bytes at a time, calling callback function if provided
-    and preserving date and times if desired."""
+    and preserving date and times if desired. All files are read into
+    the same 'chunk_size' buffer."""
+    buf = None
     for it in src_list:
         # wildcard? expand src_list with matching items in 'base'
         if '*' in it or '?' in it:
@@ -389,7 +444,7 @@ def copy_out(base, src_list, dest, callback=None, attributes=None, chunk_size=1<
             except FileExistsError:
                 pass
             if DEBUG&2: log("copy_out: target is '%s'", os.path.join(dest,it))
-            copy_tree_out(fpi, os.path.join(dest,it), callback, attributes, chunk_size)
+            copy_tree_out(fpi, os.path.join(dest,it), callback, attributes, chunk_size, buf)
             continue
         it = os.path.basename(it) # we want only file/dir name in target!
         if os.path.isdir(dest):
@@ -402,27 +457,25 @@ def copy_out(base, src_list, dest, callback=None, attributes=None, chunk_size=1<
         fpo = open(dst, 'wb')
         if DEBUG&2: log("copy_out: target is '%s'", dst)
         if callback: callback(dst)
-        while True:
-            s = fpi.read(chunk_size)
-            if not s: break
-            fpo.write(s)
+        if buf is None: buf = memoryview(bytearray(chunk_size))
+        _copy_stream_out(fpi, fpo, buf)
         fpo.close()
         fpi.close()
         _preserve_attributes_out(attributes, base, fpi, dst)
 
 
-def copy_tree_out(base, dest, callback=None, attributes=None, chunk_size=1<<20):
+def copy_tree_out(base, dest, callback=None, attributes=None, chunk_size=1<<20, buf=None):
     """Copy recursively files and directories under virtual 'base' Dirtable into
     real 'dest' directory, 'chunk_size' bytes at a time, calling callback function if provided
-    and preserving date and times if desired."""
+    and preserving date and times if desired. 'buf' is an optional memoryview to read
+    into, else one of 'chunk_size' bytes is allocated for the whole tree."""
     for root, folders, files in base.walk():
+        if files: # resolved once per directory (and cached by opendir)
+            table = base if root == base.path else base.opendir(root[len(base.path)+1:])
         for file in files:
             src = os.path.join(root, file)
             dst = os.path.join(dest, src[len(base.path)+1:])
-            if base.path == os.path.dirname(src):
-                fpi = base.open(file)
-            else:
-                fpi = base.opendir(os.path.dirname(src)[len(base.path)+1:]).open(file)
+            fpi = table.open(file)
             assert fpi.IsValid != False
             try:
                 os.makedirs(os.path.dirname(dst))
@@ -430,10 +483,8 @@ def copy_tree_out(base, dest, callback=None, attributes=None, chunk_size=1<<20):
                 pass
             fpo = open(dst, 'wb')
             if callback: callback(dst) # strip base path
-            while True:
-                s = fpi.read(chunk_size)
-                if not s: break
-                fpo.write(s)
+            if buf is None: buf = memoryview(bytearray(chunk_size))
+            _copy_stream_out(fpi, fpo, buf)
             fpo.close()
             fpi.close() # If closing is deferred to atexit, massive KeyError exceptions are generated by disk.py in cache_flush: investigate!
             _preserve_attributes_out(attributes, base, fpi, dst)
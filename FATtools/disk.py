@@ -1,6 +1,7 @@
 # -*- coding: cp1252 -*-
-import io, os, sys, atexit
+import io, os, sys, mmap, threading, queue
 from io import BytesIO
+from collections import OrderedDict
 from ctypes import *
 
 DEBUG=int(os.getenv('FATTOOLS_DEBUG', '0'))
@@ -15,8 +16,7 @@ from FATtools.utils import myfile
 
 
 class win32_disk(object):
-    "Handles a Win32 disk. PLEASE NOTE: due to locking mechanism, the Win32 HANDLE is here UNIQUE - closing once, closes it everywhere."
-    open_handles = {}
+    "Handles a Win32 disk. Each object owns its HANDLE, closed by close()."
 
     def __str__ (self):
         return "Win32 Disk Handle %Xh for %s, mode '%s'" % (self.handle, self.name, self.mode)
@@ -29,13 +29,9 @@ class win32_disk(object):
         if 'physicaldrive' in name and mode != 'rb':
             self.volume_handles=dismount_and_lock_all(bytes(name,'ascii'))
         # Open a new write handle
-        if name in win32_disk.open_handles:
-            handle = win32_disk.open_handles[name]
-        else:
-            handle = windll.kernel32.CreateFileA(name.encode(), DWORD(0xC0000000), DWORD(3), 0, DWORD(3), DWORD(0x80000000|0x10000000|0x20000000), 0)
+        handle = windll.kernel32.CreateFileA(name.encode(), DWORD(0xC0000000), DWORD(3), 0, DWORD(3), DWORD(0x80000000|0x10000000|0x20000000), 0)
         if handle == -1:
             raise BaseException('CreateFileA failed with code %d (%s)' % (GetLastError(), FormatError()))
-        win32_disk.open_handles[name] = handle
         # Dismount volume, gaining exclusive access with FSCTL_DISMOUNT_VOLUME (0x90020)
         # Dismount volume, locking it for exclusive access with FSCTL_LOCK_VOLUME (0x90018)
         # IOCTL_DISK_GET_LENGTH_INFO = 0x7405C
@@ -57,16 +53,16 @@ class win32_disk(object):
         self.handle = handle
         self.name = name
         self.mode = mode
+        self.closed = False
         if DEBUG&1: log("Successfully opened HANDLE to Win32 Disk %s (size %d MB) for exclusive access", name, self.size//(1<<20))
         self._pos = 0
         
     def close(self):
         unlock_volume_handles(self.volume_handles)
         self.volume_handles=[]
-        self.closed = True
-        if self.name in win32_disk.open_handles:
+        if not self.closed:
             windll.kernel32.CloseHandle(self.handle)
-            del win32_disk.open_handles[self.name]
+        self.closed = True
         
     def seek(self, offset, whence=0):
         if whence == 1:
@@ -120,33 +116,77 @@ class win32_disk(object):
 
 
 
+class AlignedBufferPool(object):
+    """Recycles page aligned buffers (anonymous memory maps) of 'size' bytes
+    for unbuffered I/O, keeping up to 'keep' free ones."""
+    def __init__(self, size=1<<20, keep=4):
+        self.size = (size+mmap.PAGESIZE-1)//mmap.PAGESIZE*mmap.PAGESIZE
+        self.keep = keep
+        self.free = []
+        self.lock = threading.Lock()
+
+    def get(self):
+        "Returns a writable memoryview of a free buffer"
+        with self.lock:
+            if self.free:
+                return memoryview(self.free.pop())
+        return memoryview(mmap.mmap(-1, self.size))
+
+    def put(self, view):
+        "Gives back a buffer got from the pool"
+        buf = view.obj
+        view.release()
+        with self.lock:
+            if len(self.free) < self.keep:
+                self.free.append(buf)
+
+
 class disk(object):
     """Let a device or file act in a manner similar to a Python file object. Please
     note that under Windows: 1) read, write and seek MUST be sector aligned (512
     bytes offsets); 2) seek FROM disk's end does not work; 3) seek PAST disk's
-    end followed by read returns no error."""
+    end followed by read returns no error.
+    Small I/O goes through a LRU cache of 'page_size' pages (up to 'cache_size'
+    bytes), whose dirty parts are written back in sorted, coalesced runs at
+    eviction or flush time; larger I/O goes straight to the disk.
+    If 'readahead', sequential reads are detected and the following pages are
+    loaded into the cache by a background thread, in a window doubling at each
+    sequential read (up to half the cache) and dropped at the first random one.
+    If 'direct', the file or device is opened bypassing the OS cache (O_DIRECT)
+    where supported, else buffered I/O is kept: see _direct_open."""
     def __str__ (self):
         return "Python disk '%s' (mode '%s') @%016Xh" % (self._file.name, self.mode, self.pos)
 
-    def __init__(self, name, mode='rb', buffering=0):
+    def __init__(self, name, mode='rb', buffering=0, page_size=64<<10, cache_size=4<<20, readahead=True, direct=False):
         "'name' is the name of a file or device to open or, if mode is 'ramdisk', a BytesIO object with raw disk data"
         self.mode = mode
         self.pos = 0 # linear pos in the virtual stream
-        self.si = 0 # disk sector index
-        self.so = 0 # sector offset
-        self.lastsi = 0 # last sector read from *disk*
-        self.buf = None # read buffer
         self.blocksize = 512 # fixed sector size
-        # Cache only small 512 sectors
-        self.rawcache = bytearray(1024<<10) # 1M cache buffer
-        self.cache = memoryview(self.rawcache)
-        self.cache_index = 0 # offset of next cache slot
-        self.cache_hits = 0 # sectors retrieved from cache
-        self.cache_misses = 0 # sectors not retrieved
+        assert page_size % self.blocksize == 0
+        self.page_size = page_size
+        self.cache_pages = max(2, cache_size // page_size) # max pages kept
+        self.direct_size = 2*page_size # I/O of this size or more bypasses the cache
+        self.cache = OrderedDict() # { page index: bytearray }, least recently used first
+        self.cache_dirties = {} # { page index: [start, end) dirty byte range in page }
+        self.cache_hits = 0 # pages retrieved from cache
+        self.cache_misses = 0 # pages loaded from disk
         self.cache_extras = 0 # direct, non-cacheable I/O
-        self.cache_dirties = {} # dirty sectors
-        self.cache_table = {} # { sector: cache offset }
-        self.cache_tableR = {} # reversed: { cache offset:sector }
+        self.cache_reads = 0 # read calls issued to disk
+        self.cache_writes = 0 # write calls issued to disk
+        self.lock = threading.RLock() # serializes cache and handle between caller and read-ahead thread
+        self.readahead = readahead and mode != 'ramdisk'
+        self.ra_max = self.cache_pages // 2 # max read-ahead window, in pages
+        self.ra_window = 0 # current read-ahead window, in pages
+        self.ra_next = -1 # where a sequential read would start
+        self.ra_upto = -1 # last page queued for read-ahead
+        self.ra_generation = 0 # bumped at each random read, to drop stale read-ahead jobs
+        self.ra_pages = set() # pages read ahead and not used yet
+        self.ra_hits = 0 # read ahead pages used
+        self.ra_misses = 0 # pages a sequential read had to load itself
+        self.ra_wasted = 0 # read ahead pages evicted unused
+        self.ra_queue = None
+        self.ra_thread = None
+        self.closed = False
         if mode == 'ramdisk':
             if not isinstance(name, BytesIO):
                 raise BaseException('Ramdisk can be built from BytesIO only, not from ', type(name))
@@ -159,14 +199,71 @@ class disk(object):
         else:
             self._file = open(name, mode, buffering)
             self.size = os.stat(name).st_size
-        atexit.register(self.cache_flush)
+        # positional I/O on the OS file, if possible: else seek & read/write under file_lock
+        self._fd = None
+        if isinstance(self._file, io.FileIO) and hasattr(os, 'preadv'):
+            self._fd = self._file.fileno()
+        self.file_lock = threading.Lock()
+        self.direct = False # unbuffered I/O in progress
+        if direct:
+            self._direct_open(name)
+
+    def _direct_open(self, name):
+        """Reopens the file or device with O_DIRECT, so that reads really come from
+        the device and large writes don't evict the OS cache. Returns False, keeping
+        buffered I/O, where the OS or file system refuses it.
+        Alignment contract: in direct mode every OS read or write starts at a
+        multiple of 'align' bytes (the memory page, a multiple of the sector size),
+        moves a multiple of it and uses a page aligned buffer from 'pool'. Callers
+        may still do any I/O: requests are widened to the enclosing aligned blocks
+        (writes reading the partial head and tail blocks first) and moved in chunks
+        of at most the pool buffer size."""
+        if not hasattr(os, 'O_DIRECT') or self._fd is None:
+            if DEBUG&1: log("%s: direct I/O not supported here, using buffered I/O", self)
+            return False
+        self.align = max(self.blocksize, mmap.PAGESIZE)
+        self.pool = AlignedBufferPool(max(self.page_size, 1<<20))
+        try:
+            fd = os.open(name, (os.O_RDWR if '+' in self.mode else os.O_RDONLY) | os.O_DIRECT)
+        except OSError as e:
+            if DEBUG&1: log("%s: can't open with O_DIRECT (%s), using buffered I/O", self, e)
+            return False
+        probe = self.pool.get()
+        try:
+            os.preadv(fd, [probe[:self.align]], 0) # some file systems accept the flag, then fail the I/O
+        except OSError as e:
+            if DEBUG&1: log("%s: O_DIRECT I/O fails (%s), using buffered I/O", self, e)
+            os.close(fd)
+            return False
+        finally:
+            self.pool.put(probe)
+        self._file.close()
+        self._file = io.FileIO(fd, self.mode)
+        self._file.name = name
+        self._fd = fd
+        # a regular file must not grow past its end by whole blocks
+        self.eof = self.size if os.path.isfile(name) else None
+        self.direct = True
+        if DEBUG&1: log("%s: direct I/O enabled, %d bytes alignment", self, self.align)
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     def close(self):
         "Flush internal disk cache and close its handle"
-        self.cache_flush()
-        atexit.unregister(self.cache_flush)
-        if not isinstance(self._file, BytesIO): # closing BytesIO == KILL DATA!
-            self._file.close()
+        if self.ra_thread:
+            self.ra_queue.put(None)
+            self.ra_thread.join()
+            self.ra_thread = None
+        with self.lock:
+            self.cache_flush()
+            if not isinstance(self._file, BytesIO): # closing BytesIO == KILL DATA!
+                self._file.close()
+            self.closed = True
 
     def seek(self, offset, whence=0):
         if whence == 1:
@@ -178,192 +275,501 @@ class disk(object):
             self.pos = offset
         if self.pos > self.size: self.pos = self.size
         if self.pos < 0: self.pos = 0
-        self.si = self.pos // self.blocksize
-        self.so = self.pos % self.blocksize
-        if DEBUG&1: log("disk pointer to set @%Xh", self.si*self.blocksize)
-        self._file.seek(self.si*self.blocksize)
-        if DEBUG&1: log("si=%Xh lastsi=%Xh so=%Xh", self.si,self.lastsi,self.so)
+        if DEBUG&1: log("disk pointer set @%Xh", self.pos)
 
     def tell(self):
         return self.pos
 
     def cache_stats(self):
-        if DEBUG&1: log("Cache items/hits/misses: %d/%d/%d", len(self.cache_table), self.cache_hits, self.cache_misses)
-        
+        "Returns (and logs) a dictionary of cache counters"
+        stats = {'pages':len(self.cache), 'dirty':len(self.cache_dirties), 'hits':self.cache_hits, 'misses':self.cache_misses,
+            'direct':self.cache_extras, 'reads':self.cache_reads, 'writes':self.cache_writes,
+            'readahead_hits':self.ra_hits, 'readahead_misses':self.ra_misses, 'readahead_wasted':self.ra_wasted}
+        if DEBUG&1: log("Cache stats: %s", stats)
+        return stats
+
     def flush(self):
         self.cache_flush()
 
-    def cache_flush(self, sector=None):
-        self.cache_stats()
-        if not self.cache_dirties:
-            # 21.04.17: must ANYWAY reset (read-only) cache, or higher cached slots could get silently overwritten!
-            if DEBUG&1: log("resetting cache (no dirty sectors)")
-            self.cache_table = {}
-            self.cache_tableR = {}
-            return
-        if sector != None: # assume it is called by cache_retrieve only, with the right sector #
-            self._file.seek(sector*self.blocksize)
-            i = self.cache_table[sector]
-            self._file.write(self.cache[i:i+self.blocksize])
-            del self.cache_dirties[sector]
-            if DEBUG&1: log("%s: dirty sector #%d committed to disk from cache[%d]", self, sector,i//512)
-            return
-        if DEBUG&1: log("%s: committing %d dirty sectors to disk", self, len(self.cache_dirties))
-        for sec in sorted(self.cache_dirties):
-            self._file.seek(sec*self.blocksize)
-            try:
-                i = self.cache_table[sec]
-                self._file.write(self.cache[i:i+self.blocksize])
-            except:
-                if DEBUG&1: log("ERROR! Sector %d in cache_dirties not in cache_table!", sec)
-                if sec in list(self.cache_tableR.values()):
-                    if DEBUG&1: log("(but sector %d is in cache_tableR)", sec)
+    def cache_flush(self):
+        "Writes back dirty pages, joining adjacent dirty ranges in a single write"
+        with self.lock:
+            if not self.cache_dirties: return
+            self.cache_stats()
+            if DEBUG&1: log("%s: committing %d dirty pages to disk", self, len(self.cache_dirties))
+            runs = [] # [disk offset, length, [page views]]
+            for page in sorted(self.cache_dirties):
+                start, end = self.cache_dirties[page]
+                offset = page*self.page_size + start
+                view = memoryview(self.cache[page])[start:end]
+                if runs and runs[-1][0] + runs[-1][1] == offset:
+                    runs[-1][1] += end-start
+                    runs[-1][2].append(view)
                 else:
-                    if DEBUG&1: log("(and sector %d is neither in cache_tableR)", sec)
+                    runs.append([offset, end-start, [view]])
+            for offset, length, views in runs:
+                if DEBUG&1: log("writing back %d bytes @%Xh", length, offset)
+                self._raw_write(offset, views[0] if len(views) == 1 else b''.join(views))
+            self.cache_dirties = {}
+
+    def _cache_insert(self, page, buf):
+        "Adds a page to the cache, evicting the least used one if full"
+        if len(self.cache) >= self.cache_pages:
+            old, _ = next(iter(self.cache.items()))
+            if old in self.cache_dirties:
+                self.cache_flush() # all dirty pages at once, in order
+            del self.cache[old]
+            if old in self.ra_pages:
+                self.ra_pages.discard(old)
+                self.ra_wasted += 1
+        self.cache[page] = buf
+
+    def _missing_spans(self, first, last):
+        "Returns the spans (first page, last page) of pages first..last not yet cached"
+        spans = []
+        last = min(last, (self.size-1)//self.page_size)
+        page = first
+        while page <= last:
+            if page in self.cache:
+                page += 1
                 continue
-        self.cache_dirties = {}
-        self.cache_table = {}
-        self.cache_tableR = {}
-
-    def cache_retrieve(self):
-        "Retrieve a sector from cache. Returns True if hit, False if missed."
-        # If we are retrieving a single block...
-        if self.asize ==self.blocksize:
-            if self.si not in self.cache_table:
-                self.cache_misses += 1
-                if DEBUG&1: log("%s: cache_retrieve missed #%d", self, self.si)
-                return False
+            end = page
+            while end < last and end+1 not in self.cache:
+                end += 1
+            spans.append((page, end))
+            page = end+1
+        return spans
+
+    def _read_span(self, first, last):
+        "Reads pages first..last from disk into a new buffer"
+        offset = first*self.page_size
+        n = min((last-first+1)*self.page_size, (self.size-offset+self.blocksize-1)//self.blocksize*self.blocksize)
+        buf = bytearray((last-first+1)*self.page_size)
+        if DEBUG&1: log("loading pages #%d-#%d (%d bytes @%Xh) into cache", first, last, n, offset)
+        self._raw_readinto(offset, memoryview(buf)[:n])
+        return buf
+
+    def _load_pages(self, first, last):
+        "Loads pages first..last not yet cached, with one read per missing span. Returns pages loaded"
+        loaded = []
+        for page, end in self._missing_spans(first, last):
+            buf = self._read_span(page, end)
+            for i in range(end-page+1):
+                self._cache_insert(page+i, buf[i*self.page_size:(i+1)*self.page_size])
+                loaded.append(page+i)
+        return loaded
+
+    def cache_page(self, page):
+        "Returns the cached buffer of a page, loading it (and evicting the least used one) if needed"
+        buf = self.cache.get(page)
+        if buf is not None:
             self.cache_hits += 1
-            i = self.cache_table[self.si]
-            self.buf = self.cache[i:i+self.asize]
-            if DEBUG&1: log("%s: cache_retrieve hit #%d", self, self.si)
-            return True
-
-        # If we are retrieving multiple blocks...
-        for i in range(self.asize//self.blocksize):
-            # If one block is not cached...
-            if self.si+i not in self.cache_table:
-                if DEBUG&1: log("%s: cache_retrieve (multisector) miss-not cached %d", self, self.si+i)
-                self.cache_misses += 1
-                continue
-            # If one block is dirty, first flush it...
-            if self.si+i in self.cache_dirties:
-                if DEBUG&1: log("%s: cache_retrieve (multisector) flush %d", self, self.si+i)
-                self.cache_flush(self.si+i)
-                if DEBUG&1: log("%s: seeking back @%Xh after flush", self, self.pos)
-                self.seek(self.pos)
-                continue
-        return False # consider a miss
+            self.cache.move_to_end(page)
+            if page in self.ra_pages:
+                self.ra_pages.discard(page)
+                self.ra_hits += 1
+            return buf
+        self.cache_misses += 1
+        if self.ra_window:
+            self.ra_misses += 1
+        buf = bytearray(self.page_size)
+        offset = page*self.page_size
+        if offset < self.size:
+            n = min(self.page_size, (self.size-offset+self.blocksize-1)//self.blocksize*self.blocksize)
+            if DEBUG&1: log("loading page #%d (%d bytes @%Xh) into cache", page, n, offset)
+            self._raw_readinto(offset, memoryview(buf)[:n])
+        self._cache_insert(page, buf)
+        return buf
+
+    def prefetch(self, offset, size):
+        "Hints that 'size' bytes from 'offset' will be read soon: loads them in background"
+        if not self.readahead or size <= 0 or offset >= self.size: return
+        first = offset//self.page_size
+        last = min((offset+size-1)//self.page_size, first+self.ra_max-1)
+        with self.lock:
+            if last <= self.ra_upto and first > self.ra_upto - self.ra_max:
+                return # already queued
+            self._queue_pages(first, last)
+
+    def _queue_pages(self, first, last):
+        if self.ra_thread is None:
+            self.ra_queue = queue.Queue()
+            self.ra_thread = threading.Thread(target=self._readahead_worker, daemon=True)
+            self.ra_thread.start()
+        if DEBUG&1: log("%s: read-ahead of pages #%d-#%d queued", self, first, last)
+        self.ra_upto = last
+        self.ra_queue.put((self.ra_generation, first, last))
+
+    def _readahead_worker(self):
+        while True:
+            job = self.ra_queue.get()
+            if job is None: return
+            generation, first, last = job
+            with self.lock:
+                if generation != self.ra_generation or self.closed: continue
+                spans = self._missing_spans(first, last)
+                writes = self.cache_writes
+            # disk reads go without the lock, so that callers don't wait for them
+            bufs = [self._read_span(page, end) for page, end in spans]
+            with self.lock:
+                if generation != self.ra_generation or self.closed or self.cache_writes != writes:
+                    if DEBUG&1: log("%s: read-ahead of pages #%d-#%d dropped", self, first, last)
+                    continue # stale (or written meanwhile): dropped
+                for (page, end), buf in zip(spans, bufs):
+                    for i in range(end-page+1):
+                        if page+i in self.cache or page+i in self.cache_dirties:
+                            continue # loaded or written meanwhile: the cached copy wins
+                        self._cache_insert(page+i, buf[i*self.page_size:(i+1)*self.page_size])
+                        self.ra_pages.add(page+i)
+
+    def _readahead(self, pos, size):
+        "Tracks sequential access, queueing read-ahead of the pages after pos+size"
+        if pos == self.ra_next:
+            self.ra_window = min(self.ra_max, max(2*self.ra_window, (size+self.page_size-1)//self.page_size))
+        elif self.ra_window:
+            self.ra_window = 0
+            self.ra_upto = -1
+            self.ra_generation += 1
+        self.ra_next = pos+size
+        if self.ra_window:
+            first = max(self.ra_upto+1, (pos+size)//self.page_size)
+            last = (pos+size-1)//self.page_size + self.ra_window
+            if first <= last and first*self.page_size < self.size:
+                self._queue_pages(first, last)
 
-    def cache_readinto(self):
-        # If we should read beyond the cache's end...
-        if self.cache_index + self.asize > len(self.cache):
-            # Free space, flushing dirty sectors & updating cache index
+    def _raw_readinto(self, offset, buf):
+        "Reads from the OS file at 'offset' into 'buf', with pread if possible"
+        if self.direct:
+            self._direct_readinto(offset, buf)
+        elif self._fd is not None:
+            os.preadv(self._fd, [buf], offset)
+        else:
+            with self.file_lock:
+                self._file.seek(offset)
+                self._file.readinto(buf)
+        self.cache_reads += 1
+
+    def _raw_write(self, offset, s):
+        "Writes 's' to the OS file at 'offset', with pwrite if possible"
+        if self.direct:
+            self._direct_write(offset, s)
+        elif self._fd is not None:
+            s = memoryview(s)
+            while len(s):
+                n = os.pwrite(self._fd, s, offset)
+                s = s[n:]
+                offset += n
+        else:
+            with self.file_lock:
+                self._file.seek(offset)
+                self._file.write(s)
+        self.cache_writes += 1
+
+    def _direct_readinto(self, offset, buf):
+        "_raw_readinto in direct mode: aligned chunks through pool buffers"
+        buf = memoryview(buf).cast('B')
+        align = self.align
+        done = 0
+        while done < len(buf):
+            pos = offset + done
+            start = pos - pos%align
+            n = min(len(buf)-done, self.pool.size-(pos-start))
+            end = (pos+n+align-1)//align*align
+            tmp = self.pool.get()
+            try:
+                got = os.preadv(self._fd, [tmp[:end-start]], start)
+                avail = max(0, min(n, got-(pos-start)))
+                buf[done:done+avail] = tmp[pos-start:pos-start+avail]
+                buf[done+avail:done+n] = bytes(n-avail) # past the end
+            finally:
+                self.pool.put(tmp)
+            done += n
+
+    def _direct_write(self, offset, s):
+        "_raw_write in direct mode: aligned chunks through pool buffers, partial blocks read first"
+        s = memoryview(s).cast('B')
+        align = self.align
+        done = 0
+        while done < len(s):
+            pos = offset + done
+            start = pos - pos%align
+            n = min(len(s)-done, self.pool.size-(pos-start))
+            end = (pos+n+align-1)//align*align
+            tmp = self.pool.get()
+            try:
+                if pos != start: # head block
+                    tmp[:align] = bytes(align)
+                    os.preadv(self._fd, [tmp[:align]], start)
+                if (pos+n) % align: # tail block
+                    tmp[end-start-align:end-start] = bytes(align)
+                    os.preadv(self._fd, [tmp[end-start-align:end-start]], end-align)
+                tmp[pos-start:pos-start+n] = s[done:done+n]
+                view, at = tmp[:end-start], start
+                while len(view):
+                    k = os.pwrite(self._fd, view, at)
+                    view, at = view[k:], at+k
+            finally:
+                self.pool.put(tmp)
+            done += n
+        if self.eof is not None:
+            self.eof = max(self.eof, offset+len(s))
+            if end > self.eof:
+                os.ftruncate(self._fd, self.eof)
+
+    def cache_drop(self):
+        "Writes back and forgets all cached pages, so that next reads come from the device"
+        with self.lock:
             self.cache_flush()
-            self.cache_index = 0
-            self.seek(self.pos)
-        pos = self.cache_index
-        if DEBUG&1: log("loading disk sector #%d into cache[%d]", self.si, pos//512)
-        self._file.readinto(self.cache[pos:pos+self.asize])
-        self.buf = self.cache[pos:pos+self.asize]
-        self.cache_index += self.asize
-        # Update dictionary of cached sectors and their position
-        # Invalidate accordingly if we are recycling pool from zero?
-        k = self.si
-        v = pos
-        # If a previously cached sector is pointing to the same buffer,
-        # unlink it
-        if v in self.cache_tableR:
-            del self.cache_table[self.cache_tableR[v]]
-        self.cache_table[k] = v
-        self.cache_tableR[v] = k
-        return pos
+            self.cache.clear()
+            self.ra_pages.clear()
+
+    def readview(self, size=-1):
+        "Like read, but returns a memoryview (zero-copy in mmap_disk)"
+        return memoryview(self.read(size))
+
+    def readview_at(self, offset, size=-1):
+        return memoryview(self.read_at(offset, size))
 
     def read(self, size=-1):
         if DEBUG&1: log("read(%d) bytes @%Xh", size, self.pos)
-        self.seek(self.pos)
-        # If size is negative
-        if size < 0:
-            size = 0
-            if self.size: size = self.size
-        # If size exceeds disk size
-        if self.size and self.pos + size > self.size:
-            size = self.size - self.pos
-        se = (self.pos+size)//self.blocksize
-        if (self.pos+size)%self.blocksize:
-            se += 1
-        self.asize = (se - self.si) * self.blocksize # full sectors to read in
-        # If sectors are already cached...
-        if self.cache_retrieve():
-            if DEBUG&1: log("%d bytes read from cache", self.asize)
-            self.lastsi = self.si
-            self.pos += size
-            return bytearray(self.buf[self.so : self.so+size])
-        # ...else, read them from disk...
-        # if larger than cache limit, read directly into a new buffer
-        if self.asize > self.blocksize:
-            self.buf = bytearray(self.asize)
-            self._file.seek(self.si*self.blocksize)
-            if DEBUG&1: log("reading %d bytes directly from disk @%Xh", self.asize, self._file.tell())
-            self._file.readinto(self.buf)
-            # Direct read (bypass) DON'T advance lastsi? Or file pointer?
-            self.si += self.asize//self.blocksize # 11.01.2016: fix mkexfat flaw
-            self.pos += size
-            self.cache_extras += 1
-            return bytearray(self.buf[self.so : self.so+size])
-        # ...else, update the cache
-        self.cache_readinto()
-        self.lastsi = self.si
-        self.pos += size
-        return bytearray(self.buf[self.so : self.so+size])
+        s = self.read_at(self.pos, size)
+        self.pos += len(s)
+        return s
+
+    def readinto(self, buf):
+        "Reads into 'buf' (bytearray or memoryview) from current position, returning the bytes read"
+        n = self.readinto_at(self.pos, buf)
+        self.pos += n
+        return n
 
     def write(self, s): # s MUST be of type bytearray/memoryview
         if DEBUG&1: log("request to write %d bytes @%Xh", len(s), self.pos)
+        self.write_at(self.pos, s)
+        self.pos += len(s)
+
+    def read_at(self, offset, size=-1):
+        "Reads 'size' bytes (or up to disk end, if negative) from 'offset', without moving the disk position"
+        if size < 0 or (self.size and offset + size > self.size):
+            size = max(0, self.size - offset)
+        buf = bytearray(size)
+        n = self.readinto_at(offset, buf)
+        if n < size:
+            del buf[n:]
+        return buf
+
+    def readinto_at(self, offset, buf):
+        """Reads into 'buf' from 'offset', without moving the disk position, and
+        returns the bytes read. Large reads don't hold the cache lock during I/O,
+        so threads can read in parallel."""
+        buf = memoryview(buf).cast('B')
+        size = len(buf)
+        if self.size and offset + size > self.size:
+            size = max(0, self.size - offset)
+        if not size: return 0
+        first, last = offset//self.page_size, (offset+size-1)//self.page_size
+        with self.lock:
+            if self.readahead:
+                self._readahead(offset, size)
+            direct = size >= self.direct_size and not all(page in self.cache for page in range(first, last+1))
+            if direct and self.ra_window and last <= self.ra_upto and last-first < self.ra_max:
+                # read-ahead is late: load the pages now, so they are not read twice
+                self.ra_misses += len(self._load_pages(first, last))
+                direct = False
+            if not direct:
+                i = 0
+                while i < size:
+                    page, po = divmod(offset+i, self.page_size)
+                    n = min(self.page_size-po, size-i)
+                    buf[i:i+n] = self.cache_page(page)[po:po+n]
+                    i += n
+                return size
+            writes = self.cache_writes
+        # full sectors directly from disk, then dirty cached data over them
+        start = offset - offset%self.blocksize
+        end = (offset+size+self.blocksize-1)//self.blocksize*self.blocksize
+        if DEBUG&1: log("reading %d bytes directly from disk @%Xh", end-start, start)
+        tmp = buf[:size] if start == offset and end == offset+size else bytearray(end-start)
+        self._raw_readinto(start, tmp)
+        with self.lock:
+            if self.cache_writes != writes:
+                # something was written (or flushed) meanwhile: read again
+                self._raw_readinto(start, tmp)
+            if tmp is not buf:
+                buf[:size] = memoryview(tmp)[offset-start:offset-start+size]
+            self.cache_extras += 1
+            for page, (ds, de) in self.cache_dirties.items():
+                po = page*self.page_size
+                lo, hi = max(po+ds, offset), min(po+de, offset+size)
+                if lo < hi:
+                    buf[lo-offset:hi-offset] = self.cache[page][lo-po:hi-po]
+        return size
+
+    def write_at(self, offset, s):
+        "Writes 's' at 'offset', without moving the disk position"
         if len(s) == 0: return
-        # If we have to complete a sector...
-        if self.so:
-            j = min(self.blocksize - self.so, len(s))
-            if DEBUG&1: log("writing middle sector %d[%d:%d]", self.si, self.so, self.so+j)
-            self.asize = 512
-            if not self.cache_retrieve():
-                self.cache_readinto()
-            # We assume buf is pointing to rawcache
-            self.buf[self.so : self.so+j] = s[:j]
-            s = s[j:] # slicing penalty if buffer?
-            if DEBUG&1: log("len(s) is now %d", len(s))
-            self.cache_dirties[self.si] = True
-            self.pos += j
-            self.seek(self.pos)
-        # if we have full sectors to write...
-        if len(s) > self.blocksize:
-            full_blocks = len(s)//512
-            if DEBUG&1: log("writing %d sector(s) directly to disk", full_blocks)
-            # Directly write full sectors to disk
-            # Invalidate eventually cached data
-            for si in range(self.si, self.si+full_blocks):
-                if si in self.cache_table:
-                    if DEBUG&1: log("removing sector #%d from cache", si)
-                    Ri = self.cache_table[si]
-                    del self.cache_tableR[Ri]
-                    del self.cache_table[si]
-                    if si in self.cache_dirties:
-                        if DEBUG&1: log("removing sector #%d from dirty sectors", si)
-                        del self.cache_dirties[si]
-            self._file.write(s[:full_blocks*512])
-            self.pos += full_blocks*512
-            self.seek(self.pos)
-            s = s[full_blocks*512:] # slicing penalty if buffer?
-            if DEBUG&1: log("len(s) is now %d", len(s))
-        if len(s):
-            if DEBUG&1: log("writing sector %d[%d:%d] from start", self.si, self.so, self.so+len(s))
-            self.asize = 512
-            if not self.cache_retrieve():
-                self.cache_readinto()
-            self.buf[self.so : self.so+len(s)] = s
-            self.cache_dirties[self.si] = True
-            self.pos += len(s)
-        self.seek(self.pos)
-        self.lastsi = self.si
+        s = memoryview(s).cast('B')
+        with self.lock:
+            if len(s) >= self.direct_size:
+                # full sectors go directly to disk, updating cached copies; head & tail are cached
+                start = (offset+self.blocksize-1)//self.blocksize*self.blocksize
+                end = (offset+len(s))//self.blocksize*self.blocksize
+                if DEBUG&1: log("writing %d bytes directly to disk @%Xh", end-start, start)
+                self._raw_write(start, s[start-offset:end-offset])
+                self.cache_extras += 1
+                for page, buf in self.cache.items():
+                    po = page*self.page_size
+                    lo, hi = max(po, start), min(po+self.page_size, end)
+                    if lo < hi:
+                        buf[lo-po:hi-po] = s[lo-offset:hi-offset]
+                self._cache_write(offset, s[:start-offset])
+                self._cache_write(end, s[end-offset:])
+            else:
+                self._cache_write(offset, s)
+
+    def _cache_write(self, pos, s):
+        i = 0
+        while i < len(s):
+            page, offset = divmod(pos+i, self.page_size)
+            n = min(self.page_size-offset, len(s)-i)
+            self.cache_page(page)[offset:offset+n] = s[i:i+n]
+            # dirty ranges are kept sector aligned
+            start = offset - offset%self.blocksize
+            end = min(self.page_size, (offset+n+self.blocksize-1)//self.blocksize*self.blocksize)
+            if page in self.cache_dirties:
+                r = self.cache_dirties[page]
+                r[0], r[1] = min(r[0], start), max(r[1], end)
+            else:
+                self.cache_dirties[page] = [start, end]
+            i += n
+
+
+class mmap_disk(object):
+    """Like disk, but for regular image files: the whole file is memory mapped,
+    so I/O needs no system calls and no intermediate cache. readview returns a
+    zero-copy memoryview; flush syncs to the file only the pages written."""
+    def __str__ (self):
+        return "Python mmap disk '%s' (mode '%s') @%016Xh" % (self._file.name, self.mode, self.pos)
+
+    def __init__(self, name, mode='rb'):
+        self.mode = mode
+        self.pos = 0
+        self.blocksize = 512
+        self._file = open(name, mode, 0)
+        self.size = os.fstat(self._file.fileno()).st_size
+        access = (mmap.ACCESS_WRITE, mmap.ACCESS_READ)[mode == 'rb']
+        try:
+            self.mm = mmap.mmap(self._file.fileno(), 0, access=access)
+        except:
+            self._file.close()
+            raise
+        self.view = memoryview(self.mm)
+        self.dirty = set() # indexes of written mmap.ALLOCATIONGRANULARITY pages
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        "Syncs written pages and unmaps the file"
+        if self.closed: return
+        self.flush()
+        self.view.release()
+        try:
+            self.mm.close()
+        except BufferError:
+            # some readview is still alive: the mapping goes away with it
+            if DEBUG&1: log("%s: views still exported, leaving unmap to GC", self)
+        self._file.close()
+        self.closed = True
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            self.pos += offset
+        elif whence == 2:
+            self.pos = self.size + offset
+        else:
+            self.pos = offset
+        if self.pos > self.size: self.pos = self.size
+        if self.pos < 0: self.pos = 0
+
+    def tell(self):
+        return self.pos
+
+    def cache_stats(self):
+        return {'dirty':len(self.dirty)}
+
+    def flush(self):
+        self.cache_flush()
+
+    def cache_flush(self):
+        "Syncs written pages to the file, joining adjacent ones"
+        if not self.dirty: return
+        granularity = mmap.ALLOCATIONGRANULARITY
+        pages = sorted(self.dirty)
+        start = prev = pages[0]
+        for page in pages[1:] + [None]:
+            if page == prev+1:
+                prev = page
+                continue
+            offset = start*granularity
+            length = min((prev+1)*granularity, self.size) - offset
+            if DEBUG&1: log("%s: syncing %d bytes @%Xh", self, length, offset)
+            self.mm.flush(offset, length)
+            start = prev = page
+        self.dirty = set()
+
+    def prefetch(self, offset, size):
+        "Hints the OS to page in 'size' bytes from 'offset'"
+        if hasattr(self.mm, 'madvise') and 0 <= offset < self.size:
+            start = offset - offset%mmap.PAGESIZE
+            self.mm.madvise(mmap.MADV_WILLNEED, start, min(offset+size, self.size)-start)
+
+    def readview_at(self, offset, size=-1):
+        "Returns a read-only memoryview of 'size' bytes of the mapping from 'offset'"
+        offset = min(max(offset, 0), self.size)
+        if size < 0 or offset + size > self.size:
+            size = self.size - offset
+        return self.view[offset:offset+size].toreadonly()
+
+    def readview(self, size=-1):
+        "Like read, but returns a read-only memoryview of the mapping"
+        v = self.readview_at(self.pos, size)
+        self.pos += len(v)
+        return v
+
+    def read_at(self, offset, size=-1):
+        return bytearray(self.readview_at(offset, size))
+
+    def readinto_at(self, offset, buf):
+        v = self.readview_at(offset, len(buf))
+        buf[:len(v)] = v
+        return len(v)
+
+    def read(self, size=-1):
+        if DEBUG&1: log("read(%d) bytes @%Xh", size, self.pos)
+        return bytearray(self.readview(size))
+
+    def readinto(self, buf):
+        n = self.readinto_at(self.pos, buf)
+        self.pos += n
+        return n
+
+    def write_at(self, offset, s):
+        n = len(s)
+        if not n: return
+        if offset + n > self.size:
+            raise BaseException('mmap_disk: cannot write %d bytes @%Xh past the end of %s' % (n, offset, self._file.name))
+        self.view[offset:offset+n] = s
+        granularity = mmap.ALLOCATIONGRANULARITY
+        self.dirty.update(range(offset//granularity, (offset+n-1)//granularity+1))
+
+    def write(self, s):
+        if DEBUG&1: log("request to write %d bytes @%Xh", len(s), self.pos)
+        self.write_at(self.pos, s)
+        self.pos += len(s)
 
 
 class partition(object):
@@ -382,6 +788,17 @@ class partition(object):
         self.pos = 0
         self.seek(0) # force disk to partition start
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self):
+        "Opens the file system in this partition, returning its root Dirtable"
+        from FATtools.Volume import openvolume
+        return openvolume(self)
+
     def close(self):
         self.flush()
         self.closed = True
@@ -403,10 +820,45 @@ class partition(object):
         return self.pos
 
     def read(self, size=-1):
-        return self.disk.read(size)
+        s = self.read_at(self.pos, size)
+        self.pos += len(s)
+        return s
+
+    def read_at(self, offset, size=-1):
+        "Reads from partition 'offset' without moving any position"
+        if size < 0:
+            size = max(0, self.size - offset)
+        return self.disk.read_at(self.offset+offset, size)
+
+    def readinto(self, buf):
+        n = self.readinto_at(self.pos, buf)
+        self.pos += n
+        return n
+
+    def readinto_at(self, offset, buf):
+        return self.disk.readinto_at(self.offset+offset, buf)
+
+    def prefetch(self, offset, size):
+        if hasattr(self.disk, 'prefetch'):
+            self.disk.prefetch(self.offset+offset, size)
+
+    def readview(self, size=-1):
+        if size < 0:
+            size = max(0, self.size - self.pos)
+        if hasattr(self.disk, 'readview_at'):
+            v = self.disk.readview_at(self.offset+self.pos, size)
+        else:
+            v = memoryview(self.disk.read_at(self.offset+self.pos, size)) # virtual disk images
+        self.pos += len(v)
+        return v
         
     def write(self, s): # s MUST be of type bytearray/memoryview
-        self.disk.write(s)
+        self.disk.write_at(self.offset+self.pos, s)
+        self.pos += len(s)
+
+    def write_at(self, offset, s):
+        "Writes at partition 'offset' without moving any position"
+        self.disk.write_at(self.offset+offset, s)
 
     def flush(self):
         if self.volume:
@@ -415,6 +867,89 @@ class partition(object):
 
 
 
+class ramdisk_image(BytesIO):
+    """BytesIO ramdisk holding a copy of a disk area (i.e. a partition), which
+    remembers the sectors written to it, so that only those have to be copied
+    back to the real disk (see load and write_back)"""
+    def __init__(self, initial_bytes=b'', blocksize=512):
+        BytesIO.__init__(self, initial_bytes)
+        self.blocksize = blocksize
+        self.dirty = bytearray((len(initial_bytes)+blocksize-1)//blocksize) # 1 byte flag per sector
+
+    @classmethod
+    def load(cls, stream, size, blocksize=512, chunk_size=32<<20):
+        """Copies 'size' bytes from current 'stream' position into a new ramdisk, in
+        one sequential pass, reading straight into its buffer where possible"""
+        ram = cls(b'', blocksize)
+        if size:
+            BytesIO.seek(ram, size-1)
+            BytesIO.write(ram, b'\x00') # zero filled at once, without dirty flags
+            ram.seek(0)
+        ram.dirty = bytearray((size+blocksize-1)//blocksize)
+        readinto = getattr(stream, 'readinto', None)
+        view = ram.getbuffer()
+        i = 0
+        while i < size:
+            n = min(chunk_size, size-i)
+            if readinto:
+                got = readinto(view[i:i+n])
+            else:
+                s = stream.read(n)
+                got = len(s)
+                view[i:i+got] = s
+            if not got:
+                del view
+                raise BaseException('ramdisk_image: stream ended after %d bytes of %d' % (i, size))
+            i += got
+        del view # BytesIO can't be written while its buffer is exported
+        if DEBUG&1: log("ramdisk_image: loaded %d bytes", size)
+        return ram
+
+    def write(self, s):
+        pos = self.tell()
+        n = BytesIO.write(self, s)
+        if n:
+            first = pos//self.blocksize
+            last = (pos+n+self.blocksize-1)//self.blocksize
+            if last > len(self.dirty):
+                self.dirty += bytearray(last-len(self.dirty))
+            self.dirty[first:last] = b'\x01'*(last-first)
+        return n
+
+    def dirty_runs(self, gap=64):
+        """Yields (offset, length) of dirty byte ranges in ascending order. Runs
+        separated by less than 'gap' clean sectors are merged, to trade a few
+        rewritten sectors for fewer (and larger) writes."""
+        end = len(self.dirty)
+        i = self.dirty.find(1)
+        while i > -1:
+            j = self.dirty.find(0, i)
+            while j > -1:
+                k = self.dirty.find(1, j)
+                if k < 0 or k-j > gap: break
+                j = self.dirty.find(0, k)
+            if j < 0: j = end
+            yield i*self.blocksize, (j-i)*self.blocksize
+            i = self.dirty.find(1, j) if j < end else -1
+
+    def write_back(self, stream, gap=64):
+        "Writes dirty sectors to 'stream' (positioned like this ramdisk) and marks them clean. Returns bytes written"
+        view = self.getbuffer()
+        total = 0
+        try:
+            for offset, length in self.dirty_runs(gap):
+                length = min(length, len(view)-offset)
+                if DEBUG&1: log("ramdisk_image: writing back %d bytes @%Xh", length, offset)
+                stream.seek(offset)
+                stream.write(view[offset:offset+length])
+                total += length
+        finally:
+            del view
+        self.dirty[:] = bytearray(len(self.dirty))
+        return total
+
+
+
 if __name__ == '__main__':
     import logging
     logging.basicConfig(level=logging.DEBUG, filename='test_disk.log', filemode='w')
@@ -428,9 +963,11 @@ if __name__ == '__main__':
     
     #~ open('TESTIMAGE.BIN', 'wb').write(bytearray(4<<20))
     #~ d = disk('TESTIMAGE.BIN', 'r+b')
-    d = disk('\\\\.\\G:', 'r+b')
-    d.rawcache = bytearray(4<<20)
-    d.cache = memoryview(d.rawcache)
+    # disk.py [--direct] [image or device]: a regular file is a fine stand-in for a device
+    args = [a for a in sys.argv[1:] if a != '--direct']
+    d = disk(args[0] if args else '\\\\.\\G:', 'r+b', cache_size=4<<20, direct='--direct' in sys.argv)
+    if '--direct' in sys.argv:
+        print("Direct I/O:", ('not available, testing buffered I/O', 'enabled')[d.direct])
 
     log("Testing cached random writes & reads...")
     print("Testing cached random writes & reads...")
@@ -537,5 +1074,15 @@ if __name__ == '__main__':
             FAILURES+=1
             print ('FAILURE! Expected bytes %d %d at %d, read %s!' % (i&0xFF, i&0xFF, i, c))
 
+    d.flush()
+    print("Cache stats:", d.cache_stats())
+    print("Testing reads after dropping the cache...")
+    d.seek(3)
+    s = d.read(1024)
+    d.cache_drop()
+    d.seek(3)
+    if d.read(1024) != s:
+        FAILURES+=1
+        print('FAILURE! Data read back from disk differs from cached one!')
     if not FAILURES:
         print("All tests passed!")
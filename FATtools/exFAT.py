@@ -2,14 +2,15 @@
 # Utilities to manage an exFAT  file system
 #
 
-import sys, copy, os, struct, time, io, atexit, functools
+import sys, copy, os, struct, time, io, functools, re
 from datetime import datetime
 from collections import OrderedDict
 DEBUG=int(os.getenv('FATTOOLS_DEBUG', '0'))
 
 from FATtools.debug import log
 from FATtools import utils
-from FATtools.FAT import FAT, Chain
+from FATtools.FAT import FAT, Chain, DirBuffer
+from FATtools.freemap import FreeSpaceMap, POLICIES
 
 if DEBUG&8: import hexdump
 
@@ -19,6 +20,7 @@ class exFATException(Exception):
     pass
 
 
+@utils.layout_class
 class boot_exfat(object):
     "exFAT boot sector"
     layout = { # { offset: (nome, stringa di unpack) }
@@ -51,10 +53,6 @@ class boot_exfat(object):
         self._pos = offset # base offset
         self._buf = s or bytearray(512) # normal boot sector size
         self.stream = stream
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
         self.__init2__()
 
     def __init2__(self):
@@ -130,10 +128,37 @@ def upcase_expand(s):
 
 
 
+# Bitmap spans holding free clusters: a run of free bytes or a partly used byte
+_FREE_SPANS = re.compile(b'\x00+|[^\x00\xFF]')
+
+def _free_bits(b):
+    "Returns the runs (first bit, bits) of zero bits in byte 'b'"
+    runs = []
+    for i in range(8):
+        if b & (1 << i): continue
+        if runs and runs[-1][0]+runs[-1][1] == i:
+            runs[-1] = (runs[-1][0], runs[-1][1]+1)
+        else:
+            runs.append((i, 1))
+    return tuple(runs)
+
+_FREE_BITS = [_free_bits(b) for b in range(256)]
+
+
+
 class Bitmap(Chain):
+    """The exFAT allocation Bitmap. It is kept in memory: bits are tested and
+    changed there, and written back by flush, one write per run of changed
+    'block' bytes blocks. Free runs are kept in a FreeSpaceMap: allocations
+    extend the chain's last run, if possible, or take the smallest run large
+    enough (the largest one for a growing chain), so that files stay contiguous
+    and need no FAT"""
+    block = 4096 # dirty tracking granularity, in Bitmap bytes
+
     def __init__ (self, boot, fat, cluster, size=0):
         self.isdirectory=False
         self.runs = OrderedDict() # RLE map of fragments
+        self._lcns, self._vcns, self._run = [], [], 0 # runs VCN index (see Chain)
         self.stream = boot.stream
         self.boot = boot
         self.fat = fat
@@ -149,183 +174,132 @@ class Bitmap(Chain):
         self.vco = -1
         self.lastvlcn = (0, cluster) # last cluster VCN & LCN
         self.last_free_alloc = 2
+        self.policy = 'best' # default allocation policy (see FreeSpaceMap)
         self.nofat = False
         # Bitmap always uses FAT, even if contig, but is fixed size
         self.size == self.maxrun4len(self.size)
-        self.free_clusters = None # tracks free clusters number
         self.free_clusters_map = None
         self.free_clusters_flag = 0 # set if map needs compacting
+        self.seek(0)
+        self.table = bytearray(self.read(self.filesize)) # the whole Bitmap
+        self.dirty = set() # changed blocks
         self.map_free_space()
         if DEBUG&8: log("exFAT Bitmap of %d bytes (%d clusters) @%Xh", self.filesize, self.boot.dwDataRegionLength, self.start)
 
+    @property
+    def free_clusters(self):
+        "Free clusters count"
+        if self.free_clusters_map is None: return None
+        return self.free_clusters_map.clusters
+
     def __str__ (self):
         return "exFAT Bitmap of %d bytes (%d clusters) @%Xh" % (self.filesize, self.boot.dwDataRegionLength, self.start)
 
     def map_free_space(self):
-        "Maps the free clusters in an ordered dictionary {start_cluster: run_length}"
-        self.free_clusters_map = {}
-        FREE_CLUSTERS=0
-        # Bitmap could reach 512M!
-        PAGE = 1<<20
-        END_OF_CLUSTERS = (self.boot.dwDataRegionLength+7)//8
-        REMAINDER = 8*END_OF_CLUSTERS - self.boot.dwDataRegionLength
-        i = 0 # address of cluster #2
-        self.seek(i)
-        while i < END_OF_CLUSTERS:
-            s = self.read(min(PAGE, END_OF_CLUSTERS-i)) # slurp full bitmap, or 1M page
-            if DEBUG&8: log("map_free_space: loaded Bitmap page of %d bytes @0x%X", len(s), i)
-            j=0
-            while j < len(s)*8:
-                first_free = -1
-                run_length = -1
-                while j < len(s)*8:
-                    if not j%8 and s[j//8] == 0xFF:
-                        if run_length > 0: break
-                        j+=8
-                        continue
-                    if s[j//8] & (1 << (j%8)):
-                        if run_length > 0: break
-                        j+=1
-                        continue
-                    if first_free < 0:
-                        first_free = j+2+i*8
-                        run_length = 0
-                    run_length += 1
-                    j+=1
-                if first_free < 0: continue
-                FREE_CLUSTERS+=run_length
-                self.free_clusters_map[first_free] =  run_length
-                if DEBUG&8: log("map_free_space: appended run (%d, %d)", first_free, run_length)
-            i += len(s) # advance to next Bitmap page to examine
-        if REMAINDER:
-            if DEBUG&8: log("map_free_space: Bitmap rounded by %d bits, correcting total and last run count", REMAINDER)
-            FREE_CLUSTERS -= REMAINDER
-            last = self.free_clusters_map.popitem()
-            run_length = last[1]-REMAINDER # subtracts bits processed in excess
-            if run_length > 0:
-                self.free_clusters_map[last[0]] =  run_length
-        self.free_clusters = FREE_CLUSTERS
-        if DEBUG&8: log("map_free_space: %d clusters free in %d run(s)", FREE_CLUSTERS, len(self.free_clusters_map))
-        return FREE_CLUSTERS, len(self.free_clusters_map)
+        "Maps the free clusters in a FreeSpaceMap {start_cluster: run_length}"
+        table = self.table
+        clusters = self.boot.dwDataRegionLength
+        runs = [] # [first bit, last bit+1] of free runs
+        # The regex engine skips used (0xFF) bytes; free bytes come in spans
+        for m in _FREE_SPANS.finditer(table, 0, (clusters+7)//8):
+            i = m.start()
+            if table[i]:
+                spans = [(8*i+j, n) for j, n in _FREE_BITS[table[i]]]
+            else:
+                spans = ((8*i, 8*(m.end()-i)),)
+            for j, n in spans:
+                if runs and runs[-1][1] == j:
+                    runs[-1][1] += n
+                else:
+                    runs.append([j, j+n])
+        self.free_clusters_map = FreeSpaceMap((first+2, min(last, clusters)-first) for first, last in runs) # bits past the last cluster round the Bitmap
+        if DEBUG&8: log("map_free_space: %s", self.free_clusters_map)
+        return self.free_clusters, len(self.free_clusters_map)
 
     def map_compact(self, strategy=0):
-        "Compacts, eventually reordering, the free space runs map"
-        if not self.free_clusters_flag: return
-        #~ print "Map before:", sorted(self.free_clusters_map.iteritems())
-        map_changed = 0
-        while 1:
-            d=copy.copy(self.free_clusters_map)
-            for k,v in sorted(self.free_clusters_map.items()):
-                while d.get(k+v): # while contig runs exist, merge
-                    v1 = d.get(k+v)
-                    if DEBUG&8: log("Compacting free_clusters_map: {%d:%d} -> {%d:%d}", k,v,k,v+v1)
-                    d[k] = v+v1
-                    del d[k+v]
-                    #~ print "Compacted {%d:%d} -> {%d:%d}" %(k,v,k,v+v1)
-                    #~ print sorted(d.iteritems())
-                    v+=v1
-            if self.free_clusters_map != d:
-                self.free_clusters_map = d
-                map_changed = 1
-                continue
-            break
+        "Kept for compatibility: FreeSpaceMap merges adjacent runs as they are freed"
         self.free_clusters_flag = 0
-        #~ if strategy == 1:
-            #~ self.free_clusters_map = OrderedDict(sorted(self.free_clusters_map.items(), key=lambda t: t[0])) # sort by disk offset
-        #~ elif strategy == 2:
-            #~ self.free_clusters_map = OrderedDict(sorted(self.free_clusters_map.items(), key=lambda t: t[1])) # sort by run size
-        if DEBUG&8: log("Free space map - %d run(s): %s", len(self.free_clusters_map), self.free_clusters_map)
-        #~ print "Map AFTER:", sorted(self.free_clusters_map.iteritems())
-        
+
     def isset(self, cluster):
         "Tests if the bit corresponding to a given cluster is set"
         assert cluster > 1
         cluster-=2
-        self.seek(cluster//8)
-        B = self.read(1)[0]
-        return (B & (1 << (cluster%8))) != 0
+        return (self.table[cluster//8] & (1 << (cluster%8))) != 0
 
     def set(self, cluster, length=1, clear=False):
         "Sets or clears a bit or bits run"
         assert cluster > 1
         cluster-=2 # since bit zero represents cluster #2
-        pos = cluster//8
-        rem = cluster%8
-        if DEBUG&8: log("set(%Xh,%d%s) start @0x%X:%d", cluster+2, length, ('',' (clear)')[clear!=False], pos, rem)
-        self.seek(pos)
-        if rem:
-            B = self.read(1)[0]
-            if DEBUG&8: log("got byte 0x%X", B)
-            todo = min(8-rem, length)
-            if clear:
-                B &= ~((0xFF>>(8-todo)) << rem)
-            else:
-                B |= ((0xFF>>(8-todo)) << rem)
-            self.seek(-1, 1)
-            self.write(struct.pack('B',B))
-            length -= todo
-            if DEBUG&8: log("set byte 0x%X, remaining=%d", B, length)
-        octets = length//8
-        while octets:
-            i = min(32768, octets)
-            octets -= i
-            if clear:
-                self.write(bytearray(i))
-            else:
-                self.write(i*b'\xFF')
-        rem = length%8
-        if rem:
-            if DEBUG&8: log("last bits=%d", rem)
-            B = self.read(1)[0]
-            if DEBUG&8: log("got B=0x%X", B)
+        if DEBUG&8: log("set(%Xh,%d%s) start @0x%X:%d", cluster+2, length, ('',' (clear)')[clear!=False], cluster//8, cluster%8)
+        table = self.table
+        first, last = cluster//8, (cluster+length-1)//8 # bytes touched
+        if first == last:
+            masks = ((first, ((1 << length)-1) << (cluster%8)),)
+        else:
+            masks = ((first, (0xFF << (cluster%8)) & 0xFF), (last, 0xFF >> (7-(cluster+length-1)%8)))
+            table[first+1:last] = (b'\xFF', b'\x00')[bool(clear)] * (last-first-1)
+        for i, mask in masks:
             if clear:
-                B &= ~(0xFF>>(8-rem))
+                table[i] &= ~mask & 0xFF
             else:
-                B |= (0xFF>>(8-rem))
-            self.seek(-1, 1)
-            self.write(struct.pack('B',B))
-            if DEBUG&8: log("set B=0x%X", B)
+                table[i] |= mask
+        self.dirty.update(range(first//self.block, last//self.block+1))
+
+    def flush(self):
+        "Writes the changed blocks back, one write per run of them"
+        blocks = sorted(self.dirty)
+        self.dirty = set()
+        i = 0
+        while i < len(blocks):
+            j = i
+            while j+1 < len(blocks) and blocks[j+1] == blocks[j]+1: j += 1
+            start, end = blocks[i]*self.block, min((blocks[j]+1)*self.block, len(self.table))
+            if DEBUG&8: log("Bitmap: writing back %d bytes @%Xh", end-start, start)
+            self.seek(start)
+            self.write(self.table[start:end])
+            i = j+1
     
-    def findfree(self, count=0):
-        """Returns index and length of the first free clusters run beginning from
-        'start' or (-1,-1) in case of failure. If 'count' is given, limit the search
-        to that amount."""
+    def findfree(self, count=0, policy=None, after=0):
+        """Takes from the free space map a run of up to 'count' clusters, starting
+        at cluster 'after' if free (to extend a chain), else from the run chosen by
+        'policy' or the largest one. Returns its index and length, or (-1,-1) in
+        case of failure."""
         if self.free_clusters_map == None:
             self.map_free_space()
-        try:
-            i, n = self.free_clusters_map.popitem()
-        except KeyError:
-            return -1, -1
-        if DEBUG&8: log("Got run of %d free clusters from %d (%Xh)", n, i, i)
-        if n-count > 0:
-            self.free_clusters_map[i+count] = n-count # updates map
-            if DEBUG&8: log("New free clusters map: %s", self.free_clusters_map)
-        self.free_clusters-=min(n,count)
-        return i, min(n, count)
+        m = self.free_clusters_map
+        policy = policy or self.policy
+        if after in m and (policy != 'contig' or m[after] >= count): # runs are merged: a free 'after' starts one
+            i, n = after, min(count, m[after])
+            m.take(i, n)
+        elif after and policy == 'best':
+            # a chain outgrowing its run is likely to grow more: it goes on in the
+            # largest run, not in the smallest one that fits this piece
+            i, n = m.largest()
+            n = min(n, count)
+            if i > 1: m.take(i, n)
+        else:
+            i, n = m.alloc(count, policy, self.last_free_alloc)
+        if DEBUG&8 and i > 1: log("Got run of %d free clusters from %d (%Xh)", n, i, i)
+        return i, n
 
     def findmaxrun(self, count=0):
-        "Finds a run of at least count clusters or the greatest run available. Returns a tuple (total_free_clusters, (run_start, clusters))"
-        t = self.last_free_alloc,0
-        maxrun=(0,0)
-        n=0
-        while 1:
-            t = self.findfree(t[0]+1, count)
-            if t[0] < 0: break
-            if DEBUG&8: log("Found %d free clusters from #%d", t[1], t[0])
-            maxrun = max(t, maxrun, key=lambda x:x[1])
-            n += t[1]
-            if count and maxrun[1] >= count: break # break if we found the required run
-            t = (t[0]+t[1], t[1])
-        if DEBUG&8: log("Found the biggest run of %d clusters from #%d on %d total clusters", maxrun[1], maxrun[0], n)
-        return n, maxrun
+        "Finds the greatest cluster run available. Returns a tuple (total_free_clusters, (run_start, clusters))"
+        maxrun = self.free_clusters_map.largest()
+        if DEBUG&8: log("Found the biggest run of %d clusters from #%d on %d total free clusters", maxrun[1], maxrun[0], self.free_clusters)
+        return self.free_clusters, maxrun
 
     def alloc(self, runs_map, count, params={}):
         """Allocates a set of free clusters, marking the FAT and/or the Bitmap.
         runs_map is the dictionary of previously allocated runs
         count is the number of clusters to allocate
-        params is an optional dictionary of directives to tune the allocation (to be done). 
+        params is an optional dictionary of directives to tune the allocation:
+          'policy' - 'best' (default: self.policy), 'first', 'next' (from
+          last_free_alloc) or 'contig' (a single run, or failure): whatever the
+          policy, a chain is first extended past its last run, if free
         Returns the last cluster or raise an exception in case of failure"""
-        self.map_compact()
+        policy = params.get('policy', self.policy)
+        if policy not in POLICIES:
+            raise exFATException("Unknown allocation policy '%s'" % policy)
 
         if self.free_clusters < count:
             if DEBUG&8: log("Couldn't allocate %d cluster(s), only %d free", count, self.free_clusters)
@@ -337,8 +311,11 @@ class Bitmap(Chain):
         
         while count:
             if runs_map:
-                last_run = list(runs_map.items())[-1]
-            i, n = self.findfree(count)
+                last_run = next(reversed(runs_map.items()))
+            i, n = self.findfree(count, policy, last_run[0]+last_run[1] if last_run else 0)
+            if i < 0:
+                if DEBUG&8: log("Couldn't allocate %d contiguous cluster(s)", count)
+                raise exFATException("FATAL! No free run of %d contiguous clusters!" % count)
             if last_run and i == last_run[0]+last_run[1]: # if contiguous
                 runs_map[last_run[0]] = n+last_run[1]
             else:
@@ -366,9 +343,7 @@ class Bitmap(Chain):
 
     def free1(self, start, length):
         "Frees the Bitmap only"
-        self.free_clusters_flag = 1
-        self.free_clusters += length
-        self.free_clusters_map[start] = length
+        self.free_clusters_map.free(start, length)
         self.set(start, length, True)
         #~ print "free set %X:%d clear" % (start, length)
         if DEBUG&8: log("free1: zeroing run of %d clusters from %Xh", length, start)
@@ -429,12 +404,31 @@ class Handle(object):
         self.update_time()
         return self.File.read(size)
 
+    def read_at(self, offset, size=-1):
+        "Reads from 'offset' without moving the file position (thread safe against other positional readers)"
+        return self.File.read_at(offset, size)
+
+    def readinto(self, buf):
+        "Reads into 'buf' (bytearray or memoryview), returning the bytes read"
+        self.update_time()
+        return self.File.readinto(buf)
+
+    def readinto_at(self, offset, buf):
+        return self.File.readinto_at(offset, buf)
+
     def write(self, s):
+        self.write_at(None, s)
+
+    def write_at(self, offset, s):
+        "Writes at 'offset' without moving the file position, or at the position if 'offset' is None"
         if self.IsReadOnly:
             raise exFATException("Can't write, filesystem was opened in Read-Only mode!")
         if not self.IsValid:
             raise exFATException("Can't write, invalid Handle!")
-        self.File.write(s)
+        if offset is None:
+            self.File.write(s)
+        else:
+            self.File.write_at(offset, s)
         self.update_time(1)
         #~ self.IsReadOnly = False
         # If alloc on write
@@ -605,21 +599,27 @@ class exFATDirentry(Direntry):
         self._i = 0
         self._buf = s
         self._pos = pos
-        self._kv = {}
         self.type = self._buf[0] & 0x7F
         if self.type == 0 or self.type not in self.slot_types:
             if DEBUG&8: log("Unknown slot type: %Xh", self.type)
-        self._kv = self.slot_types[self.type][0].copy() # select right slot type
         self._name = self.slot_types[self.type][1]
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
-        if self.type == 5:
-            for k in (1,3,4,8,0x14,0x18):
-                self._kv[k+32] = self.stream_extension_layout[k]
-                self._vk[self.stream_extension_layout[k][0]] = k+32
+        if self.type not in self.layouts:
+            self.layouts[self.type] = self._compile(self.type)
+        self._kv, self._vk = self.layouts[self.type] # select right slot type (shared, never altered)
         #~ if DEBUG&8: log("Decoded %s", self)
 
+    layouts = {} # { slot type: (_kv, _vk) }
+
+    @classmethod
+    def _compile(cls, slot):
+        "Returns the _kv and _vk maps of a slot type"
+        kv, vk = utils.compile_layout(cls.slot_types[slot][0])
+        if slot == 5:
+            for k in (1,3,4,8,0x14,0x18):
+                kv[k+32] = cls.stream_extension_layout[k]
+                vk[cls.stream_extension_layout[k][0]] = k+32
+        return kv, vk
+
     __getattr__ = utils.common_getattr
 
     def __str__ (self):
@@ -789,15 +789,16 @@ class Dirtable(object):
         if path == '.':
             self.dirtable = {} # These *MUST* be propagated from root to descendants!
             self.boot.dirtable = self.dirtable
-            atexit.register(self.flush)
         else:
             self.dirtable = self.boot.dirtable
         if self.start not in self.dirtable:
             # Names maps lowercased names and Direntry slots
             # Handle contains the unique Handle to the directory table
             # Open lists opened files
-            self.dirtable[self.start] = {'Names':{}, 'Handle':None, 'slots_map':{}, 'Open':[]} # Names key MUST be Python Unicode!
+            self.dirtable[self.start] = {'Names':{}, 'Handle':None, 'slots_map':{}, 'Open':[], 'Dirs':{}} # Names key MUST be Python Unicode!
             #~ if DEBUG&8: log("Global directory table is '%s':", self.dirtable)
+        self._buffer()
+        if not self.dirtable[self.start]['slots_map']:
             self.map_slots()
         #~ print self.dirtable
         self.filetable = self.dirtable[self.start]['Open']
@@ -806,6 +807,22 @@ class Dirtable(object):
         s = "Directory table @LCN %X (LBA %Xh)" % (self.start, self.boot.cl2offset(self.start))
         return s
 
+    def _buffer(self):
+        "Makes self.stream the DirBuffer shared by all the tables of this directory"
+        d = self.dirtable[self.start]
+        if 'Buffer' not in d:
+            if d['Handle']: # the Chain of the unique directory Handle
+                self.stream = d['Handle'].File
+            d['Buffer'] = DirBuffer(self.stream, self.boot.cluster)
+        self.stream = d['Buffer']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if not self.closed:
+            self.close()
+
     def _checkopen(self):
         if self.closed:
             raise exFATException('Requested operation on a closed Dirtable!')
@@ -847,43 +864,55 @@ class Dirtable(object):
 
     def opendir(self, name):
         """Opens an existing relative directory path beginning in this table and
-        return a new Dirtable object or None if not found"""
+        return a Dirtable object or None if not found. Tables opened are cached
+        in the parent's dirtable[start]['Dirs'] by name, so a path is resolved once"""
         self._checkopen()
         name = name.replace('/','\\')
         path = name.split('\\')
         found = self
-        parent = self # records parent dir handle
         for com in path:
             if len(com) > 242: return None
+            dirs = self.dirtable[found.start]['Dirs']
+            cached = dirs.get(com.lower())
+            if cached and not cached.closed:
+                found = cached
+                continue
             e = found.find(com)
             if e and e.IsDir():
                 parent = found
                 found = Dirtable(self.boot, self.fat, e.Start(), e.u64ValidDataLength, e.IsContig(), path=os.path.join(found.path, com))
+                found._sethandle(e, parent)
+                dirs[com.lower()] = found
                 continue
             found = None
             break
-        if found:
-            if DEBUG&8: log("opened directory table '%s' @0x%X (cluster 0x%X)", found.path, self.boot.cl2offset(found.start), found.start)
-            if self.dirtable[found.start]['Handle']:
-                # Opened many, closed once!
-                found.handle = self.dirtable[found.start]['Handle']
-                if DEBUG&8: log("retrieved previous directory Handle %s", found.handle)
-                # We must update the Chain stream associated with the unique Handle,
-                # or size variations will be discarded!
-                found.stream = found.handle.File
-            else:
-                res = Handle()
-                res.IsValid = True
-                res.IsReadOnly = (self.boot.stream.mode != 'r+b')
-                res.IsDirectory = 1
-                res.File = found.stream
-                res.File.isdirectory = 1
-                res.Entry = e
-                res.Dir = parent
-                found.handle = res
-                self.dirtable[found.start]['Handle'] = res
         return found
 
+    def _sethandle(self, e, parent):
+        "Gives this table the unique Handle to its directory, making it if needed"
+        if DEBUG&8: log("opened directory table '%s' @0x%X (cluster 0x%X)", self.path, self.boot.cl2offset(self.start), self.start)
+        if self.dirtable[self.start]['Handle']:
+            # Opened many, closed once!
+            self.handle = self.dirtable[self.start]['Handle']
+            if DEBUG&8: log("retrieved previous directory Handle %s", self.handle)
+        else:
+            res = Handle()
+            res.IsValid = True
+            res.IsReadOnly = (self.boot.stream.mode != 'r+b')
+            res.IsDirectory = 1
+            res.File = self.stream.chain # shared with the DirBuffer, or size variations will be discarded!
+            res.File.isdirectory = 1
+            res.Entry = e
+            res.Dir = parent
+            self.handle = res
+            self.dirtable[self.start]['Handle'] = res
+
+    def _uncache(self, start):
+        "Forgets the opened tables of the subdirectory at cluster 'start' (erased or renamed)"
+        dirs = self.dirtable[self.start]['Dirs']
+        for k in [k for k, d in dirs.items() if d.start == start]:
+            del dirs[k]
+
     def _alloc(self, name, clusters=0):
         "Allocates a new Direntry slot (both file/directory)"
         res = Handle()
@@ -943,8 +972,10 @@ class Dirtable(object):
         handle.write(bytearray(self.boot.cluster)) # blank table
         self._update_dirtable(handle.Entry)
         # Records the unique Handle to the directory
-        self.dirtable[handle.File.start] = {'Names':{}, 'Handle':handle, 'slots_map':{0:(256<<20)//32}, 'Open':[]}
-        return Dirtable(handle, None, path=os.path.join(self.path, name))
+        self.dirtable[handle.File.start] = {'Names':{}, 'Handle':handle, 'slots_map':{0:(256<<20)//32}, 'Open':[], 'Dirs':{}}
+        found = Dirtable(handle, None, path=os.path.join(self.path, name))
+        self.dirtable[self.start]['Dirs'][name.lower()] = found
+        return found
 
     def rmtree(self, name=None):
         "Removes a full directory tree"
@@ -989,10 +1020,10 @@ class Dirtable(object):
             dirs = {self.start: self.dirtable[self.start]}
         else:
             if DEBUG&8: log("Flushing root dirtable")
-            atexit.unregister(self.flush)
             dirs = self.dirtable
         if not dirs:
             if DEBUG&8: log("No directories to flush!")
+        buffers = []
         for i in dirs:
             if not self.dirtable[i]['Open']:
                 if DEBUG&8: log("No opened files!")
@@ -1003,6 +1034,12 @@ class Dirtable(object):
             if h:
                 h.close()
                 h.IsValid = False
+                buffers.append(h.Dir.stream) # parent table, updated by close
+            buffers.append(self.dirtable[i].get('Buffer')) # None if erased
+        for b in buffers:
+            if b: b.flush()
+        self.fat.flush() # in memory FAT
+        self.boot.bitmap.flush()
 
     def map_compact(self):
         "Compacts, eventually reordering, a slots map"
@@ -1032,7 +1069,7 @@ class Dirtable(object):
     def map_slots(self):
         "Fills the free slots map and file names table once at first access"
         if not self.dirtable[self.start]['slots_map']:
-            self.stream.seek(0)
+            table = memoryview(self.stream.buf)
             pos = 0
             s = ''
             while True:
@@ -1041,7 +1078,7 @@ class Dirtable(object):
                 buf = bytearray()
                 count = 0
                 while True:
-                    s = self.stream.read(32)
+                    s = table[pos:pos+32]
                     if not s or not s[0]: break
                     if s[0] & 0x80 != 0x80: # if inactive
                         if first_free < 0:
@@ -1073,8 +1110,8 @@ class Dirtable(object):
                     # Maps unallocated space to max table size (256 MiB)
                     self.dirtable[self.start]['slots_map'][pos] = ((256<<20) - pos)//32
                     break
+            table.release()
             self.needs_compact = 1
-            self.stream.seek(0)
             if DEBUG&8:
                 log("%s collected slots map: %s", self, self.dirtable[self.start]['slots_map'])
                 log("%s dirtable: %s", self, self.dirtable[self.start])
@@ -1099,14 +1136,12 @@ class Dirtable(object):
 
     def iterator(self):
         self._checkopen()
-        told = self.stream.tell()
+        table = self.stream.buf # it could change while iterating
         buf = bytearray()
-        s = 1
         pos = 0
         count = 0
-        while s:
-            self.stream.seek(pos)
-            s = self.stream.read(32)
+        while True:
+            s = table[pos:pos+32]
             pos += 32
             if not s or s[0] == 0: break
             if s[0] & 0x80 != 0x80: continue # unused slot
@@ -1120,10 +1155,9 @@ class Dirtable(object):
                 if count: continue
             else:
                 buf += s
-            yield exFATDirentry(buf, self.stream.tell()-len(buf))
+            yield exFATDirentry(buf, pos-len(buf))
             buf = bytearray()
             count = 0
-        self.stream.seek(told)
 
     def _update_dirtable(self, it, erase=False):
         k = it.Name().lower()
@@ -1164,9 +1198,13 @@ class Dirtable(object):
                 return 0
         start = e.Start()
         if DEBUG&8: log("Erasing slot @%d (pointing at %Xh)", e._pos, start)
+        if e.IsDir():
+            self._uncache(start)
         if start in self.dirtable:
             if DEBUG&8: log("Marking open Handle for %Xh as invalid", start)
             self.dirtable[start]['Handle'].IsValid = False # 20190413: prevents post-mortem updating
+            if e.IsDir() and 'Buffer' in self.dirtable[start]:
+                self.dirtable[start].pop('Buffer').dirty.clear() # its clusters are going to be freed
         #~ elif start in self.filetable:
             #~ if DEBUG&8: log("Removing Handle for %Xh from filetable", start)
             #~ del self.filetable[start]
@@ -1205,6 +1243,8 @@ class Dirtable(object):
         if self.find(newname):
             if DEBUG&8: log("Can't rename, file exists: '%s'", newname)
             return 0
+        if e.IsDir():
+            self._uncache(e.Start())
         # Alloc new slot
         ne = self._alloc(newname)
         if not ne:
@@ -1223,6 +1263,8 @@ class Dirtable(object):
         if DEBUG&8: log("'%s' renamed to '%s'", name, newname)
         self._update_dirtable(ne.Entry)
         self._update_dirtable(e, True)
+        if e.IsDir() and e.Start() in self.dirtable and self.dirtable[e.Start()]['Handle']:
+            self.dirtable[e.Start()]['Handle'].Entry = ne.Entry # or closing it would rewrite the old slot
         # Mark the old one as erased
         for i in range(0, len(e._buf), 32):
             e._buf[i] ^= (1<<7)
@@ -1290,6 +1332,7 @@ class Dirtable(object):
             c_used = (last+self.boot.cluster-1)//self.boot.cluster
             if c_used < c_alloc:
                 self.handle.ftruncate(last, 1)
+                self.stream.sync()
                 self.handle.IsValid = 1 # forces updating directory entry sizes
                 self.handle.close()
                 if DEBUG&8: log("Shrank directory table freeing %d clusters", c_alloc-c_used)
@@ -1298,7 +1341,7 @@ class Dirtable(object):
                 if DEBUG&8: log("Can't shrink directory table, free space < 1 cluster!")
         # Rebuilds Dirtable caches
         self.slots_map = {}
-        self.dirtable[self.start] = {'Names':{}, 'Handle':None, 'slots_map':{}, 'Open':[]}
+        self.dirtable[self.start] = {'Names':{}, 'Handle':None, 'slots_map':{}, 'Open':[], 'Dirs':self.dirtable[self.start]['Dirs'], 'Buffer':self.stream}
         self.map_slots()
         return last//32, unused//32
 
@@ -1396,3 +1439,43 @@ def fat_copy_clusters(boot, fat, start):
         s = src.read(boot.cluster)
         dst.write(s)
     return target
+
+
+if __name__ == '__main__':
+    # exFAT.py [image]: times mounting an exFAT volume (the Bitmap maps its free
+    # space) from 'image', or from a sparse 32 GB image with a 60% used and
+    # fragmented Bitmap built here.
+    import random, tempfile
+    from FATtools import partutils, mkfat, Volume, disk
+
+    if len(sys.argv) > 1:
+        image = sys.argv[1]
+    else:
+        image = os.path.join(tempfile.gettempdir(), 'exfatbench.img')
+        if not os.path.exists(image):
+            print("Building a 32 GB exFAT image in", image)
+            with open(image, 'wb') as f: f.truncate(32<<30)
+            with disk.disk(image, 'r+b') as d:
+                partutils.partition(d, 'mbr', mbr_type=7)
+            with Volume.vopened(image, 'r+b', 'partition0') as part:
+                mkfat.exfat_mkfs(part, part.size, params={'wanted_cluster':4096})
+            root = Volume.vopen(image, 'r+b')
+            bitmap = root.boot.bitmap
+            # runs of 1-256 used clusters alternating (60/40) with free runs of 1-64
+            rnd = random.Random(1)
+            i, last = 16, root.boot.dwDataRegionLength+2
+            while i < last:
+                used = rnd.random() < 0.6
+                n = min(last-i, rnd.randint(1, 256) if used else rnd.randint(1, 64))
+                if used: bitmap.set(i, n)
+                i += n
+            Volume.vclose(root)
+
+    with Volume.vopened(image, 'rb', 'partition0') as part:
+        t0 = time.perf_counter()
+        root = Volume.openvolume(part)
+        t1 = time.perf_counter()
+        free, runs = root.boot.bitmap.map_free_space()
+        t2 = time.perf_counter()
+        print("exFAT Bitmap of %d clusters: %d free in %d runs" % (root.boot.dwDataRegionLength, free, runs))
+        print("Mount: %.3fs, free space scan: %.3fs" % (t1-t0, t2-t1))
@@ -0,0 +1,223 @@
+# -*- coding: cp1252 -*-
+#
+# Free space map of a FAT volume, with allocation policies.
+#
+# Free cluster runs are kept sorted by start cluster (to find neighbours to
+# merge with and for first/next fit) and by length (for best fit and to pick
+# the largest run), in bisect searched lists. Freed runs are merged with
+# adjacent ones at once, so the map never needs compacting.
+#
+
+import os, bisect
+from FATtools.debug import log
+
+DEBUG=int(os.getenv('FATTOOLS_DEBUG', '0'))
+
+POLICIES = ('first', 'best', 'next', 'contig')
+
+
+class FreeSpaceMap(object):
+    """Sorted map of free cluster runs {start: length}. Allocation policies:
+    'first' - lowest run large enough (the classic FAT behaviour)
+    'best' - smallest run large enough, to keep large runs whole
+    'next' - first run large enough from a hint (the last allocated cluster), wrapping
+    'contig' - like best, but a request that no single run satisfies fails"""
+    def __init__(self, runs=()):
+        self.starts = [] # run starts, sorted
+        self.lengths = {} # { start: length }
+        self.by_size = [] # (length, start), sorted
+        self.clusters = 0 # free clusters
+        self.first = {} # { count: start } no run below start has count clusters
+        for start, length in sorted(runs): # merges adjacent runs while loading
+            if self.starts and self.starts[-1] + self.lengths[self.starts[-1]] >= start:
+                last = self.starts[-1]
+                end = max(last + self.lengths[last], start + length)
+                self.clusters += end - last - self.lengths[last]
+                self.lengths[last] = end - last
+            elif length > 0:
+                self.starts.append(start)
+                self.lengths[start] = length
+                self.clusters += length
+        self.by_size = sorted((length, start) for start, length in self.lengths.items())
+
+    def __str__(self):
+        return "FreeSpaceMap of %d clusters in %d runs" % (self.clusters, len(self.starts))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return iter(self.starts)
+
+    def __contains__(self, start):
+        return start in self.lengths
+
+    def __getitem__(self, start):
+        return self.lengths[start]
+
+    def items(self):
+        "Returns the (start, length) runs, sorted by start"
+        return [(start, self.lengths[start]) for start in self.starts]
+
+    def _add(self, start, length):
+        bisect.insort(self.starts, start)
+        self.lengths[start] = length
+        bisect.insort(self.by_size, (length, start))
+
+    def _remove(self, i):
+        "Removes the i-th run (by start), returning (start, length)"
+        start = self.starts.pop(i)
+        length = self.lengths.pop(start)
+        del self.by_size[bisect.bisect_left(self.by_size, (length, start))]
+        return start, length
+
+    def free(self, start, length):
+        "Adds a run of free clusters, merging it with the adjacent (or overlapping) ones"
+        if length < 1: return
+        end = start + length
+        i = bisect.bisect_right(self.starts, start) - 1
+        if i < 0 or self.starts[i] + self.lengths[self.starts[i]] < start:
+            i += 1 # previous run does not touch the new one
+        while i < len(self.starts) and self.starts[i] <= end:
+            s, n = self._remove(i)
+            if DEBUG&4: log("FreeSpaceMap: merging run (%d, %d) with (%d, %d)", start, end-start, s, n)
+            self.clusters -= n
+            start, end = min(start, s), max(end, s+n)
+        self._add(start, end-start)
+        self.clusters += end-start
+        for count, first in self.first.items():
+            if start < first and end-start >= count:
+                self.first[count] = start # first fit lies here now
+
+    def update(self, runs):
+        """Adds many runs of free clusters at once, merging them with the map: like
+        free, but sorting once (to map the free space a FAT page at a time)"""
+        new = FreeSpaceMap(runs)
+        if not new.starts: return
+        lo, hi = new.starts[0], new.starts[-1] + new.lengths[new.starts[-1]]
+        i = bisect.bisect_left(self.starts, lo)
+        if i and self.starts[i-1] + self.lengths[self.starts[i-1]] >= lo:
+            i -= 1 # previous run touches the new ones
+        j = bisect.bisect_right(self.starts, hi)
+        if i < j: # runs of the map among the new ones: merged with them
+            old = [self._remove(i) for k in range(j-i)]
+            self.clusters -= sum(n for s, n in old)
+            new = FreeSpaceMap(new.items() + old)
+        self.starts[i:i] = new.starts
+        self.lengths.update(new.lengths)
+        self.by_size += new.by_size
+        self.by_size.sort() # merges two sorted lists
+        self.clusters += new.clusters
+        self.first.clear() # first fits could lie among the new runs
+        if DEBUG&4: log("FreeSpaceMap: added %d clusters in %d runs", new.clusters, len(new))
+
+    def take(self, start, length):
+        "Removes clusters [start, start+length), which must be free, from the map"
+        i = bisect.bisect_right(self.starts, start) - 1
+        if i < 0 or self.starts[i] + self.lengths[self.starts[i]] < start + length:
+            raise ValueError("clusters %d-%d are not in a free run" % (start, start+length-1))
+        s, n = self._remove(i)
+        if start > s:
+            self._add(s, start-s)
+        if start+length < s+n:
+            self._add(start+length, s+n-start-length)
+        self.clusters -= length
+
+    def largest(self):
+        "Returns (start, length) of the largest run, the lowest if many, or (-1, 0)"
+        if not self.by_size: return -1, 0
+        length = self.by_size[-1][0]
+        return self.by_size[bisect.bisect_left(self.by_size, (length, 0))][1], length
+
+    def find(self, count, policy='first', hint=2):
+        """Returns (start, length) of the run that 'policy' picks for 'count'
+        clusters, or (-1, -1) if no run is large enough"""
+        if not self.by_size or self.by_size[-1][0] < count:
+            return -1, -1
+        if policy in ('best', 'contig'):
+            length, start = self.by_size[bisect.bisect_left(self.by_size, (count, 0))]
+            return start, length
+        i = 0
+        if policy == 'first':
+            i = bisect.bisect_left(self.starts, self.first.get(count, 0))
+        elif policy == 'next':
+            i = bisect.bisect_right(self.starts, hint) - 1
+            if i < 0 or self.starts[i] + self.lengths[self.starts[i]] <= hint:
+                i += 1 # hint is not free: start from the next run
+        else:
+            raise ValueError("unknown allocation policy '%s'" % policy)
+        starts, lengths = self.starts, self.lengths
+        for j in range(len(starts)):
+            start = starts[(i+j) % len(starts)]
+            if lengths[start] >= count:
+                if policy == 'first':
+                    if len(self.first) > 256: self.first.clear()
+                    self.first[count] = start
+                if policy == 'next' and start < hint < start+lengths[start] and start+lengths[start]-hint >= count:
+                    return hint, start+lengths[start]-hint # continue right after the hint
+                return start, lengths[start]
+        return -1, -1
+
+    def alloc(self, count, policy='first', hint=2):
+        """Takes up to 'count' clusters from the run chosen by 'policy' (the
+        largest one, if none is large enough, except with 'contig') and returns
+        (start, length) of what was taken, or (-1, -1)"""
+        start, length = self.find(count, policy, hint)
+        if start < 0:
+            if policy == 'contig': return -1, -1
+            start, length = self.largest()
+            if start < 0: return -1, -1
+        length = min(length, count)
+        self.take(start, length)
+        if DEBUG&4: log("FreeSpaceMap: allocated %d clusters from #%d (%s fit)", length, start, policy)
+        return start, length
+
+
+if __name__ == '__main__':
+    # freemap.py [files]: allocates 'files' small files (1-8 clusters) on a
+    # fragmented free space of 1M clusters, freeing one file in four as it goes,
+    # with each policy and with the linear scan of a plain dictionary that
+    # FAT.findfree used before
+    import sys, time, random
+
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    rnd = random.Random(1)
+    runs, i = [], 2
+    while i < 1<<20:
+        n = rnd.randint(1, 64)
+        runs.append((i, n))
+        i += n + rnd.randint(1, 256) # used clusters between free runs
+    sizes = [rnd.randint(1, 8) for k in range(files)]
+
+    def dict_first_fit(d, count):
+        for i in sorted(d.keys()):
+            if d[i] >= count:
+                n = d.pop(i)
+                if n > count: d[i+count] = n-count
+                return i, count
+        return -1, -1
+
+    print("%d free clusters in %d runs, %d files of %d clusters" % (sum(n for i, n in runs), len(runs), files, sum(sizes)))
+    for policy in ('dict',) + POLICIES:
+        m = FreeSpaceMap(runs) if policy != 'dict' else dict(runs)
+        rnd = random.Random(2)
+        allocated, frags, hint = [], 0, 2
+        t0 = time.perf_counter()
+        for count in sizes[:files if policy != 'dict' else files//10]:
+            while count:
+                if policy == 'dict':
+                    i, n = dict_first_fit(m, count)
+                else:
+                    i, n = m.alloc(count, policy, hint)
+                if i < 0: break
+                allocated.append((i, n))
+                frags += 1
+                hint = i+n-1
+                count -= n
+            if rnd.random() < 0.25 and policy != 'dict':
+                m.free(*allocated.pop(rnd.randrange(len(allocated))))
+        t = time.perf_counter() - t0
+        if policy == 'dict':
+            print("%-6s %8.3fs (extrapolated from %d files)" % (policy, t*10, files//10))
+        else:
+            print("%-6s %8.3fs %6d extents, %6d free runs left, largest %d" % (policy, t, frags, len(m), m.largest()[1]))
@@ -18,6 +18,7 @@ partition_uuids = {
 
 
 
+@utils.layout_class
 class GPT(object):
     "GPT Header Sector according to UEFI Specs"
     layout = { # { offset: (name, unpack string) }
@@ -43,12 +44,8 @@ class GPT(object):
         self._pos = offset # base offset
         self._buf = s or bytearray(512) # normal GPT Header  size
         self.stream = stream
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
         self.partitions = []
         self.raw_partitions = None
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
     
     __getattr__ = utils.common_getattr
 
@@ -114,6 +111,7 @@ class GPT(object):
 
 
 
+@utils.layout_class
 class GPT_Partition(object):
     "Partition entry in GPT Array (128 bytes)"
     layout = { # { offset: (name, unpack string) }
@@ -131,10 +129,6 @@ class GPT_Partition(object):
         self._i = 0
         self._pos = offset # base offset
         self._buf = s or bytearray(512)
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
         
     __getattr__ = utils.common_getattr
 
@@ -0,0 +1,481 @@
+# -*- coding: cp1252 -*-
+#
+# Bulk injection of a host directory tree into a FAT12/16/32 volume.
+#
+# Instead of creating items one at a time (each one searching a free slot,
+# allocating clusters and updating the FAT through the sector cache), the
+# whole tree is planned in advance: every directory table is built in memory
+# with cluster numbers relative to a single contiguous run, then the run is
+# allocated once and filled with a few large sequential writes, followed by a
+# bulk FAT update.
+# A plan can also be saved as a relocatable blob, to splice the same tree into
+# many volumes with one write each.
+#
+
+import os, glob, bisect, struct, tempfile
+DEBUG=int(os.getenv('FATTOOLS_DEBUG', '0'))
+from FATtools.FAT import FATDirentry, FATException
+from FATtools.debug import log
+
+
+class Node(object):
+    "A host file or directory to inject"
+    def __init__ (self, name, path, size=0, is_dir=False):
+        self.name = name # name in the virtual table
+        self.path = path # host path
+        self.size = size # file size in bytes
+        self.is_dir = is_dir
+        self.children = [] # Node objects, if directory
+        self.start = 0 # first cluster, relative to the injected run
+        self.clusters = 0 # clusters occupied
+        self.entries = [] # FATDirentry objects of children, if directory
+
+    def __str__ (self):
+        return "%s '%s' (%d bytes) @%Xh+%d" % (('File','Directory')[self.is_dir], self.path, self.size, self.start, self.clusters)
+
+
+def scan_tree(path, name=None):
+    "Builds the Node tree of a host file or directory"
+    name = name or os.path.basename(os.path.normpath(path))
+    if not os.path.isdir(path):
+        return Node(name, path, os.stat(path).st_size)
+    node = Node(name, path, is_dir=True)
+    names = {}
+    for it in sorted(os.scandir(path), key=lambda x: x.name):
+        if it.is_dir():
+            child = scan_tree(it.path, it.name)
+        elif it.is_file():
+            child = Node(it.name, it.path, it.stat().st_size)
+        else:
+            continue
+        # FAT names are case insensitive: the last one wins, like copy_in
+        names[it.name.lower()] = child
+    node.children = list(names.values())
+    return node
+
+
+def scan_sources(src_list):
+    """Builds the Node trees of a list of host paths, expanding wildcards like
+    copy_in. Node objects in the list (trees already scanned) are passed as is."""
+    nodes = []
+    for it in src_list:
+        if isinstance(it, Node):
+            nodes += [it]
+            continue
+        for path in sorted(glob.glob(it, recursive=True)) or [it]:
+            if os.path.isdir(path) or os.path.isfile(path):
+                nodes += [scan_tree(path)]
+    return nodes
+
+
+class InjectionPlan(object):
+    """Lays out a list of Node trees in one contiguous run of clusters. Cluster
+    numbers in directory tables are relative to the run start and get rebased
+    when the run is written."""
+    def __init__ (self, nodes, cluster, parent_start=0):
+        self.nodes = nodes # top level nodes
+        self.cluster = cluster # cluster size in bytes
+        self.parent_start = parent_start # cluster of the table receiving top level nodes (0 if root)
+        self.order = [] # nodes with clusters, in disk order
+        self.chains = [] # chain lengths, in disk order
+        self.relocs = [] # run offsets of short slots holding a relative start cluster
+        self.clusters = 0 # total clusters in run
+        self.files = 0
+        self.bytes = 0
+        for node in nodes:
+            self._layout(node)
+        for node in nodes:
+            self._link(node, None)
+        self.relocs.sort()
+        if DEBUG&2: log("InjectionPlan: %d files, %d bytes in %d clusters, %d chains", self.files, self.bytes, self.clusters, len(self.chains))
+
+    def __str__ (self):
+        return "Injection plan of %d files (%d bytes) in %d clusters" % (self.files, self.bytes, self.clusters)
+
+    def _make_entries(self, node):
+        "Generates the slots for the children of a directory node"
+        # aliases must not take the 8.3 names of children coming later, too
+        used = set(child.name.lower() for child in node.children if FATDirentry.IsShortName(child.name))
+        for child in node.children:
+            if not FATDirentry.IsValidDosName(child.name, True):
+                raise FATException("Invalid characters in name '%s'" % child.name)
+            dentry = FATDirentry(bytearray(32))
+            # If name is a LFN, generate a short one valid in this table
+            if not FATDirentry.IsShortName(child.name):
+                i = 1
+                short = FATDirentry.GetShortName(FATDirentry.GenRawShortFromLongNameNT(child.name, i))
+                while short.lower() in used:
+                    i += 1
+                    short = FATDirentry.GetShortName(FATDirentry.GenRawShortFromLongNameNT(child.name, i))
+                dentry.GenRawSlotFromName(short, child.name)
+                used.add(short.lower())
+            else:
+                dentry.GenRawSlotFromName(child.name)
+            used.add(child.name.lower())
+            node.entries += [dentry]
+
+    def _layout(self, node):
+        "Assigns relative clusters in pre-order: table, files, then subdirectories"
+        if node.is_dir:
+            self._make_entries(node)
+            size = 64 + sum([len(e._buf) for e in node.entries])
+            if size > (2<<20):
+                raise FATException("Directory table of '%s' would exceed its maximum extension!" % node.path)
+            node.clusters = (size+self.cluster-1)//self.cluster
+        else:
+            node.clusters = (node.size+self.cluster-1)//self.cluster
+            self.files += 1
+            self.bytes += node.size
+        if node.clusters:
+            node.start = self.clusters
+            self.clusters += node.clusters
+            self.order += [node]
+            self.chains += [node.clusters]
+        if node.is_dir:
+            for child in node.children:
+                if not child.is_dir:
+                    self._layout(child)
+            for child in node.children:
+                if child.is_dir:
+                    self._layout(child)
+
+    def _link(self, node, parent):
+        "Sets start clusters and sizes in the slots of a directory node"
+        if not node.is_dir: return
+        dot = FATDirentry(bytearray(32), 0)
+        dot.GenRawSlotFromName('.')
+        dot.Start(node.start)
+        dot.chDOSPerms = 0x10
+        dotdot = FATDirentry(bytearray(32), 32)
+        dotdot.GenRawSlotFromName('..')
+        if parent:
+            dotdot.Start(parent.start)
+        else:
+            dotdot.Start(self.parent_start)
+        dotdot.chDOSPerms = 0x10
+        pos = 64
+        node.table = bytearray(dot.pack()) + dotdot.pack()
+        base = node.start*self.cluster
+        self.relocs += [base]
+        if parent:
+            self.relocs += [base+32]
+        for child, dentry in zip(node.children, node.entries):
+            if child.clusters:
+                dentry.Start(child.start)
+                self.relocs += [base+pos+len(dentry._buf)-32]
+            if child.is_dir:
+                dentry.chDOSPerms = 0x10
+            else:
+                dentry.dwFileSize = child.size
+            dentry._pos = pos
+            node.table += dentry.pack()
+            pos += len(dentry._buf)
+        node.table += bytearray(node.clusters*self.cluster - len(node.table)) # blank table
+        for child in node.children:
+            self._link(child, node)
+
+    def rebase(self, buf, offset, base):
+        "Adds 'base' to the relative start clusters in buf, holding the run bytes from 'offset'"
+        rebase(buf, self.relocs, offset, base)
+
+    def chunks(self, base, callback=None, chunk_size=1<<20):
+        """Generates the run contents for a run starting at cluster 'base', in
+        cluster aligned chunks of about 'chunk_size' bytes"""
+        buf = bytearray()
+        for node in self.order:
+            if node.is_dir:
+                table = bytearray(node.table)
+                self.rebase(table, node.start*self.cluster, base)
+                buf += table
+            else:
+                if callback: callback(node.path)
+                done = 0
+                with open(node.path, 'rb') as fp:
+                    while done < node.size:
+                        s = fp.read(min(node.size-done, chunk_size))
+                        if not s: break # file shrank since scan
+                        buf += s
+                        done += len(s)
+                        if len(buf) >= chunk_size:
+                            n = len(buf)//self.cluster*self.cluster
+                            yield buf[:n]
+                            del buf[:n]
+                buf += bytearray(node.clusters*self.cluster - done) # blank cluster tip
+            if len(buf) >= chunk_size:
+                yield buf
+                buf = bytearray()
+        if buf:
+            yield buf
+
+    def write(self, boot, base, callback=None, chunk_size=1<<20):
+        "Writes directory tables and file contents into the run starting at cluster 'base'"
+        stream = boot.stream
+        stream.seek(boot.cl2offset(base))
+        for buf in self.chunks(base, callback, chunk_size):
+            stream.write(buf)
+        if DEBUG&2: log("InjectionPlan: written %d clusters from #%Xh", self.clusters, base)
+
+    def save(self, path, tag=b'', callback=None, chunk_size=1<<20):
+        """Saves the plan as a relocatable blob file (see FATBlob), marked with an
+        user 'tag' of up to 32 bytes (i.e. a digest of the source tree). The
+        blob is written to a temporary file and then renamed over 'path', so
+        that readers never see it half written"""
+        if self.parent_start:
+            raise FATException("Only a plan for the root table can be saved as blob")
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path)+'.', suffix='.tmp', dir=os.path.dirname(path) or '.')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(struct.pack(FATBlob.header_fmt, FATBlob.magic, tag, self.cluster, self.clusters, len(self.relocs), len(self.chains), len(self.nodes)))
+                for node in self.nodes:
+                    name = node.name.encode('utf-8')
+                    fp.write(struct.pack(FATBlob.node_fmt, node.is_dir, node.start, node.clusters, node.size, len(name)) + name)
+                fp.write(struct.pack('<%dI' % len(self.relocs), *self.relocs))
+                fp.write(struct.pack('<%dI' % len(self.chains), *self.chains))
+                for buf in self.chunks(0, callback, chunk_size):
+                    fp.write(buf)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        if DEBUG&2: log("InjectionPlan: saved %s to blob '%s'", self, path)
+
+
+def rebase(buf, relocs, offset, base):
+    """Adds 'base' to the start clusters of the short slots listed in sorted
+    'relocs', for the ones falling in buf (holding the run bytes from 'offset')"""
+    i = bisect.bisect_left(relocs, offset)
+    end = offset + len(buf)
+    while i < len(relocs) and relocs[i] < end:
+        j = relocs[i] - offset
+        cluster = base + ((buf[j+0x14] | buf[j+0x15]<<8) << 16 | buf[j+0x1A] | buf[j+0x1B]<<8)
+        struct.pack_into('<H', buf, j+0x14, cluster >> 16)
+        struct.pack_into('<H', buf, j+0x1A, cluster & 0xFFFF)
+        i += 1
+
+
+class FATBlob(object):
+    """A saved InjectionPlan for the root table: directory tables and file
+    contents with cluster numbers relative to the run start, plus what is
+    needed to splice it into a volume. Layout:
+        header (header_fmt)
+        top level nodes (node_fmt + UTF-8 name)
+        relocations (DWORD run offsets of short slots to rebase)
+        chain lengths (DWORDs, in disk order)
+        run contents (clusters*cluster bytes)"""
+    magic = b'FATBLOB1'
+    header_fmt = '<8s32sIIIII' # magic, tag, cluster size, clusters, relocs, chains, nodes
+    node_fmt = '<BIIIH' # is_dir, start, clusters, size, name length
+
+    def __init__ (self, path):
+        "Reads the header of a blob file, raising FATException if it is not valid"
+        self.path = path
+        with open(path, 'rb') as fp:
+            hdr = fp.read(struct.calcsize(self.header_fmt))
+            if len(hdr) < struct.calcsize(self.header_fmt) or hdr[:8] != self.magic:
+                raise FATException("'%s' is not a FAT blob" % path)
+            self.header = hdr
+            magic, self.tag, self.cluster, self.clusters, nrelocs, nchains, nnodes = struct.unpack(self.header_fmt, hdr)
+            self.nodes = []
+            for i in range(nnodes):
+                is_dir, start, clusters, size, n = struct.unpack(self.node_fmt, fp.read(struct.calcsize(self.node_fmt)))
+                node = Node(fp.read(n).decode('utf-8'), None, size, is_dir)
+                node.start = start
+                node.clusters = clusters
+                self.nodes += [node]
+            self.relocs = list(struct.unpack('<%dI' % nrelocs, fp.read(4*nrelocs)))
+            self.chains = list(struct.unpack('<%dI' % nchains, fp.read(4*nchains)))
+            self.data_offset = fp.tell()
+            if os.fstat(fp.fileno()).st_size != self.data_offset + self.clusters*self.cluster:
+                raise FATException("FAT blob '%s' is truncated" % path)
+
+    def __str__ (self):
+        return "FAT blob '%s' of %d clusters of %d bytes" % (self.path, self.clusters, self.cluster)
+
+    def splice(self, dest):
+        """Splices the blob into root table 'dest' with one write: finds a free
+        run, rebases cluster numbers, marks the FAT and links the top level
+        items (replacing existing ones). Returns the run start or -1 if the
+        blob does not fit this volume (caller should inject the tree instead)."""
+        if dest.fat.exfat or dest.path != '.' or dest.boot.cluster != self.cluster:
+            if DEBUG&2: log("%s: can't be spliced into %s", self, dest)
+            return -1
+        # the run is read first, so that a bad blob leaves the volume untouched
+        with open(self.path, 'rb') as fp:
+            if fp.read(len(self.header)) != self.header:
+                raise FATException("FAT blob '%s' was replaced since it was opened" % self.path)
+            fp.seek(self.data_offset)
+            buf = bytearray(fp.read(self.clusters*self.cluster))
+        if len(buf) != self.clusters*self.cluster:
+            raise FATException("FAT blob '%s' is truncated" % self.path)
+        _replace(dest, self.nodes)
+        base = 0
+        if self.clusters:
+            fat = dest.fat
+            fat.map_compact()
+            base, n = fat.findfree(self.clusters)
+            if base < 0 or n < self.clusters:
+                if DEBUG&2: log("%s: no free run large enough", self)
+                return -1
+            rebase(buf, self.relocs, 0, base)
+            dest.boot.stream.seek(dest.boot.cl2offset(base))
+            dest.boot.stream.write(buf)
+            fat.mark_chains(base, self.chains)
+            fat.last_free_alloc = base + self.clusters - 1
+        _link(dest, self.nodes, base)
+        if DEBUG&2: log("%s spliced @%Xh", self, base)
+        return base
+
+
+def _replace(dest, nodes):
+    "Removes the items in 'dest' with the same names of top level nodes"
+    for node in nodes:
+        e = dest.find(node.name)
+        if not e: continue
+        if DEBUG&2: log("replacing '%s'", node.name)
+        if e.IsDir():
+            dest.rmtree(node.name)
+        else:
+            dest.erase(node.name)
+
+
+def _link(dest, nodes, base):
+    "Links top level nodes of a run starting at cluster 'base' into 'dest' table"
+    for node in nodes:
+        handle = dest._alloc(node.name)
+        e = handle.Entry
+        if node.clusters:
+            e.Start(base + node.start)
+        if node.is_dir:
+            e.chDOSPerms = 0x10
+        else:
+            e.dwFileSize = node.size
+        dest.stream.seek(e._pos)
+        dest.stream.write(e.pack())
+        dest._update_dirtable(e)
+
+
+def inject_in(src_list, dest, callback=None, chunk_size=1<<20):
+    """Copies files and directories in 'src_list' to virtual 'dest' directory
+    table like copy_in, but writes the whole set in one contiguous cluster run
+    with a few large sequential writes and a bulk FAT update. Items already in
+    'dest' with the same names get replaced. Falls back to copy_in on exFAT or
+    if no free run is large enough. 'src_list' may hold Node trees built
+    elsewhere, to spare scanning the host tree again."""
+    from FATtools.Volume import copy_in
+    nodes = scan_sources(src_list)
+    if dest.fat.exfat:
+        if DEBUG&2: log("inject_in: exFAT, falling back to copy_in")
+        return copy_in([node.path for node in nodes], dest, callback, chunk_size=chunk_size)
+    _replace(dest, nodes)
+    parent_start = 0
+    if dest.path != '.':
+        parent_start = dest.stream.start
+    plan = InjectionPlan(nodes, dest.boot.cluster, parent_start)
+    base = 0
+    if plan.clusters:
+        fat = dest.fat
+        fat.map_compact()
+        base, n = fat.findfree(plan.clusters)
+        if base < 0 or n < plan.clusters:
+            if DEBUG&2: log("inject_in: no free run of %d clusters, falling back to copy_in", plan.clusters)
+            return copy_in([node.path for node in nodes], dest, callback, chunk_size=chunk_size)
+        plan.write(dest.boot, base, callback, chunk_size)
+        fat.mark_chains(base, plan.chains)
+        fat.last_free_alloc = base + plan.clusters - 1
+    _link(dest, nodes, base)
+    if DEBUG&2: log("inject_in: %s injected @%Xh", plan, base)
+    return plan
+
+
+if __name__ == '__main__':
+    # Patches several file backed images at once, one thread each, to check
+    # that volumes share no state: python -m FATtools.inject [images] [MB]
+    import sys, io, time, shutil, tempfile, threading, contextlib
+    from FATtools import disk, mkfat
+    from FATtools.Volume import vopened
+
+    N = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    SIZE = (int(sys.argv[2]) if len(sys.argv) > 2 else 64) << 20
+
+    tmp = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmp, 'contents')
+        files = {}
+        for i in range(200):
+            rel = os.path.join('dir%d' % (i % 7), 'sub%d' % (i % 3), 'file %03d.dat' % i)
+            data = os.urandom(i * 997 % 70000)
+            os.makedirs(os.path.dirname(os.path.join(src, rel)), exist_ok=True)
+            open(os.path.join(src, rel), 'wb').write(data)
+            files[rel] = data
+        # a real 8.3 name sorting after the long name whose alias it looks like
+        for rel in ('abcdefghij.txt', 'abcdef~1.txt'):
+            data = os.urandom(1000)
+            open(os.path.join(src, rel), 'wb').write(data)
+            files[rel] = data
+
+        images = []
+        for i in range(N):
+            path = os.path.join(tmp, 'card%d.img' % i)
+            open(path, 'wb').truncate(SIZE)
+            d = disk.disk(path, 'r+b')
+            with contextlib.redirect_stdout(io.StringIO()):
+                mkfat.fat32_mkfs(d, d.size, params={'fat32_allows_few_clusters':1})
+            d.close()
+            images.append(path)
+
+        errors = []
+        def patch(path):
+            try:
+                with vopened(path, 'r+b') as root:
+                    inject_in([src], root)
+            except Exception as e:
+                errors.append((path, e))
+
+        t0 = time.time()
+        for path in images[:1]:
+            patch(path)
+        one = time.time() - t0
+        threads = [threading.Thread(target=patch, args=(path,)) for path in images]
+        t0 = time.time()
+        for t in threads: t.start()
+        for t in threads: t.join()
+        many = time.time() - t0
+
+        for path in images:
+            with vopened(path, 'rb') as root:
+                for rel, data in files.items():
+                    f = root.open(os.path.join('contents', rel).replace(os.sep, '/'))
+                    if f.IsValid == False or f.read() != data:
+                        errors.append((path, rel))
+                    f.close()
+                shorts = [e.ShortName().lower() for e in root.opendir('contents').iterator()]
+                if len(shorts) != len(set(shorts)):
+                    errors.append((path, 'duplicated short names'))
+
+        # a new version injected over a browsed tree must be reachable at once
+        for rel in files:
+            files[rel] = os.urandom(len(files[rel]) + 100)
+            open(os.path.join(src, rel), 'wb').write(files[rel])
+        def check(root, when):
+            for rel, data in files.items():
+                try:
+                    f = root.open(os.path.join('contents', rel).replace(os.sep, '/'))
+                except FATException:
+                    errors.append((images[0], rel, when))
+                    continue
+                if f.IsValid == False or f.read() != data:
+                    errors.append((images[0], rel, when))
+                f.close()
+        with vopened(images[0], 'r+b') as root:
+            for dir in ('contents/dir0', 'contents/dir0/sub0', 'contents/dir6/sub2'):
+                list(root.opendir(dir).iterator())
+            inject_in([src], root)
+            check(root, 'same session')
+        with vopened(images[0], 'rb') as root:
+            check(root, 'new session')
+        print("%d images patched in %.2fs (one alone: %.2fs), %d errors" % (N, many, one, len(errors)))
+        for e in errors[:10]:
+            print(e)
+        sys.exit(len(errors) > 0)
+    finally:
+        shutil.rmtree(tmp)
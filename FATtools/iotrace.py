@@ -0,0 +1,305 @@
+# -*- coding: cp1252 -*-
+#
+# I/O accounting for FATtools streams.
+#
+# A TracedStream wraps any stream (disk, partition, virtual disk Image, Chain,
+# even the raw file under a disk) and records, for the layer it is given, the
+# number of reads, writes and seeks, bytes moved, distance jumped between I/Os,
+# time spent and the call sites. Stacking one per layer shows where read or
+# write amplification comes from. Nothing is wrapped unless asked: with tracing
+# off FATtools runs its plain streams.
+#
+# Setting FATTOOLS_IOTRACE=<report.json> attaches the global tracer to every
+# volume opened by Volume.openvolume and dumps its report at exit.
+#
+
+import os, sys, time, json, atexit, weakref
+from collections import Counter
+from FATtools.debug import log
+
+DEBUG=int(os.getenv('FATTOOLS_DEBUG', '0'))
+IOTRACE=os.getenv('FATTOOLS_IOTRACE', '')
+
+
+# modules implementing streams: call sites are searched above them
+_STREAM_MODULES = ('disk.py', 'iotrace.py', 'vhdutils.py', 'vhdxutils.py', 'vdiutils.py', 'vmdkutils.py')
+
+def _caller(depth):
+    "Returns 'file:line function' of the first caller outside stream modules"
+    f = sys._getframe(depth+1)
+    while f.f_back and os.path.basename(f.f_code.co_filename) in _STREAM_MODULES:
+        f = f.f_back
+    return '%s:%d %s' % (os.path.basename(f.f_code.co_filename), f.f_lineno, f.f_code.co_name)
+
+
+class LayerStats(object):
+    "I/O counters of a layer"
+    def __init__(self, name):
+        self.name = name
+        self.reads = 0
+        self.read_bytes = 0
+        self.writes = 0
+        self.write_bytes = 0
+        self.seeks = 0 # seek calls
+        self.jumps = 0 # I/Os not starting where the previous one ended
+        self.jump_bytes = 0 # total distance of those jumps
+        self.time = 0.0 # seconds spent in read/write/seek
+        self.callers = Counter() # { 'file:line function': I/O calls }
+
+    def report(self, callers=10):
+        return {'reads':self.reads, 'read_bytes':self.read_bytes, 'writes':self.writes, 'write_bytes':self.write_bytes,
+        'seeks':self.seeks, 'jumps':self.jumps, 'jump_bytes':self.jump_bytes, 'time':round(self.time, 6),
+        'callers':dict(self.callers.most_common(callers))}
+
+
+class TracedStream(object):
+    "Wraps a stream, accounting its I/O to a Tracer layer. Other attributes pass through"
+    def __init__(self, stream, tracer, layer):
+        object.__setattr__(self, '_stream', stream)
+        object.__setattr__(self, '_stats', tracer.layer(layer))
+        object.__setattr__(self, '_next', None) # position following last I/O
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._stream, name, value)
+
+    def __str__(self):
+        return "Traced %s (%s)" % (self._stream, self._stats.name)
+
+    def _account(self, t0, n, written=False):
+        st = self._stats
+        st.time += time.perf_counter() - t0
+        st.callers[_caller(2)] += 1
+        if written:
+            st.writes += 1
+            st.write_bytes += n
+        else:
+            st.reads += 1
+            st.read_bytes += n
+
+    def _where(self, pos=None):
+        "Accounts a jump if the I/O (at 'pos' or current position) doesn't continue the previous one"
+        if pos is None:
+            pos = self._stream.tell()
+        if self._next is not None and pos != self._next:
+            self._stats.jumps += 1
+            self._stats.jump_bytes += abs(pos - self._next)
+        return pos
+
+    def seek(self, offset, whence=0):
+        t0 = time.perf_counter()
+        r = self._stream.seek(offset, whence)
+        self._stats.seeks += 1
+        self._stats.time += time.perf_counter() - t0
+        return r
+
+    def read(self, size=-1):
+        pos = self._where()
+        t0 = time.perf_counter()
+        s = self._stream.read(size)
+        self._account(t0, len(s))
+        object.__setattr__(self, '_next', pos+len(s))
+        return s
+
+    def readview(self, size=-1):
+        pos = self._where()
+        t0 = time.perf_counter()
+        s = self._stream.readview(size)
+        self._account(t0, len(s))
+        object.__setattr__(self, '_next', pos+len(s))
+        return s
+
+    def readinto(self, buf):
+        pos = self._where()
+        t0 = time.perf_counter()
+        n = self._stream.readinto(buf)
+        if n is None: n = len(buf) # win32_disk
+        self._account(t0, n)
+        object.__setattr__(self, '_next', pos+n)
+        return n
+
+    def write(self, s):
+        pos = self._where()
+        t0 = time.perf_counter()
+        r = self._stream.write(s)
+        self._account(t0, len(s), True)
+        object.__setattr__(self, '_next', pos+len(s))
+        return r
+
+    def read_at(self, offset, size=-1):
+        self._where(offset)
+        t0 = time.perf_counter()
+        s = self._stream.read_at(offset, size)
+        self._account(t0, len(s))
+        object.__setattr__(self, '_next', offset+len(s))
+        return s
+
+    def readinto_at(self, offset, buf):
+        self._where(offset)
+        t0 = time.perf_counter()
+        n = self._stream.readinto_at(offset, buf)
+        self._account(t0, n)
+        object.__setattr__(self, '_next', offset+n)
+        return n
+
+    def write_at(self, offset, s):
+        self._where(offset)
+        t0 = time.perf_counter()
+        r = self._stream.write_at(offset, s)
+        self._account(t0, len(s), True)
+        object.__setattr__(self, '_next', offset+len(s))
+        return r
+
+
+# Chains are created all over FAT and exFAT modules, so they are traced by
+# hooking Chain.read/readinto/write/readinto_at/write_at (only while some
+# volume is attached) and looking up the Tracer of the chain's volume
+_chain_tracers = weakref.WeakKeyDictionary() # { boot object: Tracer }
+_chain_methods = None # original Chain (read, write, readinto_at, write_at, readinto)
+
+def _chain_read(self, size=-1):
+    tracer = _chain_tracers.get(self.boot)
+    if tracer is None:
+        return _chain_methods[0](self, size)
+    t0 = time.perf_counter()
+    s = _chain_methods[0](self, size)
+    tracer._account_chain(t0, len(s), False)
+    return s
+
+def _chain_write(self, s):
+    tracer = _chain_tracers.get(self.boot)
+    if tracer is None:
+        return _chain_methods[1](self, s)
+    t0 = time.perf_counter()
+    r = _chain_methods[1](self, s)
+    tracer._account_chain(t0, len(s), True)
+    return r
+
+def _chain_readinto(self, buf):
+    tracer = _chain_tracers.get(self.boot)
+    if tracer is None:
+        return _chain_methods[4](self, buf)
+    t0 = time.perf_counter()
+    n = _chain_methods[4](self, buf)
+    tracer._account_chain(t0, n, False)
+    return n
+
+def _chain_readinto_at(self, offset, buf):
+    tracer = _chain_tracers.get(self.boot)
+    if tracer is None:
+        return _chain_methods[2](self, offset, buf)
+    t0 = time.perf_counter()
+    n = _chain_methods[2](self, offset, buf)
+    tracer._account_chain(t0, n, False)
+    return n
+
+def _chain_write_at(self, offset, s):
+    tracer = _chain_tracers.get(self.boot)
+    if tracer is None or offset + len(s) > self.size: # else accounted by write
+        return _chain_methods[3](self, offset, s)
+    t0 = time.perf_counter()
+    r = _chain_methods[3](self, offset, s)
+    tracer._account_chain(t0, len(s), True)
+    return r
+
+def _hook_chains():
+    global _chain_methods
+    from FATtools.FAT import Chain
+    if _chain_methods is None:
+        _chain_methods = (Chain.read, Chain.write, Chain.readinto_at, Chain.write_at, Chain.readinto)
+        Chain.read, Chain.write, Chain.readinto_at, Chain.write_at, Chain.readinto = \
+            _chain_read, _chain_write, _chain_readinto_at, _chain_write_at, _chain_readinto
+
+def _unhook_chains():
+    global _chain_methods
+    from FATtools.FAT import Chain
+    if _chain_methods is not None and not len(_chain_tracers):
+        Chain.read, Chain.write, Chain.readinto_at, Chain.write_at, Chain.readinto = _chain_methods
+        _chain_methods = None
+
+
+class Tracer(object):
+    "Collects per layer I/O statistics from TracedStreams"
+    def __init__(self):
+        self.layers = {} # { name: LayerStats }
+        self.started = time.time()
+
+    def layer(self, name):
+        if name not in self.layers:
+            self.layers[name] = LayerStats(name)
+        return self.layers[name]
+
+    def trace(self, stream, layer):
+        "Returns 'stream' wrapped in a TracedStream accounting to 'layer'"
+        if isinstance(stream, TracedStream): return stream
+        return TracedStream(stream, self, layer)
+
+    def attach(self, root):
+        """Stacks tracing on the layers of an opened volume, given its root
+        Dirtable: cluster chains of files and directories (chain), partition
+        (partition), disk (disk) and the OS file under it (file). Call it right
+        after opening the volume: streams already captured by other objects are
+        not traced."""
+        boot = root.boot
+        part = boot.stream
+        if isinstance(part, TracedStream): return
+        dsk = getattr(part, 'disk', None) # None if volume is in a plain disk
+        if dsk is None:
+            dsk, part = part, None
+        if hasattr(dsk, '_file') and not isinstance(dsk._file, TracedStream):
+            dsk._file = self.trace(dsk._file, 'file')
+            if getattr(dsk, '_fd', None) is not None and not dsk.direct:
+                dsk._fd = None # pread/pwrite would bypass the traced file (direct I/O needs them)
+        if part is not None:
+            part.disk = self.trace(dsk, 'disk')
+            top = self.trace(part, 'partition')
+        else:
+            top = self.trace(dsk, 'disk')
+        boot.stream = top
+        root.fat.stream = top
+        if 'bitmap' in boot.__dict__: # exFAT (boot objects raise KeyError on missing attributes)
+            boot.bitmap.stream = top
+        root.stream.chain.stream = top # under the DirBuffer
+        _chain_tracers[boot] = self
+        _hook_chains()
+        if DEBUG&2: log("iotrace: attached to %s", root)
+
+    def detach(self, root):
+        "Stops tracing file and directory (chain) I/O of a volume; wrapped streams stay as they are"
+        _chain_tracers.pop(root.boot, None)
+        _unhook_chains()
+
+    def _account_chain(self, t0, n, written):
+        st = self.layer('chain')
+        st.time += time.perf_counter() - t0
+        st.callers[_caller(2)] += 1
+        if written:
+            st.writes += 1
+            st.write_bytes += n
+        else:
+            st.reads += 1
+            st.read_bytes += n
+
+    def report(self):
+        "Returns a dictionary with the statistics of every layer"
+        return {'elapsed':round(time.time()-self.started, 6), 'layers':{k:v.report() for k,v in self.layers.items()}}
+
+    def dump(self, path):
+        "Writes the report as JSON"
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=1)
+
+    def __str__(self):
+        s = "%-10s %8s %12s %8s %12s %8s %8s %9s\n" % ('layer', 'reads', 'read bytes', 'writes', 'write bytes', 'seeks', 'jumps', 'time')
+        for name, st in self.layers.items():
+            s += "%-10s %8d %12d %8d %12d %8d %8d %8.3fs\n" % (name, st.reads, st.read_bytes, st.writes, st.write_bytes, st.seeks, st.jumps, st.time)
+        return s
+
+
+tracer = None # global tracer, if FATTOOLS_IOTRACE is set
+
+if IOTRACE:
+    tracer = Tracer()
+    atexit.register(tracer.dump, IOTRACE)
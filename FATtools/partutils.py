@@ -161,6 +161,7 @@ class MBR_Partition(object):
         return 512 * self.dwTotalSectors
 
 
+@utils.layout_class
 class MBR(object):
     "Master (or DOS Extended) Boot Record Sector"
     layout = { # { offset: (name, unpack string) }
@@ -174,13 +175,9 @@ class MBR(object):
         self.stream = stream
         self.heads_per_cyl = 0 # Heads Per Cylinder (disk based)
         self.is_lba = 0
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
         self.partitions = []
         self.heads_per_cyl = size2chs(disksize, True)[1] # detects disk geometry, size based
         if DEBUG&1: log("Calculated Heads Per Cylinder: %d", self.heads_per_cyl)
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
         for i in range(2): # Part. 2-3 unused in DOS
             self.partitions += [MBR_Partition(self._buf, index=i)]
             self.partitions[-1].heads_per_cyl = self.heads_per_cyl
@@ -1,5 +1,5 @@
 # -*- coding: cp1252 -*-
-import io, struct
+import io, struct, threading
 
 class myfile(io.FileIO):
     "Wrapper for file object whose read member returns a bytearray"
@@ -9,6 +9,49 @@ class myfile(io.FileIO):
     def read(self, size=-1):
         return bytearray(super(myfile, self).read(size))
 
+_pio_guard = threading.Lock()
+
+class PositionalIO(object):
+    """Mixin giving a seek based stream positional read_at, readinto_at and
+    write_at, which leave its position alone. This fallback moves and restores
+    the position under a per object lock (so it is atomic against other
+    positional calls only): streams able to do better override it."""
+    def _pio_lock(self):
+        lock = self.__dict__.get('_pio_lock_')
+        if lock is None:
+            with _pio_guard:
+                lock = self.__dict__.setdefault('_pio_lock_', threading.RLock())
+        return lock
+
+    def _pio_restore(self, pos):
+        if '_pos' in self.__dict__:
+            self._pos = pos # virtual disk images: their seek refuses the end position
+        else:
+            self.seek(pos)
+
+    def read_at(self, offset, size=-1):
+        with self._pio_lock():
+            pos = self.tell()
+            try:
+                self.seek(offset)
+                return self.read(size)
+            finally:
+                self._pio_restore(pos)
+
+    def readinto_at(self, offset, buf):
+        s = self.read_at(offset, len(buf))
+        buf[:len(s)] = s
+        return len(s)
+
+    def write_at(self, offset, s):
+        with self._pio_lock():
+            pos = self.tell()
+            try:
+                self.seek(offset)
+                self.write(s)
+            finally:
+                self._pio_restore(pos)
+
 def is_vdisk(s):
     "Returns the base virtual disk image path if it contains a known extension or an empty string"
     image_path=''
@@ -31,6 +74,41 @@ def class2str(c, s):
         s += '%x: %s = %s\n' % (key, o, v)
     return s
 
+class Field(object):
+    """Descriptor of a layout field: decodes it from the object's buffer at first
+    access and stores it in the object, which then bypasses the descriptor"""
+    def __init__(self, name, offset, fmt):
+        self.name = name
+        self.offset = offset
+        self.unpack_from = struct.Struct(fmt).unpack_from
+
+    def __get__(self, obj, cls=None):
+        if obj is None: return self
+        v = self.unpack_from(obj._buf, self.offset)[0]
+        obj.__dict__[self.name] = v
+        return v
+
+def compile_layout(layout, base=0):
+    "Returns the { offset: (name, unpack string) } and { name: offset } maps of a layout, its offsets moved by 'base'"
+    kv = {}
+    for k, v in layout.items():
+        kv[k+base] = v
+    vk = {} # { name: offset}
+    for k, v in kv.items():
+        vk[v[0]] = k
+    return kv, vk
+
+def layout_class(cls=None, base=0):
+    """Class decorator: compiles the class layout once into _kv and _vk maps
+    shared by its objects, and a Field for each name, so that objects don't
+    build them and fields are decoded without calling __getattr__"""
+    if cls is None:
+        return lambda cls: layout_class(cls, base)
+    cls._kv, cls._vk = compile_layout(cls.layout, base)
+    for k, v in cls._kv.items():
+        setattr(cls, v[0], Field(v[0], k, v[1]))
+    return cls
+
 def common_getattr(c, name):
     "Decodes and stores an attribute following special class layout"
     i = c._vk[name]
@@ -34,6 +34,7 @@ from FATtools.utils import myfile
 
 
 
+@utils.layout_class
 class Header(object):
     "VDI 1.1 Header"
     layout = { # { offset: (name, unpack string) }
@@ -72,10 +73,6 @@ class Header(object):
         self._pos = offset # base offset
         self._buf = s or bytearray(512)
         self.stream = stream
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
     
     __getattr__ = utils.common_getattr
 
@@ -184,7 +181,7 @@ class BAT(object):
 
 
 
-class Image(object):
+class Image(utils.PositionalIO):
     def __init__ (self, name, mode='rb'):
         atexit.register(self.close)
         self.tstamp = os.stat(name).st_mtime # records last mod time stamp
@@ -41,6 +41,7 @@ from FATtools.utils import myfile
 
 
 
+@utils.layout_class
 class Footer(object):
     "VHD Footer"
     layout = { # { offset: (name, unpack string) }
@@ -67,10 +68,6 @@ class Footer(object):
         self._pos = offset # base offset
         self._buf = s or bytearray(512)
         self.stream = stream
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
     
     __getattr__ = utils.common_getattr
 
@@ -101,6 +98,7 @@ class Footer(object):
 
 
 
+@utils.layout_class
 class DynamicHeader(object):
     "Dynamic Disk Header"
     layout = { # { offset: (name, unpack string) }
@@ -124,10 +122,6 @@ class DynamicHeader(object):
         self._pos = offset # base offset
         self._buf = s or bytearray(1024)
         self.stream = stream
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
         self.locators = []
         for i in range(8):
             j = 0x240+i*24
@@ -258,6 +252,7 @@ class BAT(object):
 
 
 
+@utils.layout_class
 class ParentLocator(object):
     "Element in the Dynamic Header Parent Locators array"
     layout = { # { offset: (name, unpack string) }
@@ -272,10 +267,6 @@ class ParentLocator(object):
         self._i = 0
         self._pos = 0
         self._buf = s
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
     
     __getattr__ = utils.common_getattr
 
@@ -342,7 +333,7 @@ class BlockBitmap(object):
 
 
 
-class Image(object):
+class Image(utils.PositionalIO):
     def __init__ (self, name, mode='rb'):
         self._pos = 0 # offset in virtual stream
         self.size = 0 # size of virtual stream
@@ -28,6 +28,7 @@ def global_crc(self):
     return c_crc
 
 
+@utils.layout_class
 class ZeroDescriptor(object):
     "Log Zero descriptor"
     layout = { # { offset: (name, unpack string) }
@@ -43,10 +44,6 @@ class ZeroDescriptor(object):
         self._pos = offset # base offset
         self._buf = s or bytearray(32)
         self.stream = stream
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
     
     def __str__ (self):
         return utils.class2str(self, "VHDX Log Zero Descriptor @%X\n" % self._pos)
@@ -71,6 +68,7 @@ class ZeroDescriptor(object):
         return 1
 
 
+@utils.layout_class
 class DataDescriptor(object):
     "Log Data descriptor"
     layout = { # { offset: (name, unpack string) }
@@ -87,10 +85,6 @@ class DataDescriptor(object):
         self._pos = offset # base offset
         self._buf = s or bytearray(32)
         self.stream = stream
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
     
     def __str__ (self):
         return utils.class2str(self, "VHDX Log Data Descriptor @%X\n" % self._pos)
@@ -117,6 +111,7 @@ class DataDescriptor(object):
         return 1
 
 
+@utils.layout_class
 class DataSector(object):
     "Log Data sector"
     layout = { # { offset: (name, unpack string) }
@@ -131,10 +126,6 @@ class DataSector(object):
         self._pos = offset # base offset
         self._buf = s or bytearray(32)
         self.stream = stream
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
     
     def __str__ (self):
         return utils.class2str(self, "VHDX Log Data Sector @%X\n" % self._pos)
@@ -153,6 +144,7 @@ class DataSector(object):
         return 1
 
 
+@utils.layout_class
 class LogEntryHeader(object):
     "Log Entry header and sequence"
     layout = { # { offset: (name, unpack string) }
@@ -173,10 +165,6 @@ class LogEntryHeader(object):
         self._pos = offset # base offset
         self._buf = s or bytearray(4096)
         self.stream = stream
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
     
     __getattr__ = utils.common_getattr
 
@@ -161,6 +161,7 @@ uuid.UUID('a8d35f2d-b30b-454d-abf7-d3d84834ab0c'): ('Parent Locator', parent_loc
 
 
 
+@utils.layout_class
 class FileTypeIdentifier(object):
     "File Type Identifier"
     layout = { # { offset: (name, unpack string) }
@@ -173,10 +174,6 @@ class FileTypeIdentifier(object):
         self._pos = offset # base offset
         self._buf = s or bytearray(65536)
         self.stream = stream
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
     
     __getattr__ = utils.common_getattr
 
@@ -195,6 +192,7 @@ class FileTypeIdentifier(object):
         return 0
 
 
+@utils.layout_class
 class VHDXHeader(object):
     "VHDX Header"
     layout = { # { offset: (name, unpack string) }
@@ -216,10 +214,6 @@ class VHDXHeader(object):
         self._pos = offset # base offset
         self._buf = s or bytearray(4096)
         self.stream = stream
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
     
     __getattr__ = utils.common_getattr
 
@@ -245,6 +239,7 @@ class VHDXHeader(object):
         return 1
 
 
+@utils.layout_class
 class RegionTableHeader(object):
     "Region Table Header"
     layout = { # { offset: (name, unpack string) }
@@ -259,10 +254,6 @@ class RegionTableHeader(object):
         self._pos = offset # base offset
         self._buf = s or bytearray(65536)
         self.stream = stream
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
         self.entries = []
         self.metadata_offset = 0
         self.BAT_offset = 0
@@ -313,6 +304,7 @@ class RegionTableHeader(object):
         return 1
 
 
+@utils.layout_class
 class RegionTableEntry(object):
     "Region Table Entry"
     layout = { # { offset: (name, unpack string) }
@@ -328,10 +320,6 @@ class RegionTableEntry(object):
         self._pos = offset # base offset
         self._buf = s or bytearray(32)
         self.stream = stream
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
     
     __getattr__ = utils.common_getattr
 
@@ -345,6 +333,7 @@ class RegionTableEntry(object):
         return utils.class2str(self, "VHDX Region Table Entry @%X\n" % self._pos)
 
 
+@utils.layout_class
 class MetadataTableHeader(object):
     "Metadata Table Header"
     layout = { # { offset: (name, unpack string) }
@@ -359,10 +348,6 @@ class MetadataTableHeader(object):
         self._pos = offset # base offset
         self._buf = s or bytearray(32)
         self.stream = stream
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
         self.entries = []
 
     __getattr__ = utils.common_getattr
@@ -406,6 +391,7 @@ class MetadataTableHeader(object):
         return 1
 
 
+@utils.layout_class
 class MetadataEntry(object):
     "Metadata Entry"
     layout = { # { offset: (name, unpack string) }
@@ -420,10 +406,6 @@ class MetadataEntry(object):
         self._pos = offset # base offset
         self._buf = s or bytearray(32)
         self.stream = stream
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
     
     __getattr__ = utils.common_getattr
 
@@ -444,6 +426,7 @@ class MetadataEntry(object):
         return 1
 
 
+@utils.layout_class
 class ParentLocator(object):
     "Parent Locator"
     layout = { # { offset: (name, unpack string) }
@@ -457,10 +440,6 @@ class ParentLocator(object):
         self._pos = offset # base offset
         self._buf = s or bytearray(20)
         self.stream = stream
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
         self.entries = {}
 
     __getattr__ = utils.common_getattr
@@ -659,7 +638,7 @@ class BlockBitmap(object):
             if DEBUG&16: log("set B={0:08b}".format(B))
 
 
-class Image(object):
+class Image(utils.PositionalIO):
     def __init__ (self, name, mode='rb', _fparams=0):
         # Flags for GUID updates at first write operation
         self.updated_file_guid = 0
@@ -94,6 +94,7 @@ def calc_ext_meta_size(size, grainsize=65536):
 
 
 
+@utils.layout_class
 class Header(object):
     "VMDK Sparse Header"
     layout = { # { offset: (name, unpack string) }
@@ -122,10 +123,6 @@ class Header(object):
         self._pos = offset # base offset
         self._buf = s or bytearray(512)
         self.stream = stream
-        self._kv = self.layout.copy()
-        self._vk = {} # { name: offset}
-        for k, v in list(self._kv.items()):
-            self._vk[v[0]] = k
     
     __getattr__ = utils.common_getattr
 
@@ -394,7 +391,7 @@ class Extent(object):
 
 
 
-class Image(object):
+class Image(utils.PositionalIO):
     "Handles a VMDK disk image made by extents"
     def __init__ (self, name, mode='rb'):
         atexit.register(self.close)
@@ -473,6 +470,9 @@ class Image(object):
         if self._pos >= self.size:
             raise BaseException("%s: can't seek @0x%X past disk end!" % (self.name, self._pos))
 
+    def tell(self):
+        return self._pos
+
     # To read from parent an extent has to know its parent
     def read(self, size=-1):
         if size == -1 or self._pos + size > self.size:
@@ -6,7 +6,7 @@ import os
 import wmi
 import pythoncom
 
-from image_edit import add_contents_to_raw_disk
+from image_edit import add_contents_to_raw_disk,refresh_contents
 import rawdisk
 
 class ImageBurner:
@@ -143,13 +143,13 @@ class ImageBurner:
         else:
             return False
 
-    def _burn_thread(self,source_image,target_disk,id,contents_only,prepatched):
+    def _burn_thread(self,source_image,target_disk,id,contents_only,prepatched,init_files,manifests):
         try:
             if not contents_only:
                 self.burns[id]["text"]="Burning image"
                 rawdisk.copy_to_disk(source_image,target_disk,self._burn_progress,id)
             self.burns[id]["text"]="Copying contents"
-            add_contents_to_raw_disk(target_disk,prepatched)
+            add_contents_to_raw_disk(target_disk,prepatched,init_files,manifests=manifests)
             if not contents_only:
                 self.burns[id]["output"]="Burnt and patched successfully"
             else:
@@ -164,7 +164,10 @@ class ImageBurner:
         self.burns[id]["finished"]=True
         self.event.set()
 
-    def burn_image_to_disk(self,source_image=None,target_disk=None,contents_only=False,prepatched=False):
+    def burn_image_to_disk(self,source_image=None,target_disk=None,contents_only=False,prepatched=False,init_files={},manifests=None):
+        # manifests are refreshed here, not in the burn threads, which share them
+        if manifests is None:
+            manifests=refresh_contents()
         id=self.next_id
         self.next_id+=1
         self.burns[id]={}
@@ -174,7 +177,7 @@ class ImageBurner:
         self.burns[id]["finished"]=False
         self.burns[id]["total_size"]=total_size
         self.burns[id]["target"]=target_disk
-        self.burns[id]["thd"]=threading.Thread(target=self._burn_thread,args=[source_image,target_disk,id,contents_only,prepatched],daemon=True)
+        self.burns[id]["thd"]=threading.Thread(target=self._burn_thread,args=[source_image,target_disk,id,contents_only,prepatched,init_files,manifests],daemon=True)
         self.burns[id]["updated"]=True
         self.burns[id]["bytes_transferred"]=0
         self.burns[id]["thd"].start()
@@ -1,11 +1,162 @@
 from pathlib import Path
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from FATtools.inject import Node
+
+MANIFEST_VERSION = 1
+# files modified this close to the last manifest save can't be trusted by mtime
+RACY_NS = 2 * 1000000000
+
+
+def _needs_fixing(f):
+    return f.suffix in [".sh", ".py", ".local"] or f.name in [".gitattributes", "authorized_keys"]
+
+
+def _fix_file(f):
+    bytes = f.read_bytes()
+    if _needs_fixing(f) and bytes.find(b"\r\n") != -1:
+        text = f.read_text()
+        print("Fixing line endings:", f)
+        f.write_text(text, newline="\n")
+        bytes = f.read_bytes()
+    return bytes
+
+
+class ContentManifest:
+    """Manifest of a contents tree with line endings fixed, keyed on path, size and mtime
+
+    Stored as json next to the tree (e.g. .contents.manifest.json). refresh() only
+    reads (and fixes) files whose size or mtime changed since the last refresh, so
+    the tree can be handed to FATtools without walking or reading it again.
+    """
+
+    def __init__(self, directory_name, manifest_path=None):
+        self.root = Path(directory_name)
+        if manifest_path is None:
+            manifest_path = self.root.parent / ("." + self.root.name + ".manifest.json")
+        self.manifest_path = Path(manifest_path)
+        # { relative posix path: {"dir": True} or {"size", "mtime_ns", "sha256"} }
+        self.entries = {}
+        self.saved_ns = 0
+        try:
+            data = json.loads(self.manifest_path.read_text())
+            if data.get("version") == MANIFEST_VERSION:
+                self.entries = data["entries"]
+                self.saved_ns = data["saved_ns"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def refresh(self):
+        "Brings the manifest up to date with the tree, fixing changed files. Returns number of changed entries"
+        changed = 0
+        racy = 0  # files read again only because they were racy
+        seen = set()
+        stack = [self.root]
+        while stack:
+            dir = stack.pop()
+            for it in os.scandir(dir):
+                rel = Path(it.path).relative_to(self.root).as_posix()
+                seen.add(rel)
+                if it.is_dir():
+                    stack.append(it.path)
+                    if rel not in self.entries:
+                        self.entries[rel] = {"dir": True}
+                        changed += 1
+                    continue
+                if not it.is_file():
+                    continue
+                st = it.stat()
+                old = self.entries.get(rel)
+                if (
+                    old
+                    and not old.get("dir")
+                    and old["size"] == st.st_size
+                    and old["mtime_ns"] == st.st_mtime_ns
+                    and st.st_mtime_ns < self.saved_ns - RACY_NS
+                ):
+                    continue
+                bytes = _fix_file(Path(it.path))
+                st = os.stat(it.path)
+                entry = {
+                    "size": len(bytes),
+                    "mtime_ns": st.st_mtime_ns,
+                    "sha256": hashlib.sha256(bytes).hexdigest(),
+                }
+                if entry != old:
+                    changed += 1
+                else:
+                    racy += 1
+                self.entries[rel] = entry
+        for rel in list(self.entries):
+            if rel not in seen:
+                del self.entries[rel]
+                changed += 1
+        if changed or racy:
+            # a later saved_ns lets racy files be trusted by mtime next time
+            self.save()
+        return changed
+
+    def save(self):
+        self.saved_ns = time.time_ns()
+        # a unique temporary name, so that concurrent savers don't replace each other's file
+        with tempfile.NamedTemporaryFile(
+            "w",
+            dir=self.manifest_path.parent,
+            prefix=self.manifest_path.name + ".",
+            suffix=".tmp",
+            delete=False,
+        ) as tmp:
+            tmp.write(
+                json.dumps(
+                    {"version": MANIFEST_VERSION, "saved_ns": self.saved_ns, "entries": self.entries},
+                    sort_keys=True,
+                )
+            )
+        try:
+            os.replace(tmp.name, self.manifest_path)
+        except OSError:
+            os.remove(tmp.name)
+            raise
+
+    def walk(self):
+        "Yields (relative path, entry) in path order"
+        for rel in sorted(self.entries):
+            yield rel, self.entries[rel]
+
+    def digest(self):
+        "Hash of the whole normalised tree (names and contents)"
+        h = hashlib.sha256()
+        for rel, entry in self.walk():
+            h.update(rel.encode("utf-8") + b"\0")
+            h.update(b"<dir>" if entry.get("dir") else entry["sha256"].encode("ascii"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def tree(self):
+        "Returns the tree as a FATtools.inject Node, without touching the disk"
+        top = Node(self.root.name, str(self.root), is_dir=True)
+        dirs = {"": top}
+        for rel, entry in self.walk():
+            parent, _, name = rel.rpartition("/")
+            path = str(self.root / rel)
+            if entry.get("dir"):
+                node = Node(name, path, is_dir=True)
+                dirs[rel] = node
+            else:
+                node = Node(name, path, entry["size"])
+            dirs[parent].children.append(node)
+        for node in dirs.values():
+            # FAT names are case insensitive: the last one wins, like copy_in
+            names = {}
+            for child in sorted(node.children, key=lambda x: x.name):
+                names[child.name.lower()] = child
+            node.children = list(names.values())
+        return top
+
 
 def fix_line_endings(directory_name):
-    for f in Path(directory_name).glob("**/*"):
-        ext=f.suffix
-        if ext in [".sh",".py",".local"] or f.name in [".gitattributes","authorized_keys"]:
-            bytes=f.read_bytes()
-            if bytes.find(b"\r\n")!=-1:
-                text=f.read_text()
-                print("Fixing line endings:",f)
-                f.write_text(text,newline="\n")
\ No newline at end of file
+    ContentManifest(directory_name).refresh()
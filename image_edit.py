@@ -9,14 +9,26 @@ import struct
 import re
 import os
 import stat
+import threading
 from FATtools.Volume import *
 from FATtools.partutils import MBR
+from FATtools.inject import inject_in, InjectionPlan, FATBlob
+from FATtools.FAT import FATException
 from glob import glob
-from fixcontents import fix_line_endings
+from fixcontents import fix_line_endings, ContentManifest
 
 # if this is false, we're using wpa_supplicant.conf files
 USE_NETWORK_MANAGER = True
 
+# files made per burn by create_init_files, which go in the root of the boot
+# partition next to installscripts/* - stale copies in installscripts are ignored
+INIT_FILES = [
+    "userconf.txt",
+    "setup_dss_mac_address.sh",
+    "init_task.sh",
+    "wpa_supplicant.conf",
+]
+
 
 def hard_delete(redo_function, path, excinfo):
     if os.path.exists(path):
@@ -38,8 +50,11 @@ class FatDiskPath:
     def write_text(self, str, newline="\n"):
         str = str.replace("\r\n", newline)
         str = str.replace("\n", newline)
+        self.write_bytes(str.encode("utf-8"))
+
+    def write_bytes(self, data):
         fp = self.root.create(self.file)
-        fp.write(str.encode("utf-8"))
+        fp.write(data)
         fp.close()
 
     def read_text(self):
@@ -49,23 +64,75 @@ class FatDiskPath:
         return data.decode("utf-8")
 
 
-def add_contents_to_raw_disk(device_name, prepatched):
-    fix_line_endings("contents")
-    fix_line_endings("installscripts")
-    v = vopen(device_name, mode="r+b", what="partition0")
-    print(v, type(v))
-    root = v.open()
-    x = str(root.dirtable)
+# burn threads share the contents blobs: only one checks or builds them at a time
+_blob_lock = threading.Lock()
+
 
-    install_scripts = glob("installscripts/*")
-    copy_in(["contents"] + install_scripts, root)
-    if not prepatched:
-        add_dynamic_files(FatDiskPath(root=root))
-    root.close()
-    vclose(v)
+def _splice_contents(contents, root):
+    # contents are the same on every card, so they are laid out once in a blob
+    # (per cluster size) that gets spliced in with a single write
+    blob_path = ".%s.%d.fatblob" % (contents.root.name, root.boot.cluster)
+    tag = bytes.fromhex(contents.digest())
+    with _blob_lock:
+        try:
+            blob = FATBlob(blob_path)
+            if blob.tag != tag:
+                blob = None
+        except (OSError, FATException):
+            blob = None
+        if blob is None:
+            print("Building contents blob:", blob_path)
+            InjectionPlan([contents.tree()], root.boot.cluster).save(blob_path, tag)
+            blob = FATBlob(blob_path)
+    return blob.splice(root) >= 0
 
 
-def add_contents_to_card(device_name):
+@contextmanager
+def open_boot_partition(device_name, in_memory=True):
+    "Yields the root directory of the boot partition, patched in RAM and written back in one pass if in_memory"
+    if in_memory:
+        with vopened_in_ram(device_name, what="partition0") as root:
+            yield root
+    else:
+        with vopened(device_name, mode="r+b", what="partition0") as v:
+            with v.open() as root:
+                yield root
+
+
+def refresh_contents():
+    "Returns the contents and installscripts manifests, brought up to date (fixing line endings)"
+    contents = ContentManifest("contents")
+    contents.refresh()
+    install_scripts = ContentManifest("installscripts")
+    install_scripts.refresh()
+    return contents, install_scripts
+
+
+def add_contents_to_raw_disk(
+    device_name, prepatched, init_files={}, in_memory=True, manifests=None
+):
+    # concurrent burns get the manifests refreshed once by the caller, as the
+    # refresh rewrites files with fixed line endings and saves the manifests
+    contents, install_scripts = manifests or refresh_contents()
+    # skip hidden files, like glob("installscripts/*")
+    install_nodes = [
+        n
+        for n in install_scripts.tree().children
+        if not n.name.startswith(".") and n.name not in INIT_FILES
+    ]
+    with open_boot_partition(device_name, in_memory) as root:
+        if not _splice_contents(contents, root):
+            # lay out the whole tree in one contiguous run, rather than file by file
+            inject_in([contents.tree()], root)
+        inject_in(install_nodes, root)
+        drive_path = FatDiskPath(root=root)
+        for name, data in init_files.items():
+            (drive_path / name).write_bytes(data)
+        if not prepatched:
+            add_dynamic_files(drive_path)
+
+
+def add_contents_to_card(device_name, init_files={}):
     fix_line_endings("contents")
     fix_line_endings("installscripts")
     volume_re = r"\* Volume \d+\s+([A-z]).*"
@@ -104,7 +171,7 @@ def add_contents_to_card(device_name):
     if drive_letter is None:
         raise RuntimeError("Couldn't find drive letter")
     print("Drive letter:", drive_letter)
-    add_contents_to_mounted_drive(drive_letter)
+    add_contents_to_mounted_drive(drive_letter, init_files)
 
 
 def _add_setting(key, value, config_txt):
@@ -186,24 +253,36 @@ def add_dynamic_files(drive_path):
     imgdate_file.write_text(git_time.strftime("%d%m%Y"))
 
 
-def add_contents_to_mounted_drive(drive_letter):
+def add_contents_to_mounted_drive(drive_letter, init_files={}):
     drive_path = Path(f"{drive_letter}:\\")
     if os.path.exists(drive_path / "contents"):
         shutil.rmtree(drive_path / "contents", onerror=hard_delete)
     shutil.copytree("./contents", f"{drive_letter}:\\contents\\", dirs_exist_ok=True)
-    shutil.copytree("./installscripts", f"{drive_letter}:\\", dirs_exist_ok=True)
+    shutil.copytree(
+        "./installscripts",
+        f"{drive_letter}:\\",
+        dirs_exist_ok=True,
+        ignore=shutil.ignore_patterns(*INIT_FILES),
+    )
+    for name, data in init_files.items():
+        (drive_path / name).write_bytes(data)
     add_dynamic_files(drive_path)
 
 
 def create_init_files(options):
+    """Makes the per burn files for the root of the boot partition
+
+    Returns a dict of {file name: contents as bytes}. Nothing is written to
+    installscripts, so several cards can be patched at once with different options.
+    """
+    init_files = {}
     if options.labimage == True:
-        shutil.copyfile("userconf.lab.conf", "installscripts/userconf.txt")
-        shutil.copyfile(
-            "setup_dss_mac_address.sh", "installscripts/setup_dss_mac_address.sh"
+        init_files["userconf.txt"] = Path("userconf.lab.conf").read_bytes()
+        init_files["setup_dss_mac_address.sh"] = (
+            Path("setup_dss_mac_address.sh").read_bytes().replace(b"\r\n", b"\n")
         )
     else:
-        shutil.copyfile("userconf.student.conf", "installscripts/userconf.txt")
-        os.unlink("installscripts/setup_dss_mac_address.sh")
+        init_files["userconf.txt"] = Path("userconf.student.conf").read_bytes()
 
     task_text = """#!/bin/bash
 
@@ -212,12 +291,11 @@ cp -rf $SCRIPT_PATH/contents/home/* /home
 
 iw reg set GB
 """
-    task_script = Path(__file__).parent / "installscripts" / "init_task.sh"
 
     if USE_NETWORK_MANAGER:
         task_text += create_network_manager_connections(options)
     else:
-        task_text += create_wpa_supplicant(options)
+        task_text += create_wpa_supplicant(options, init_files)
 
     task_text += "\nnmcli conn reload\n"
     # change user password (this fails on new card because raspberry pi init does it)
@@ -228,7 +306,8 @@ iw reg set GB
         task_text += "\nrm /etc/ssh/ssh_host*\nsudo ssh-keygen -A\n"
         # run afterUpdate on first run
         task_text += "\nbash /home/pi/grove-startup-scripts/afterUpdate.sh\n"
-    task_script.write_text(task_text, newline="\n")
+    init_files["init_task.sh"] = task_text.replace("\r\n", "\n").encode("utf-8")
+    return init_files
 
 
 def create_network_manager_connections(options):
@@ -247,18 +326,15 @@ bash create_networks.sh '{options.wifiname}' '{options.wifipw}' WPA
 """
 
 
-def create_wpa_supplicant(options):
-    conf_file = Path(__file__).parent / "installscripts" / "wpa_supplicant.conf"
-    conf_file.parent.mkdir(exist_ok=True, parents=True)
-
+def create_wpa_supplicant(options, init_files):
     if options.labimage == True:
-        shutil.copyfile("wpa_supplicant.lab.conf", conf_file)
+        init_files["wpa_supplicant.conf"] = Path("wpa_supplicant.lab.conf").read_bytes()
     else:
         if options.hash:
             unipw = "hash:" + lmhash.hash(options.unipw)
         else:
             unipw = f'"{options.unipw}"'
-        conf_file.write_text(
+        init_files["wpa_supplicant.conf"] = (
             """
 ctrl_interface=DIR=/var/run/wpa_supplicant GROUP=netdev
 country=GB
@@ -294,9 +370,8 @@ group=CCMP TKIP
 psk="%s"
 }
 """
-            % (options.uniname, unipw, options.wifiname, options.wifipw),
-            newline="\n",
-        )
+            % (options.uniname, unipw, options.wifiname, options.wifipw)
+        ).encode("utf-8")
     return "\ncp $SCRIPT_PATH/wpa_supplicant.conf /etc/wpa_supplicant/wpa_supplicant.conf\n"
 
 
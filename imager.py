@@ -32,9 +32,7 @@ import image_edit
 from image_shrink import shrink_image
 import os
 from pathlib import Path
-from lzma import LZMADecompressor, LZMACompressor
-from zipfile import ZipFile
-import shutil
+import imagesource
 import sys
 from datetime import date
 
@@ -191,7 +189,8 @@ class BurnReadyFrame(EscapeFrame):
         # make image
         # start burn (on first drive or on all drives depending on type)
         self.dataholder.burner.clear()
-        image_edit.create_init_files(self.dataholder)
+        init_files = image_edit.create_init_files(self.dataholder)
+        manifests = image_edit.refresh_contents()
         for disk, model, location in self.dataholder.burner.get_all_disks():
             if self.dataholder.prepatched_image:
                 source = "raspios_prepatched.img"
@@ -202,6 +201,8 @@ class BurnReadyFrame(EscapeFrame):
                 target_disk=disk,
                 contents_only=self.dataholder.contents_only,
                 prepatched=self.dataholder.prepatched_image,
+                init_files=init_files,
+                manifests=manifests,
             )
         raise NextScene("burn")
 
@@ -562,7 +563,7 @@ class UpdateImageFrame(EscapeFrame):
             root=".",
             height=screen.height - 4,
             name="image_file_chooser",
-            file_filter=".*(.xz|.zip|.img)$",
+            file_filter=imagesource.FILE_FILTER,
             on_select=self.copy_image,
         )
         progress_layout = Layout([100], False)
@@ -586,6 +587,24 @@ class UpdateImageFrame(EscapeFrame):
 
         super().update(frame)
 
+    def _unpack_progress(self, compressed_pos, compressed_size, uncompressed_pos):
+        progress = int(40 * (compressed_pos / max(compressed_size, 1)))
+        new_progress_text = (
+            "Progress: "
+            + ("*" * progress)
+            + (
+                "." * (40 - progress)
+                + " Unpacking %d/%d MB (%d MB unpacked)"
+                % (compressed_pos / 1048576, compressed_size / 1048576, uncompressed_pos / 1048576)
+            )
+        )
+        if self.progress.text != new_progress_text:
+            self.progress.text = new_progress_text
+            self.screen.refresh()
+            self.screen.force_update()
+            self.screen.draw_next_frame()
+        return True
+
     def copy_image(self):
         self.writing = True
         img = self.file_chooser.value
@@ -597,61 +616,18 @@ class UpdateImageFrame(EscapeFrame):
         else:
             target_path = "raspios.img"
         self.file_layout.clear_widgets()
-        if img.endswith(".img"):
-            if os.path.abspath(img) != os.path.abspath(target_path):
-                shutil.copyfile(img, target_path)
-        elif img.endswith(".zip"):
-            # assume biggest file in zip is image
-            f_size = 0
-            f_img = ""
-            with ZipFile(img) as z:
-                for info in z.infolist():
-                    if info.file_size > f_size:
-                        f_size = info.file_size
-                        f_img = info.filename
-                with z.open(f_img) as zf:
-                    with open(target_path, "wb") as outfile:
-                        shutil.copyfileobj(zf, outfile)
-        elif img.endswith(".xz"):
-            with open(img, "rb") as infile:
-                with open(target_path, "wb") as outfile:
-                    dc = LZMADecompressor()
-                    total_len = os.stat(img).st_size
-                    current_len = 0
-                    try:
-                        while current_len < total_len:
-                            data = infile.read(1048576)  # 16mb at a time
-                            if len(data) > 0:
-                                outfile.write(dc.decompress(data))
-                            current_len += len(data)
-
-                            progress = int(40 * (current_len / total_len))
-                            new_progress_text = (
-                                "Progress: "
-                                + ("*" * progress)
-                                + (
-                                    "." * (40 - progress)
-                                    + " Unpacking %d/%d MB"
-                                    % (current_len / 1048576, total_len / 1048576)
-                                )
-                            )
-                            print(new_progress_text)
-                            if self.progress.text != new_progress_text:
-                                self.progress.text = new_progress_text
-                                self.screen.refresh()
-                                self.screen.force_update()
-                                self.screen.draw_next_frame()
-                    except EOFError:
-                        pass
-        else:
-            dlg = PopUpDialog(
-                self.screen,
-                text=f"Bad image file format {img}",
-                buttons=["OK"],
-                on_close=self.done,
-            )
-            self._scene.add_effect(dlg)
-            return
+        if os.path.abspath(img) != os.path.abspath(target_path):
+            try:
+                imagesource.copy_image(img, target_path, self._unpack_progress)
+            except imagesource.READ_ERRORS as e:
+                dlg = PopUpDialog(
+                    self.screen,
+                    text=str(e),
+                    buttons=["OK"],
+                    on_close=self.done,
+                )
+                self._scene.add_effect(dlg)
+                return
         if self.dataholder.patch_image:
             # mount as vhd and write contents, then unmount
             self.dataholder.labimage = False
@@ -660,8 +636,8 @@ class UpdateImageFrame(EscapeFrame):
             self.dataholder.uniname = "<YOUR_UNI_NAME e.g. pszjm2>@nottingham.ac.uk"
             self.dataholder.unipw = "<YOUR UNI PASSWORD>"
             self.dataholder.hash = False
-            image_edit.create_init_files(self.dataholder)
-            image_edit.add_contents_to_raw_disk(target_path)
+            init_files = image_edit.create_init_files(self.dataholder)
+            image_edit.add_contents_to_raw_disk(target_path, False, init_files)
             dlg = PopUpDialog(
                 self.screen,
                 text=f"Image patched successfully: {target_path}",
@@ -0,0 +1,179 @@
+import os
+import io
+import time
+import lzma
+import gzip
+import tempfile
+from zipfile import ZipFile, BadZipFile
+
+# optional - only needed for .zst images
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BUFFER_SIZE = 32 * 1024 * 1024  # 32mb buffer
+PROGRESS_INTERVAL = 0.25  # seconds between progress callbacks
+
+SUPPORTED_EXTENSIONS = (".img", ".zip", ".xz", ".gz", ".zst")
+# regex for file browsers to pick any supported image
+FILE_FILTER = ".*(%s)$" % "|".join(SUPPORTED_EXTENSIONS)
+
+# what reading a bad, truncated or cancelled image can raise (gzip.BadGzipFile is an OSError)
+READ_ERRORS = (ValueError, EOFError, OSError, lzma.LZMAError, BadZipFile, RuntimeError)
+if zstandard is not None:
+    READ_ERRORS += (zstandard.ZstdError,)
+
+
+class ImageSource(io.RawIOBase):
+    """Read-only stream of the raw disk image inside an .img, .zip, .xz,
+    .gz or .zst file.
+
+    Tracks how far through the container file (compressed_pos) and the
+    decompressed image (uncompressed_pos) we are. If progress_callback is
+    given, it is called as progress_callback(compressed_pos, compressed_size,
+    uncompressed_pos) at most once every interval seconds (and once at the
+    end); if it returns False, reading raises RuntimeError("Cancelled by user").
+    """
+
+    def __init__(self, path, progress_callback=None, interval=PROGRESS_INTERVAL):
+        super().__init__()
+        self.name = path
+        self.progress_callback = progress_callback
+        self.interval = interval
+        self.compressed_size = os.stat(path).st_size
+        # None if the container doesn't tell us
+        self.uncompressed_size = None
+        self.uncompressed_pos = 0
+        self._raw = open(path, "rb")
+        self._zip = None
+        try:
+            self._reader = self._open_reader(path.lower())
+        except:
+            self._raw.close()
+            raise
+        self._start_time = time.monotonic()
+        self._last_report = 0
+        self._buffer = None
+
+    def _open_reader(self, path):
+        if path.endswith(".img"):
+            self.uncompressed_size = self.compressed_size
+            return self._raw
+        elif path.endswith(".zip"):
+            # assume biggest file in zip is image
+            self._zip = ZipFile(self._raw)
+            info = max(self._zip.infolist(), key=lambda x: x.file_size)
+            self.uncompressed_size = info.file_size
+            return self._zip.open(info)
+        elif path.endswith(".xz"):
+            return lzma.LZMAFile(self._raw)
+        elif path.endswith(".gz"):
+            return gzip.GzipFile(fileobj=self._raw)
+        elif path.endswith(".zst"):
+            if zstandard is None:
+                raise ValueError("Reading .zst images needs the zstandard module (pip install zstandard)")
+            return zstandard.ZstdDecompressor().stream_reader(self._raw)
+        raise ValueError(f"Bad image file format {self.name}")
+
+    @property
+    def compressed_pos(self):
+        return self._raw.tell()
+
+    @property
+    def throughput(self):
+        "Uncompressed bytes per second since the source was opened"
+        elapsed = time.monotonic() - self._start_time
+        if elapsed <= 0:
+            return 0
+        return self.uncompressed_pos / elapsed
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        """Fills buffer as far as possible, returns the number of bytes read
+        (less than len(buffer) only at end of image)"""
+        view = memoryview(buffer).cast("B")
+        total = 0
+        while total < len(view):
+            n = self._reader.readinto(view[total:])
+            if not n:
+                break
+            total += n
+        self.uncompressed_pos += total
+        self._report(force=(total < len(view)))
+        return total
+
+    def chunks(self, size=BUFFER_SIZE):
+        """Yields memoryviews of up to size bytes until the end of the image.
+        The same buffer is reused, so each chunk must be consumed before
+        asking for the next one"""
+        if self._buffer is None or len(self._buffer) != size:
+            self._buffer = bytearray(size)
+        view = memoryview(self._buffer)
+        while True:
+            n = self.readinto(self._buffer)
+            if n == 0:
+                break
+            yield view[:n]
+            if n < size:
+                break
+
+    def _report(self, force=False):
+        if self.progress_callback is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_report < self.interval:
+            return
+        self._last_report = now
+        if not self.progress_callback(
+            self.compressed_pos, self.compressed_size, self.uncompressed_pos
+        ):
+            raise RuntimeError("Cancelled by user")
+
+    def close(self):
+        if not self.closed:
+            if self._reader is not self._raw:
+                self._reader.close()
+            if self._zip:
+                self._zip.close()
+            self._raw.close()
+        super().close()
+
+
+def open_image(path, progress_callback=None, interval=PROGRESS_INTERVAL):
+    return ImageSource(path, progress_callback, interval)
+
+
+def copy_image(src_img, target_path, progress_callback=None, interval=PROGRESS_INTERVAL):
+    """Unpacks src_img (any supported format) to a raw .img file at target_path.
+    The image is unpacked to a temporary file next to it, which replaces
+    target_path only once complete: on errors (see READ_ERRORS) it is deleted"""
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(target_path)),
+        prefix=os.path.basename(target_path) + ".",
+        suffix=".part",
+    )
+    try:
+        with open(fd, "wb") as outfile:
+            with open_image(src_img, progress_callback, interval) as src:
+                for chunk in src.chunks():
+                    outfile.write(chunk)
+        os.replace(tmp_path, target_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+if __name__ == "__main__":
+    import sys
+
+    def _progress(compressed_pos, compressed_size, uncompressed_pos):
+        print(
+            "%d/%d MB read, %d MB unpacked"
+            % (compressed_pos / 1048576, compressed_size / 1048576, uncompressed_pos / 1048576)
+        )
+        return True
+
+    copy_image(sys.argv[1], sys.argv[2], _progress)
@@ -8,6 +8,7 @@ import pythoncom
 import time
 import threading
 from dataclasses import dataclass
+import imagesource
 
 BUFFER_SIZE = 32 * 1024*1024 # 32mb buffer
 
@@ -25,7 +26,7 @@ def get_disk_volumes(target_device):
 
 def copy_to_disk(src_img,target_device,progress_callback,id):
     out_handle=None
-    in_handle=None
+    in_file=None
     volumes=[]
     try:
         out_handle=win32file.CreateFile(target_device,win32file.GENERIC_WRITE,win32file.FILE_SHARE_READ|win32file.FILE_SHARE_WRITE,None,win32file.OPEN_EXISTING,win32file.FILE_ATTRIBUTE_NORMAL,None)
@@ -49,33 +50,33 @@ def copy_to_disk(src_img,target_device,progress_callback,id):
             win32file.DeviceIoControl(volume_handle,winioctlcon.FSCTL_DISMOUNT_VOLUME,None,None)
             win32file.DeviceIoControl(volume_handle,winioctlcon.FSCTL_LOCK_VOLUME,None,None)
 
-        in_size=os.stat(src_img).st_size
         print("Opening for read:",src_img,target_device)
-        in_handle=win32file.CreateFile(src_img,win32file.GENERIC_READ,win32file.FILE_SHARE_READ|win32file.FILE_SHARE_WRITE,None,win32file.OPEN_EXISTING,win32file.FILE_ATTRIBUTE_NORMAL,None)
-        print(in_handle)
+        # progress is reported against the size of the (possibly compressed) source file
+        in_file=imagesource.open_image(src_img,lambda pos,size,unpacked: progress_callback(pos,size,id))
         read_buffer_size=(BUFFER_SIZE//sector_size)*sector_size
         print("Bufsize: ",read_buffer_size)
-        data_written=0
-        while data_written<in_size:
-            read_size=min(read_buffer_size,in_size-data_written)
-            res, data = win32file.ReadFile(in_handle, read_size)
-            if res!=0:
-                raise IOError(f"Error reading from {src_img}:{res}")
-            res,bytes_written=win32file.WriteFile(out_handle,data)
+        buffer=bytearray(read_buffer_size)
+        view=memoryview(buffer)
+        while True:
+            read_size=in_file.readinto(buffer)
+            if read_size==0:
+                break
+            # raw disk writes have to be whole sectors
+            write_size=((read_size+sector_size-1)//sector_size)*sector_size
+            buffer[read_size:write_size]=bytes(write_size-read_size)
+            res,bytes_written=win32file.WriteFile(out_handle,view[:write_size])
             if res!=0:
                 raise IOError(f"Error writing to {target_device}:{res}")        
-            data_written+=bytes_written
-            if not progress_callback(data_written,in_size,id):
-                # cancelled
-                raise RuntimeError("Cancelled by user")
+            if read_size<read_buffer_size:
+                break
 
     except pywintypes.error as e:
         raise RuntimeError(str(e))
     finally:
         if out_handle:
             win32file.CloseHandle(out_handle)
-        if in_handle:
-            win32file.CloseHandle(in_handle)
+        if in_file:
+            in_file.close()
         for volume_handle in volumes:
 #            win32file.DeviceIoControl(volume_handle,winioctlcon.FSCTL_UNLOCK_VOLUME,None,None)
             win32file.CloseHandle(volume_handle)